@@ -0,0 +1,98 @@
+"""
+Бенчмарк брокера: сколько аренд в секунду выдерживает один брокер при нескольких воркерах.
+
+    python -m benchmarks.bench_broker --workers 16 --proxies 2000 --duration 5
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from proxy_manager.broker import BrokerClient, ProxyBroker
+from proxy_manager.proxy_controller import HttpClientType, ProxyController
+
+
+def _worker(path: str, duration: float, concurrency: int, queue: multiprocessing.Queue):
+    async def run():
+        client = BrokerClient(path, HttpClientType.aiohttp)
+        await client.connect()
+        latencies = []
+        deadline = time.monotonic() + duration
+
+        async def loop(worker_id: int):
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                lease_id, _ = await client.lease(task_key=f"task{worker_id % 4}", time_condition=0.0, timeout=5.0)
+                latencies.append(time.perf_counter() - start)
+                client.release(lease_id, True)
+
+        await asyncio.gather(*(loop(i) for i in range(concurrency)))
+        await client.close()
+        queue.put(latencies)
+
+    asyncio.run(run())
+
+
+async def _serve(path: str, proxies: int, stop_event: multiprocessing.Event):
+    controller = await ProxyController.create_with_conditions(HttpClientType.aiohttp, with_check=False)
+    for i in range(proxies):
+        await controller.add_proxy(f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}:1080:user:pass")
+    broker = ProxyBroker(controller, path)
+    await broker.start()
+    while not stop_event.is_set():
+        await asyncio.sleep(0.05)
+    await broker.stop()
+
+
+def _broker_process(path: str, proxies: int, ready: multiprocessing.Event, stop_event: multiprocessing.Event):
+    async def run():
+        task = asyncio.create_task(_serve(path, proxies, stop_event))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        ready.set()
+        await task
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных аренд на воркер")
+    parser.add_argument("--proxies", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+    ready, stop_event = multiprocessing.Event(), multiprocessing.Event()
+    broker = multiprocessing.Process(target=_broker_process, args=(path, args.proxies, ready, stop_event))
+    broker.start()
+    ready.wait()
+
+    queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_worker, args=(path, args.duration, args.concurrency, queue))
+        for _ in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    latencies = []
+    for _ in workers:
+        latencies.extend(queue.get())
+    for worker in workers:
+        worker.join()
+    stop_event.set()
+    broker.join()
+
+    latencies.sort()
+    print(f"workers={args.workers} concurrency={args.concurrency} proxies={args.proxies}")
+    print(f"leases/sec: {len(latencies) / args.duration:.0f}")
+    print(f"lease latency p50: {statistics.median(latencies) * 1e6:.0f} us")
+    print(f"lease latency p99: {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Бенчмарк загрузки прокси при старте: add_proxy в цикле против add_proxies из файла.
+Каждый способ запускается в отдельном процессе, меряется время и пиковый RSS процесса.
+
+    python -m benchmarks.bench_load --proxies 50000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from proxy_manager.proxy_controller import HttpClientType, ProxyController
+
+
+def _proxy_line(i: int) -> str:
+    return f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}:1080:user:pass"
+
+
+async def _load_loop(path: str):
+    controller = await ProxyController.create_with_conditions(HttpClientType.aiohttp, with_check=False)
+    with open(path) as lines:
+        for line in lines:
+            await controller.add_proxy(line.strip())
+    return controller
+
+
+async def _load_stream(path: str):
+    controller = await ProxyController.create_with_conditions(HttpClientType.aiohttp, with_check=False)
+    await controller.add_proxies(path)
+    return controller
+
+
+async def _measure(name: str, load, path: str):
+    start = time.perf_counter()
+    controller = await load(path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name}: {elapsed:.2f} s, peak RSS {peak:.0f} MiB, {len(controller.queue.proxies)} proxies", flush=True)
+    await ProxyController.close_all_connectors()
+
+
+def _run(name: str, load, path: str):
+    asyncio.run(_measure(name, load, path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=50000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "proxies.txt")
+    with open(path, "w") as f:
+        for i in range(args.proxies):
+            f.write(_proxy_line(i) + "\n")
+
+    print(f"proxies={args.proxies}")
+    for name, load in (("add_proxy loop", _load_loop), ("add_proxies", _load_stream)):
+        process = multiprocessing.Process(target=_run, args=(name, load, path))
+        process.start()
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Бенчмарк прогрева: задержка первого запроса через только что выданную прокси без прогрева и после
+ConnectionPrewarmer. Прокси - локальные SOCKS5 ретрансляторы, которые перед CONNECT ждут --connect-delay
+(вместо сетевой задержки до прокси и сайта), сайт - локальный http сервер с keep-alive.
+
+    python -m benchmarks.bench_prewarm --proxies 20 --connect-delay 0.05
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List
+
+import httpx
+
+from proxy_manager.connectors_fabric import HttpClientType
+from proxy_manager.prewarm import ConnectionPrewarmer
+from proxy_manager.proxy_controller import ProxyController
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _socks5_relay(connect_delay: float) -> asyncio.Server:
+    async def handle(reader, writer):
+        try:
+            _, n_methods = await reader.readexactly(2)
+            await reader.readexactly(n_methods)
+            writer.write(b"\x05\x02")
+            _, user_len = await reader.readexactly(2)
+            await reader.readexactly(user_len)
+            (password_len,) = await reader.readexactly(1)
+            await reader.readexactly(password_len)
+            writer.write(b"\x01\x00")
+            _, _, _, address_type = await reader.readexactly(4)
+            if address_type == 1:
+                host = ".".join(str(b) for b in await reader.readexactly(4))
+            else:
+                (host_len,) = await reader.readexactly(1)
+                host = (await reader.readexactly(host_len)).decode()
+            port = int.from_bytes(await reader.readexactly(2), "big")
+            await asyncio.sleep(connect_delay)
+            upstream_reader, upstream_writer = await asyncio.open_connection(host, port)
+            writer.write(b"\x05\x00\x00\x01" + bytes(6))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        await asyncio.gather(_pipe(reader, upstream_writer), _pipe(upstream_reader, writer))
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def _http_target() -> asyncio.Server:
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                body = b"" if head.startswith(b"HEAD") else b"ok"
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def _first_requests(controller: ProxyController, url: str, n: int) -> List[float]:
+    latencies = []
+    for _ in range(n):
+        async with controller.acquire(task_key="bench", time_condition=60.0, timeout=5.0) as proxy:
+            started = time.perf_counter()
+            if isinstance(proxy.session, httpx.AsyncClient):
+                await proxy.session.get(url)
+            else:
+                async with proxy.session.get(url) as response:
+                    await response.read()
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def _run(proxies: int, connect_delay: float, http_client: HttpClientType):
+    target = await _http_target()
+    url = f"http://127.0.0.1:{target.sockets[0].getsockname()[1]}/"
+    relays = [await _socks5_relay(connect_delay) for _ in range(proxies)]
+    results = {}
+    for mode in ("cold", "prewarmed"):
+        controller = await ProxyController.create_with_conditions(http_client, with_check=False)
+        for relay in relays:
+            await controller.add_proxy(f"127.0.0.1:{relay.sockets[0].getsockname()[1]}:user:pass")
+        prewarmer = None
+        if mode == "prewarmed":
+            prewarmer = ConnectionPrewarmer(
+                controller, [url], task_key="bench", time_condition=60.0, max_warm=proxies, concurrency=proxies
+            )
+            await prewarmer.start()
+            while len(prewarmer.warmed) < proxies:
+                await asyncio.sleep(0.05)
+        results[mode] = await _first_requests(controller, url, proxies)
+        if prewarmer is not None:
+            await prewarmer.stop()
+        await ProxyController.close_all_connectors()
+        for proxy_data in list(controller.sessions):
+            ProxyController.proxy_storage.remove_proxy(proxy_data)
+    for relay in relays:
+        relay.close()
+    target.close()
+    await asyncio.sleep(0.1)  # закрытые клиенты дают EOF - обработчики соединений завершаются сами
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=20)
+    parser.add_argument("--connect-delay", type=float, default=0.05, help="задержка SOCKS5 CONNECT, секунды")
+    parser.add_argument("--client", choices=["httpx", "aiohttp"], default="httpx")
+    args = parser.parse_args()
+
+    print(f"proxies={args.proxies} connect_delay={args.connect_delay} client={args.client}")
+    results = asyncio.run(_run(args.proxies, args.connect_delay, HttpClientType[args.client]))
+    for mode, latencies in results.items():
+        print(
+            f"{mode}: first request mean {statistics.mean(latencies) * 1000:.1f} ms, "
+            f"p50 {statistics.median(latencies) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
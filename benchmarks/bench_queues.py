@@ -0,0 +1,50 @@
+"""
+Бенчмарк очередей: get/release в секунду у ProxyQueueWithoutConditions и ProxyPool
+при одинаковой нагрузке (одна задача, кулдаун time_condition).
+
+    python -m benchmarks.bench_queues --proxies 5000 --concurrency 200 --cooldown 0.01
+"""
+import argparse
+import asyncio
+import time
+
+from proxy_manager.queues.abstract_queue import AbstractQueue
+from proxy_manager.queues.custom_queue import ProxyPool
+from proxy_manager.queues.queue_without_conditions import ProxyQueueWithoutConditions
+from proxy_manager.types import ProxyData, ProxySession
+
+
+async def _run(queue: AbstractQueue, proxies: int, concurrency: int, cooldown: float, duration: float) -> int:
+    for i in range(proxies):
+        proxy_data = ProxyData(f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}", 1080, "user", "pass")
+        await queue.add(ProxySession(proxy_data=proxy_data, session=None))
+    done = 0
+    deadline = time.monotonic() + duration
+
+    async def loop():
+        nonlocal done
+        while time.monotonic() < deadline:
+            proxy = await queue.get(task_key="task", last_used=cooldown, timeout=10.0)
+            await queue.release(proxy, "task")
+            done += 1
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных get/release")
+    parser.add_argument("--cooldown", type=float, default=0.0, help="time_condition в секундах")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    print(f"proxies={args.proxies} concurrency={args.concurrency} cooldown={args.cooldown}")
+    for queue_cls in (ProxyQueueWithoutConditions, ProxyPool):
+        done = asyncio.run(_run(queue_cls(), args.proxies, args.concurrency, args.cooldown, args.duration))
+        print(f"{queue_cls.__name__}: {done / args.duration:.0f} get+release/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Бенчмарк снимка состояния: запись и восстановление пула с накопленной статистикой и кулдаунами.
+
+    python -m benchmarks.bench_snapshot --proxies 50000 --tasks 3
+"""
+import argparse
+import asyncio
+import gc
+import os
+import tempfile
+import time
+
+from proxy_manager.connectors_fabric import HttpClientType
+from proxy_manager.proxy_controller import ProxyController
+
+
+async def _run(proxies: int, tasks: int, without_conditions: bool):
+    create = ProxyController.create_without_conditions if without_conditions else ProxyController.create_with_conditions
+    storage = ProxyController.proxy_storage
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "state.db")
+        controller = await create(HttpClientType.httpx, with_check=False)
+        await controller.add_proxies(
+            f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}:1080:user:pass" for i in range(proxies)
+        )
+        for proxy in controller.sessions.values():
+            for task in range(tasks):
+                storage.report_status(proxy.proxy_data, True, f"task{task}", latency=0.1)
+                proxy.update_used_time(f"task{task}")
+
+        started = time.perf_counter()
+        await controller.start_snapshots(path, interval=3600)
+        await controller.stop_snapshots()
+        saved = time.perf_counter() - started
+        size = os.path.getsize(path)
+
+        # Как после перезапуска: прежнего пула в памяти нет
+        for proxy_data in list(controller.sessions):
+            storage.remove_proxy(proxy_data)
+        del controller
+        gc.collect()
+        started = time.perf_counter()
+        restarted = await create(HttpClientType.httpx, with_check=False, snapshot_path=path, snapshot_interval=3600)
+        restored = time.perf_counter() - started
+        await restarted.stop_snapshots(save=False)
+        return len(restarted.sessions), saved, restored, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--proxies", type=int, default=50000)
+    parser.add_argument("--tasks", type=int, default=3, help="задач с кулдауном и статистикой на прокси")
+    parser.add_argument("--without-conditions", action="store_true")
+    args = parser.parse_args()
+
+    count, saved, restored, size = asyncio.run(_run(args.proxies, args.tasks, args.without_conditions))
+    print(f"proxies={count} tasks={args.tasks} snapshot={size / 1024 / 1024:.1f} MB")
+    print(f"save: {saved * 1000:.0f} ms, restore: {restored * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+Брокер прокси для нескольких процессов.
+
+Один процесс владеет ProxyController (пул, кулдауны, статистика), воркеры берут и
+возвращают аренды через unix-сокет. Клиенты (httpx/aiohttp) создаются в каждом воркере
+локально, по сокету ходит только строка прокси.
+
+Формат кадра: заголовок !IBI (длина тела, код операции, id запроса) и тело.
+Строки в теле - !H длина + utf-8.
+"""
+import asyncio
+import itertools
+import logging
+import struct
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set, Tuple
+
+from proxy_manager.connectors_fabric import SessionFactory
+from proxy_manager.proxy_controller import PROXY_ERRORS, HttpClientType, ProxyController, ProxyError
+from proxy_manager.types import ProxyData, ProxySession, RateLimit, cooldown_key
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("!IBI")
+# time_condition, timeout (<0 - без таймаута), priority, rate (<=0 - без rate_limit), burst
+_ACQUIRE = struct.Struct("!ddidi")
+_LEASE = struct.Struct("!Q")
+_RELEASE = struct.Struct("!QB")
+_U16 = struct.Struct("!H")
+
+OP_ACQUIRE = 1
+OP_RELEASE = 2
+OP_LEASE = 10
+OP_TIMEOUT = 11
+OP_ERROR = 12
+
+STATUS_FAIL = 0
+STATUS_OK = 1
+STATUS_UNKNOWN = 2
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode()
+    return _U16.pack(len(data)) + data
+
+
+def _unpack_str(body: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _U16.unpack_from(body, offset)
+    offset += _U16.size
+    return body[offset:offset + length].decode(), offset + length
+
+
+def encode_acquire(
+        task_key: str,
+        time_condition: float,
+        timeout: Optional[float],
+        other_conditions: Optional[Dict[str, str]],
+        priority: int,
+        rate_limit: Optional[RateLimit] = None,
+        host: Optional[str] = None,
+) -> bytes:
+    other_conditions = other_conditions or {}
+    rate, burst = (rate_limit.rate, rate_limit.burst) if rate_limit is not None else (0.0, 0)
+    parts = [
+        _ACQUIRE.pack(time_condition, -1.0 if timeout is None else timeout, priority, rate, burst),
+        _pack_str(task_key),
+        _pack_str(host or ""),
+        _U16.pack(len(other_conditions)),
+    ]
+    for key, value in other_conditions.items():
+        parts.append(_pack_str(key))
+        parts.append(_pack_str(value))
+    return b"".join(parts)
+
+
+def decode_acquire(
+        body: bytes
+) -> Tuple[str, float, Optional[float], Dict[str, str], int, Optional[RateLimit], Optional[str]]:
+    time_condition, timeout, priority, rate, burst = _ACQUIRE.unpack_from(body, 0)
+    task_key, offset = _unpack_str(body, _ACQUIRE.size)
+    host, offset = _unpack_str(body, offset)
+    (count,) = _U16.unpack_from(body, offset)
+    offset += _U16.size
+    other_conditions = {}
+    for _ in range(count):
+        key, offset = _unpack_str(body, offset)
+        value, offset = _unpack_str(body, offset)
+        other_conditions[key] = value
+    rate_limit = RateLimit(rate, burst) if rate > 0 else None
+    return (
+        task_key, time_condition, None if timeout < 0 else timeout, other_conditions, priority, rate_limit, host or None
+    )
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    header = await reader.readexactly(_HEADER.size)
+    length, op, request_id = _HEADER.unpack(header)
+    body = await reader.readexactly(length) if length else b""
+    return op, request_id, body
+
+
+def _frame(op: int, request_id: int, body: bytes = b"") -> bytes:
+    return _HEADER.pack(len(body), op, request_id) + body
+
+
+class ProxyBroker:
+    """Серверная часть: раздает аренды прокси из пула контроллера"""
+
+    def __init__(self, controller: ProxyController, path: str):
+        self.controller = controller
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._lease_ids = itertools.count(1)
+        # id аренды -> (прокси, task_key, host)
+        self._leases: Dict[int, Tuple[ProxySession, str, Optional[str]]] = {}
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection_leases = set()
+        pending = set()
+        try:
+            while True:
+                op, request_id, body = await _read_frame(reader)
+                if op == OP_ACQUIRE:
+                    task = asyncio.create_task(self._acquire(writer, request_id, body, connection_leases))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                elif op == OP_RELEASE:
+                    lease_id, status = _RELEASE.unpack(body)
+                    connection_leases.discard(lease_id)
+                    await self._release(lease_id, status)
+                else:
+                    writer.write(_frame(OP_ERROR, request_id, _pack_str(f"Unknown op {op}")))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Дожидаемся отмененных выдач: прокси, выданная в момент отмены, успеет вернуться в очередь
+            # или попасть в connection_leases до того, как аренды соединения будут возвращены
+            pending = list(pending)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            # Воркер отвалился - его аренды возвращаем без статистики
+            for lease_id in connection_leases:
+                await self._release(lease_id, STATUS_UNKNOWN)
+            writer.close()
+
+    async def _acquire(self, writer: asyncio.StreamWriter, request_id: int, body: bytes, connection_leases: set):
+        # Ответ уходит всегда, иначе lease воркера так и будет ждать
+        try:
+            await self._lease(writer, request_id, body, connection_leases)
+        except Exception as e:
+            logger.exception("Broker failed to acquire proxy")
+            writer.write(_frame(OP_ERROR, request_id, _pack_str(f"Broker error: {e!r}")))
+
+    async def _lease(self, writer: asyncio.StreamWriter, request_id: int, body: bytes, connection_leases: set):
+        task_key, time_condition, timeout, other_conditions, priority, rate_limit, host = decode_acquire(body)
+        try:
+            proxy = await self.controller.queue.get(
+                task_key=cooldown_key(task_key, host),
+                last_used=time_condition,
+                timeout=timeout,
+                other_conditions=other_conditions,
+                priority=priority,
+                rate_limit=rate_limit,
+            )
+        except (asyncio.TimeoutError, TimeoutError):
+            writer.write(_frame(OP_TIMEOUT, request_id))
+            return
+        lease_id = next(self._lease_ids)
+        self._leases[lease_id] = (proxy, task_key, host)
+        connection_leases.add(lease_id)
+        writer.write(_frame(OP_LEASE, request_id, _LEASE.pack(lease_id) + _pack_str(proxy.proxy_data.as_str())))
+
+    async def _release(self, lease_id: int, status: int):
+        lease = self._leases.pop(lease_id, None)
+        if lease is None:
+            return
+        proxy, task_key, host = lease
+        request_status = None if status == STATUS_UNKNOWN else status == STATUS_OK
+        await self.controller.return_proxy(proxy, task_key=task_key, request_status=request_status, host=host)
+
+
+class BrokerClient:
+    """Клиент воркера: берет аренды у брокера, клиенты http создает локально"""
+
+    def __init__(self, path: str, http_client: HttpClientType):
+        self.path = path
+        self.http_client = http_client
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._request_ids = itertools.count(1)
+        self._waiters: Dict[int, asyncio.Future] = {}
+        # id запросов, ответа на которые воркер уже не ждет: выданную по ним аренду сразу возвращаем
+        self._abandoned: Set[int] = set()
+        # строка прокси -> локальная сессия воркера
+        self._sessions: Dict[str, ProxySession] = {}
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        for proxy in self._sessions.values():
+            if self.http_client == HttpClientType.httpx:
+                await SessionFactory.close_httpx_session(proxy.session)
+            else:
+                await SessionFactory.close_aiohttp_session(proxy.session)
+        self._sessions.clear()
+
+    async def _read_responses(self):
+        try:
+            while True:
+                op, request_id, body = await _read_frame(self._reader)
+                future = self._waiters.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((op, body))
+                elif (future is not None and future.cancelled()) or request_id in self._abandoned:
+                    self._abandoned.discard(request_id)
+                    self._release_abandoned(op, body)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self._waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Broker connection lost: {e}"))
+            self._waiters.clear()
+
+    def _local_session(self, proxy_str: str) -> ProxySession:
+        proxy = self._sessions.get(proxy_str)
+        if proxy is None:
+            ip, port, username, password = proxy_str.split(":")
+            proxy_data = ProxyData(ip, int(port), username, password)
+            if self.http_client == HttpClientType.httpx:
+                client = SessionFactory.create_httpx_session(proxy_data)
+            else:
+                client = SessionFactory.create_aiohttp_session(proxy_data)
+            proxy = self._sessions[proxy_str] = ProxySession(proxy_data=proxy_data, session=client)
+        return proxy
+
+    async def lease(
+            self,
+            task_key: str = "default",
+            time_condition: float = 5.0,
+            timeout: float | None = 100.0,
+            other_conditions: Optional[Dict[str, str]] = None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            host: Optional[str] = None,
+    ) -> Tuple[int, ProxySession]:
+        """
+        :return: (id аренды, локальная сессия), аренду обязательно вернуть через release
+        """
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = future
+        body = encode_acquire(task_key, time_condition, timeout, other_conditions, priority, rate_limit, host)
+        self._writer.write(_frame(OP_ACQUIRE, request_id, body))
+        try:
+            op, body = await future
+        except BaseException:
+            self._abandon(request_id, future)
+            raise
+        finally:
+            self._waiters.pop(request_id, None)
+        if op == OP_TIMEOUT:
+            raise asyncio.TimeoutError(f"Broker timeout ({timeout}s) while waiting for proxy.")
+        if op != OP_LEASE:
+            message, _ = _unpack_str(body, 0)
+            raise ProxyError(message)
+        (lease_id,) = _LEASE.unpack_from(body, 0)
+        proxy_str, _ = _unpack_str(body, _LEASE.size)
+        return lease_id, self._local_session(proxy_str)
+
+    def _abandon(self, request_id: int, future: asyncio.Future):
+        """Воркер перестал ждать (отмена, таймаут): аренда, выданная брокером сейчас или позже, не должна зависнуть"""
+        if future.done() and not future.cancelled():
+            if future.exception() is None:
+                self._release_abandoned(*future.result())
+        elif request_id in self._waiters:
+            self._abandoned.add(request_id)
+
+    def _release_abandoned(self, op: int, body: bytes):
+        if op == OP_LEASE:
+            (lease_id,) = _LEASE.unpack_from(body, 0)
+            self.release(lease_id, None)
+
+    def release(self, lease_id: int, request_status: Optional[bool]):
+        """
+        :param request_status: true - work false - not work, None - не учитывать в статистике
+        """
+        status = STATUS_UNKNOWN if request_status is None else (STATUS_OK if request_status else STATUS_FAIL)
+        self._writer.write(_frame(OP_RELEASE, 0, _RELEASE.pack(lease_id, status)))
+
+    @asynccontextmanager
+    async def acquire(
+            self,
+            task_key: str = "default",
+            time_condition: float = 5.0,
+            timeout: float | None = 100.0,
+            other_conditions: Optional[Dict[str, str]] = None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            host: Optional[str] = None,
+    ):
+        """То же, что ProxyController.acquire, но прокси берется у брокера"""
+        lease_id, proxy = await self.lease(
+            task_key, time_condition, timeout, other_conditions, priority, rate_limit, host
+        )
+        try:
+            async with asyncio.timeout(20):
+                yield proxy
+        except PROXY_ERRORS as e:
+            self.release(lease_id, False)
+            logger.debug("request if failed: %s", e)
+            raise ProxyError("Proxy is bad")
+        except BaseException:
+            self.release(lease_id, None)
+            raise
+        self.release(lease_id, True)
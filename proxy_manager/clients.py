@@ -0,0 +1,173 @@
+from collections import OrderedDict
+from enum import Enum
+from typing import Dict, Optional, Set, Union
+
+import aiohttp
+import httpx
+
+from proxy_manager.connectors_fabric import HttpClientType, SessionFactory
+from proxy_manager.types import ProxySession
+
+HttpClient = Union[httpx.AsyncClient, aiohttp.ClientSession]
+
+
+class ClientState(Enum):
+    live = 1
+    closing = 2
+    closed = 3
+
+
+class ClientRegistry:
+    """
+    Реестр http клиентов прокси: у каждой прокси не больше одного живого клиента.
+    Замененный или закрытый клиент закрывается через реестр и сразу забывается
+    """
+
+    def __init__(self):
+        self._live: Dict[ProxySession, HttpClient] = {}
+        self._live_ids: Set[int] = set()
+        # id клиента -> клиент, пока идет закрытие
+        self._closing: Dict[int, HttpClient] = {}
+
+    @property
+    def live_count(self) -> int:
+        return len(self._live)
+
+    @property
+    def closing_count(self) -> int:
+        return len(self._closing)
+
+    def state(self, client: HttpClient) -> ClientState:
+        if id(client) in self._live_ids:
+            return ClientState.live
+        if id(client) in self._closing:
+            return ClientState.closing
+        return ClientState.closed
+
+    def register(self, proxy: ProxySession, client: HttpClient):
+        """Новый клиент прокси. Прежний к этому моменту должен быть закрыт"""
+        previous = self._live.get(proxy)
+        if previous is not None:
+            self._live_ids.discard(id(previous))
+        self._live[proxy] = client
+        self._live_ids.add(id(client))
+
+    async def sync(self, proxy: ProxySession):
+        """
+        Приводит реестр к proxy.session, например после ProxyChecker: прежний клиент прокси закрывается
+        """
+        previous = self._live.get(proxy)
+        if previous is proxy.session:
+            return
+        if previous is not None:
+            self._forget(proxy)
+        if proxy.session is not None:
+            self.register(proxy, proxy.session)
+        if previous is not None:
+            await self._close_client(previous)
+
+    async def close(self, proxy: ProxySession):
+        """Закрывает живой клиент прокси и обнуляет proxy.session"""
+        client = self._live.get(proxy)
+        if client is not None:
+            self._forget(proxy)
+        if proxy.session is client:
+            proxy.session = None
+        if client is not None:
+            await self._close_client(client)
+
+    async def close_all(self):
+        for proxy in list(self._live):
+            await self.close(proxy)
+
+    def _forget(self, proxy: ProxySession):
+        client = self._live.pop(proxy)
+        self._live_ids.discard(id(client))
+
+    async def _close_client(self, client: HttpClient):
+        self._closing[id(client)] = client
+        try:
+            await SessionFactory.close_session(client)
+        finally:
+            del self._closing[id(client)]
+
+
+class ClientCache:
+    """
+    Клиенты прокси создаются при первой выдаче, а не при добавлении. Если живых клиентов больше max_clients,
+    закрываются давно простаивающие (ни одной выдачи сейчас), при следующей выдаче клиент создается заново.
+    Так память зависит от числа одновременных запросов, а не от размера пула
+    """
+
+    def __init__(
+            self,
+            http_client: HttpClientType,
+            max_clients: Optional[int] = None,
+            registry: Optional[ClientRegistry] = None,
+    ):
+        """
+        :param max_clients: максимум живых клиентов, None - без ограничения
+        :param registry: реестр, в котором регистрируются созданные клиенты
+        """
+        self.http_client = http_client
+        self.max_clients = max_clients
+        self.registry = registry or ClientRegistry()
+        self._owned: Set[ProxySession] = set()  # прокси с клиентом, созданным этим кэшем
+        self._leases: Dict[ProxySession, int] = {}
+        # простаивающие прокси с живым клиентом, от давно отпущенных к недавним
+        self._idle: "OrderedDict[ProxySession, None]" = OrderedDict()
+        self._stale: Set[ProxySession] = set()  # клиент закрывается после последней выдачи
+
+    @property
+    def live(self) -> int:
+        return len(self._owned)
+
+    def leased(self, proxy: ProxySession) -> bool:
+        return proxy in self._leases
+
+    def checkout(self, proxy: ProxySession) -> ProxySession:
+        """Перед выдачей прокси: создает клиент, если его нет, и убирает прокси из кандидатов на закрытие"""
+        self._idle.pop(proxy, None)
+        self._leases[proxy] = self._leases.get(proxy, 0) + 1
+        if proxy.session is None or SessionFactory.is_closed(proxy.session):
+            proxy.session = SessionFactory.create_session(self.http_client, proxy.proxy_data)
+            self.registry.register(proxy, proxy.session)
+            self._owned.add(proxy)
+        return proxy
+
+    async def checkin(self, proxy: ProxySession):
+        """После возврата прокси: последняя выдача закончилась - клиент становится кандидатом на закрытие"""
+        if proxy not in self._leases:
+            return  # прокси выдана не через checkout (например, брокером без клиента)
+        leases = self._leases[proxy] - 1
+        if leases > 0:
+            self._leases[proxy] = leases
+            return
+        self._leases.pop(proxy, None)
+        if proxy in self._stale:
+            await self.close(proxy)
+            return
+        if proxy.session is not None:
+            self._idle[proxy] = None
+        await self.evict()
+
+    async def evict(self):
+        if self.max_clients is None:
+            return
+        while self.live > self.max_clients and self._idle:
+            proxy, _ = self._idle.popitem(last=False)
+            await self.close(proxy)
+
+    async def invalidate(self, proxy: ProxySession):
+        """Клиент устарел (например, сменился логин прокси): закрывается сейчас или после последней выдачи"""
+        if proxy in self._leases:
+            self._stale.add(proxy)
+        else:
+            await self.close(proxy)
+
+    async def close(self, proxy: ProxySession):
+        """Закрывает клиент прокси, при следующей выдаче он создастся заново"""
+        self._idle.pop(proxy, None)
+        self._stale.discard(proxy)
+        self._owned.discard(proxy)
+        await self.registry.close(proxy)
@@ -1,3 +1,6 @@
+from enum import Enum
+from typing import Union
+
 import aiohttp
 import httpx
 from aiohttp_socks import ProxyType, ProxyConnector
@@ -5,6 +8,11 @@ from aiohttp_socks import ProxyType, ProxyConnector
 from proxy_manager.proxy_storage import ProxyData
 
 
+class HttpClientType(Enum):
+    httpx = 1
+    aiohttp = 2
+
+
 class SessionFactory:
     @classmethod
     def _create_aiohttp_socks_con(cls, proxy: ProxyData) -> ProxyConnector:
@@ -27,6 +35,29 @@ class SessionFactory:
             http2=True,
         )
 
+    @classmethod
+    def create_session(
+            cls, http_client: HttpClientType, proxy: ProxyData
+    ) -> Union[httpx.AsyncClient, aiohttp.ClientSession]:
+        if http_client == HttpClientType.httpx:
+            return cls.create_httpx_session(proxy)
+        return cls.create_aiohttp_session(proxy)
+
+    @classmethod
+    def is_closed(cls, session: Union[httpx.AsyncClient, aiohttp.ClientSession]) -> bool:
+        if isinstance(session, httpx.AsyncClient):
+            return session.is_closed
+        if isinstance(session, aiohttp.ClientSession):
+            return session.closed
+        return False
+
+    @classmethod
+    async def close_session(cls, session: Union[httpx.AsyncClient, aiohttp.ClientSession]):
+        if isinstance(session, httpx.AsyncClient):
+            await cls.close_httpx_session(session)
+        elif isinstance(session, aiohttp.ClientSession):
+            await cls.close_aiohttp_session(session)
+
     @classmethod
     async def close_httpx_session(cls, proxy):
         await proxy.aclose()
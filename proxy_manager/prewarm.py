@@ -0,0 +1,126 @@
+"""
+Прогрев соединений прокси, которые скоро пойдут в выдачу.
+
+Первый запрос через свежий клиент платит за TCP до прокси, SOCKS5 рукопожатие с авторизацией, CONNECT
+и TLS до сайта. Прогреватель заранее делает HEAD к горячим сайтам через клиенты прокси, у которых по
+расписанию кулдаунов task_key скоро закончится кулдаун, и соединение остается в пуле клиента (keep-alive).
+Прокси при этом из пула не забираются, клиент создается через ClientCache как при обычной выдаче.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+import aiohttp
+import httpx
+
+from proxy_manager.proxy_controller import ProxyController
+from proxy_manager.types import ProxySession
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPrewarmer:
+    def __init__(
+            self,
+            controller: ProxyController,
+            urls: List[str],
+            task_key: str = "default",
+            time_condition: float = 5.0,
+            lead_time: float = 2.0,
+            max_warm: int = 8,
+            refresh: float = 4.0,
+            interval: float = 0.5,
+            concurrency: int = 4,
+            timeout: float = 5.0,
+    ):
+        """
+        :param urls: горячие сайты, соединения к которым держать открытыми
+        :param task_key: по расписанию кулдаунов какой задачи выбирать прокси
+        :param time_condition: кулдаун этой задачи, как в acquire
+        :param lead_time: греть прокси, которые освободятся в ближайшие lead_time секунд
+        :param max_warm: сколько ближайших прокси держать прогретыми
+        :param refresh: через сколько секунд прогревать прокси снова, должно быть меньше
+         времени жизни простаивающего соединения в клиенте (keep-alive)
+        :param interval: как часто пересматривать ближайшие прокси
+        :param concurrency: максимум одновременных прогревов
+        :param timeout: прогрев дольше timeout считается неудачным
+        """
+        self.controller = controller
+        self.urls = urls
+        self.task_key = task_key
+        self.time_condition = time_condition
+        self.lead_time = lead_time
+        self.max_warm = max_warm
+        self.refresh = refresh
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.warmed: Dict[ProxySession, float] = {}  # прокси -> time.monotonic() последнего прогрева
+        self._task: Optional[asyncio.Task] = None
+        self._warming: Dict[ProxySession, asyncio.Task] = {}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._warming.values())
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _due(self) -> List[ProxySession]:
+        """Ближайшие к выдаче прокси, которые еще не прогреты или прогреты давно"""
+        now = time.monotonic()
+        upcoming = self.controller.queue.upcoming(self.task_key, self.time_condition, self.lead_time, self.max_warm)
+        # Забываем прокси, которые ушли из ближайших и остыли
+        keep: Set[ProxySession] = set(upcoming)
+        self.warmed = {
+            proxy: at for proxy, at in self.warmed.items() if proxy in keep or now - at < self.refresh
+        }
+        return [
+            proxy for proxy in upcoming
+            if proxy not in self._warming and now - self.warmed.get(proxy, -self.refresh) >= self.refresh
+        ]
+
+    async def _run(self):
+        while True:
+            for proxy in self._due():
+                if len(self._warming) >= self.concurrency:
+                    break
+                task = asyncio.create_task(self.warm(proxy))
+                self._warming[proxy] = task
+                task.add_done_callback(lambda _, proxy=proxy: self._warming.pop(proxy, None))
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    async def _touch(session, url: str):
+        if isinstance(session, httpx.AsyncClient):
+            await session.request("HEAD", url)
+        elif isinstance(session, aiohttp.ClientSession):
+            async with session.head(url):
+                pass
+        else:
+            raise ValueError(f"Unsupported session type: {type(session)}")
+
+    async def warm(self, proxy: ProxySession) -> bool:
+        """
+        Открывает через прокси соединения ко всем urls и оставляет их в пуле клиента
+        :return: False если прогрев не удался (на статистику прокси не влияет)
+        """
+        self.controller.clients.checkout(proxy)
+        try:
+            async with asyncio.timeout(self.timeout):
+                for url in self.urls:
+                    await self._touch(proxy.session, url)
+        except Exception as e:
+            logger.debug("Prewarm failed for %s: %s", proxy.proxy_data.ip, e)
+            return False
+        finally:
+            await self.controller._checkin(proxy)
+        self.warmed[proxy] = time.monotonic()
+        return True
@@ -0,0 +1,137 @@
+"""
+Фоновый замер задержки свободных прокси.
+
+Прокси из пула не забираются: проба идет через клиент прокси параллельно с обычными запросами,
+поэтому acquire она не блокирует. У прокси без клиента меряется SOCKS5 рукопожатие, клиент ради пробы
+не создается. Время до первого байта ответа уходит в ProxyStorage.report_probe, по оценке здоровья
+PowerOfTwoChoicesPolicy и LatencyWeightedPolicy реже выбирают медленные прокси, а LeastRecentlyUsedPolicy
+с хранилищем (по умолчанию в create_with_conditions) пропускает прокси с оценкой ниже min_health.
+Очередь без условий оценку не учитывает.
+"""
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set
+from urllib.parse import urlsplit
+
+import aiohttp
+import httpx
+
+from proxy_manager.proxy_check import ProxyChecker
+from proxy_manager.proxy_controller import ProxyController
+from proxy_manager.queues.custom_queue import ProxyPool
+from proxy_manager.queues.selection import LeastRecentlyUsedPolicy
+from proxy_manager.types import ProxySession
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyProber:
+    def __init__(
+            self,
+            controller: ProxyController,
+            url: str = "https://example.com/",
+            rate: float = 1.0,
+            concurrency: int = 4,
+            timeout: float = 5.0,
+            slow_latency: float = 2.0,
+    ):
+        """
+        :param url: что запрашивать через прокси
+        :param rate: проб в секунду на весь пул, прокси перебираются по кругу
+        :param concurrency: максимум одновременных проб
+        :param timeout: проба дольше timeout считается неудачной
+        :param slow_latency: задержка, при которой оценка здоровья стремится к 0.5
+        """
+        self.controller = controller
+        self.url = url
+        self.rate = rate
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.slow_latency = slow_latency
+        self._task: Optional[asyncio.Task] = None
+        self._probes: Set[asyncio.Task] = set()
+        self._round: List[ProxySession] = []
+
+    async def start(self):
+        policy = getattr(self.controller.queue, "policy", None)
+        if policy is None or (isinstance(policy, LeastRecentlyUsedPolicy) and policy.storage is None):
+            logger.warning("Queue selection ignores health score, probes only update stats")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._probes)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _idle_proxies(self) -> List[ProxySession]:
+        queue = self.controller.queue
+        if isinstance(queue, ProxyPool):
+            return list(queue.proxies)
+        return list(queue.ready)
+
+    def _next_proxy(self) -> Optional[ProxySession]:
+        """Следующая свободная прокси по кругу. Круг собирается заново, когда кончается"""
+        if not self._round:
+            self._round = self._idle_proxies()
+            self._round.reverse()
+        while self._round:
+            proxy = self._round.pop()
+            if proxy.in_rotation and proxy.in_flight == 0:
+                return proxy
+        return None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            if len(self._probes) >= self.concurrency:
+                continue
+            proxy = self._next_proxy()
+            if proxy is None:
+                continue
+            task = asyncio.create_task(self.probe(proxy))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+
+    async def _time_to_first_byte(self, proxy: ProxySession) -> float:
+        start = time.perf_counter()
+        if proxy.session is None:
+            # Клиент еще не создан (или закрыт как простаивающий) - ради пробы его не создаем,
+            # меряем SOCKS5 рукопожатие и CONNECT к хосту url
+            url = urlsplit(self.url)
+            port = url.port or (443 if url.scheme == "https" else 80)
+            await ProxyChecker.socks5_handshake(proxy.proxy_data, url.hostname, port)
+            return time.perf_counter() - start
+        if isinstance(proxy.session, httpx.AsyncClient):
+            async with proxy.session.stream("GET", self.url):
+                return time.perf_counter() - start
+        if isinstance(proxy.session, aiohttp.ClientSession):
+            async with proxy.session.get(self.url):
+                return time.perf_counter() - start
+        raise ValueError(f"Unsupported session type: {type(proxy.session)}")
+
+    async def probe(self, proxy: ProxySession) -> Optional[float]:
+        """
+        :return: время до первого байта ответа, None если проба не прошла
+        """
+        # Живой клиент на время пробы выдается, как в ConnectionPrewarmer.warm, иначе ClientCache.evict
+        # может закрыть его посреди пробы и здоровая прокси получит провальный замер
+        leased = proxy.session is not None
+        if leased:
+            self.controller.clients.checkout(proxy)
+        try:
+            async with asyncio.timeout(self.timeout):
+                latency = await self._time_to_first_byte(proxy)
+        except Exception as e:
+            logger.debug("Probe failed for %s: %s", proxy.proxy_data.ip, e)
+            latency = None
+        finally:
+            if leased:
+                await self.controller._checkin(proxy)
+        ProxyController.proxy_storage.report_probe(proxy.proxy_data, latency, self.slow_latency)
+        return latency
@@ -1,15 +1,39 @@
 import asyncio
-from typing import Optional
+import struct
+from typing import Optional, Tuple
 
 import aiohttp
 import httpx
 from proxy_manager.connectors_fabric import SessionFactory
-from proxy_manager.types import ProxySession
+from proxy_manager.types import ProxyData, ProxySession
+
+_SOCKS_VERSION = 5
+_SOCKS_AUTH_NONE = 0
+_SOCKS_AUTH_PASSWORD = 2
+_SOCKS_CMD_CONNECT = 1
+_SOCKS_ATYP_IPV4 = 1
+_SOCKS_ATYP_DOMAIN = 3
+_SOCKS_ATYP_IPV6 = 4
+
+
+class Socks5Error(Exception):
+    pass
 
 
 class ProxyChecker:
     @classmethod
-    async def check_session(cls, proxy: ProxySession) -> Optional[ProxySession]:
+    async def check_session(
+            cls,
+            proxy: ProxySession,
+            handshake_target: Optional[Tuple[str, int]] = None,
+    ) -> Optional[ProxySession]:
+        """
+        :param handshake_target: (host, port) - проверить только SOCKS5 рукопожатие и CONNECT к host:port,
+         без TLS и HTTP запроса. None - полный GET https://example.com/ через прокси
+        :return: прокси с рабочим клиентом или None. Клиент пересоздается, только если старый закрыт
+        """
+        if handshake_target is not None:
+            return await cls.check_handshake(proxy, *handshake_target)
         if isinstance(proxy.session, httpx.AsyncClient):
             return await cls.check_httpx_session(proxy)
         elif isinstance(proxy.session, aiohttp.ClientSession):
@@ -17,26 +41,90 @@ class ProxyChecker:
         else:
             raise ValueError(f"Unsupported session type: {type(proxy.session)}")
 
+    @classmethod
+    async def check_handshake(cls, proxy: ProxySession, host: str, port: int) -> Optional[ProxySession]:
+        try:
+            async with asyncio.timeout(15):
+                await cls.socks5_handshake(proxy.proxy_data, host, port)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, Socks5Error):
+            return None
+        cls._ensure_open_session(proxy)
+        return proxy
+
+    @classmethod
+    def _ensure_open_session(cls, proxy: ProxySession):
+        if isinstance(proxy.session, httpx.AsyncClient) and proxy.session.is_closed:
+            proxy.session = SessionFactory.create_httpx_session(proxy.proxy_data)
+        elif isinstance(proxy.session, aiohttp.ClientSession) and proxy.session.closed:
+            proxy.session = SessionFactory.create_aiohttp_session(proxy.proxy_data)
+
+    @classmethod
+    async def socks5_handshake(cls, proxy: ProxyData, host: str, port: int):
+        """
+        Приветствие, авторизация логином и паролем и CONNECT к host:port через SOCKS5 прокси (RFC 1928, 1929).
+        Соединение сразу закрывается
+        :raise Socks5Error: прокси ответила отказом или не по протоколу
+        """
+        reader, writer = await asyncio.open_connection(proxy.ip, proxy.port)
+        try:
+            writer.write(bytes((_SOCKS_VERSION, 2, _SOCKS_AUTH_NONE, _SOCKS_AUTH_PASSWORD)))
+            version, method = await reader.readexactly(2)
+            if version != _SOCKS_VERSION:
+                raise Socks5Error(f"Unexpected SOCKS version {version}")
+            if method == _SOCKS_AUTH_PASSWORD:
+                username, password = proxy.username.encode(), proxy.password.encode()
+                writer.write(bytes((1, len(username))) + username + bytes((len(password),)) + password)
+                _, status = await reader.readexactly(2)
+                if status != 0:
+                    raise Socks5Error("SOCKS authentication failed")
+            elif method != _SOCKS_AUTH_NONE:
+                raise Socks5Error(f"No acceptable SOCKS auth method ({method})")
+
+            address = host.encode()
+            writer.write(
+                bytes((_SOCKS_VERSION, _SOCKS_CMD_CONNECT, 0, _SOCKS_ATYP_DOMAIN, len(address)))
+                + address + struct.pack("!H", port)
+            )
+            _, reply, _, address_type = await reader.readexactly(4)
+            if reply != 0:
+                raise Socks5Error(f"SOCKS CONNECT failed with code {reply}")
+            if address_type == _SOCKS_ATYP_IPV4:
+                await reader.readexactly(4 + 2)
+            elif address_type == _SOCKS_ATYP_IPV6:
+                await reader.readexactly(16 + 2)
+            elif address_type == _SOCKS_ATYP_DOMAIN:
+                (length,) = await reader.readexactly(1)
+                await reader.readexactly(length + 2)
+            else:
+                raise Socks5Error(f"Unknown SOCKS address type {address_type}")
+        finally:
+            writer.close()
+
     @classmethod
     async def check_aiohttp_session(cls, proxy: ProxySession) -> ProxySession | None:
-        session = SessionFactory.create_aiohttp_session(proxy.proxy_data)
+        reuse = not proxy.session.closed
+        session = proxy.session if reuse else SessionFactory.create_aiohttp_session(proxy.proxy_data)
         try:
             async with asyncio.timeout(15):
-                await session.get(url="https://example.com/", timeout=10.0)
+                async with session.get(url="https://example.com/", timeout=10.0):
+                    pass
                 proxy.session = session
                 return proxy
         except:
-            await SessionFactory.close_aiohttp_session(session)
+            if not reuse:
+                await SessionFactory.close_aiohttp_session(session)
             return None
 
     @classmethod
     async def check_httpx_session(cls, proxy: ProxySession) -> ProxySession | None:
-        session = SessionFactory.create_httpx_session(proxy.proxy_data)
+        reuse = not proxy.session.is_closed
+        session = proxy.session if reuse else SessionFactory.create_httpx_session(proxy.proxy_data)
         try:
             async with asyncio.timeout(15):
                 await session.get(url="https://example.com/", timeout=10.0)
                 proxy.session = session
                 return proxy
         except:
-            await SessionFactory.close_httpx_session(session)
+            if not reuse:
+                await SessionFactory.close_httpx_session(session)
             return None
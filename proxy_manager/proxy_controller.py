@@ -1,149 +1,624 @@
 import asyncio
+import heapq
+import itertools
 import logging
-from contextlib import asynccontextmanager
-from enum import Enum
-from typing import Dict
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import aiohttp
 import httpx
 from python_socks._errors import ProxyConnectionError as PySocksProxyConnectionError
 
-from proxy_manager.connectors_fabric import SessionFactory
+from proxy_manager.clients import ClientCache, ClientRegistry
+from proxy_manager.connectors_fabric import HttpClientType
 from proxy_manager.proxy_check import ProxyChecker
 from proxy_manager.queues.custom_queue import ProxyPool
+from proxy_manager.queues.selection import LeastRecentlyUsedPolicy, SelectionPolicy
 from proxy_manager.queues.queue_without_conditions import ProxyQueueWithoutConditions
-from proxy_manager.types import ProxySession
+from proxy_manager.snapshot import IN_BREAKER, IN_CHECK, RETIRED, ProxyState, SnapshotStore
+from proxy_manager.types import (
+    BreakerState,
+    HealthCheckPolicy,
+    HedgePolicy,
+    LatencyWindow,
+    LoadReport,
+    ProxyBatch,
+    ProxyData,
+    ProxySession,
+    RateLimit,
+    SyncReport,
+    TimingMetric,
+    cooldown_key,
+)
 from .proxy_storage import ProxyStorage
 
 logger = logging.getLogger(__name__)
 
+# Ошибки, которые считаются отказом прокси
+PROXY_ERRORS = (
+    httpx.ProxyError,
+    httpx.ConnectError,
+    httpx.ReadTimeout,
+    httpx.RemoteProtocolError,
+    httpx.ProtocolError,
+    asyncio.TimeoutError,
+    aiohttp.ClientProxyConnectionError,
+    aiohttp.ServerTimeoutError,
+    aiohttp.ClientResponseError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientOSError,
+    PySocksProxyConnectionError,
+)
 
-class ProxyError(Exception):
-    pass
 
+# Методы, которые можно безопасно отправить дважды (для хеджа)
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
 
-class HttpClientType(Enum):
-    httpx = 1
-    aiohttp = 2
+
+class ProxyError(Exception):
+    pass
 
 
 class ProxyController:
     proxy_storage = ProxyStorage()
-    proxy_clients = []  # слегка костыльный метод для принудительного закрытия всех коннекторов
+    client_registry = ClientRegistry()  # живые http клиенты всех прокси
 
     @classmethod
     async def close_all_connectors(cls):
-        for client in cls.proxy_clients:
-            if isinstance(client, aiohttp.ClientSession):
-                await SessionFactory.close_aiohttp_session(client)
-
-            if isinstance(client, httpx.AsyncClient):
-                await SessionFactory.close_httpx_session(client)
+        await cls.client_registry.close_all()
 
     @classmethod
-    async def create_with_conditions(cls, http_client: HttpClientType, with_check: bool = True):
-        queue = ProxyPool()
+    async def create_with_conditions(
+            cls,
+            http_client: HttpClientType,
+            with_check: bool = True,
+            policy: Optional[SelectionPolicy] = None,
+            max_concurrency: int = 1,
+            cooldown_ttl: Optional[float] = 3600.0,
+            max_cooldown_keys: Optional[int] = 1000,
+            health_check: Optional[HealthCheckPolicy] = None,
+            max_clients: Optional[int] = None,
+            snapshot_path: Optional[str] = None,
+            snapshot_interval: float = 30.0,
+    ):
+        """
+        :param policy: политика выбора прокси среди готовых, например PowerOfTwoChoicesPolicy(cls.proxy_storage),
+         по умолчанию LRU, пропускающий прокси с низкой оценкой здоровья
+        :param max_concurrency: сколько запросов одна прокси обслуживает одновременно по умолчанию
+        :param cooldown_ttl: через сколько секунд без использования забывается кулдаун по task_key/host
+        :param max_cooldown_keys: максимум ключей кулдауна на прокси
+        :param health_check: параллельность и расписание фоновой проверки выведенных прокси
+        :param max_clients: максимум живых http клиентов, лишние простаивающие закрываются
+        :param snapshot_path: файл снимка состояния: прокси, их статистика и кулдауны восстанавливаются из него
+         при создании и сохраняются в него каждые snapshot_interval секунд
+        """
+        queue = ProxyPool(
+            policy=policy or LeastRecentlyUsedPolicy(cls.proxy_storage),
+            cooldown_ttl=cooldown_ttl,
+            max_cooldown_keys=max_cooldown_keys,
+        )
         await queue.start()
-        return cls(http_client, queue, with_check)
+        controller = cls(
+            http_client,
+            queue,
+            with_check,
+            max_concurrency=max_concurrency,
+            health_check=health_check,
+            max_clients=max_clients,
+        )
+        if snapshot_path is not None:
+            await controller.start_snapshots(snapshot_path, snapshot_interval)
+        return controller
 
     @classmethod
-    async def create_without_conditions(cls, http_client: HttpClientType, with_check: bool = True):
-        queue = ProxyQueueWithoutConditions()
-        return cls(http_client, queue, with_check)
+    async def create_without_conditions(
+            cls,
+            http_client: HttpClientType,
+            with_check: bool = True,
+            health_check: Optional[HealthCheckPolicy] = None,
+            max_clients: Optional[int] = None,
+            snapshot_path: Optional[str] = None,
+            snapshot_interval: float = 30.0,
+            cooldown_ttl: Optional[float] = 3600.0,
+            max_cooldown_keys: Optional[int] = 1000,
+    ):
+        """
+        Кулдаун здесь общий на прокси: time_condition последнего взявшего ее запроса не дает выдать ее
+        и другим задачам. Раздельные кулдауны по task_key - в create_with_conditions
+        :param snapshot_path: файл снимка состояния, как в create_with_conditions
+        :param cooldown_ttl: через сколько секунд без использования забывается task_key/host прокси
+        :param max_cooldown_keys: максимум task_key/host на прокси
+        """
+        queue = ProxyQueueWithoutConditions(cooldown_ttl=cooldown_ttl, max_cooldown_keys=max_cooldown_keys)
+        controller = cls(http_client, queue, with_check, health_check=health_check, max_clients=max_clients)
+        if snapshot_path is not None:
+            await controller.start_snapshots(snapshot_path, snapshot_interval)
+        return controller
 
     def __init__(
             self,
             http_client: HttpClientType,
             queue: ProxyPool | ProxyQueueWithoutConditions,
-            with_check: bool
+            with_check: bool,
+            max_concurrency: int = 1,
+            health_check: Optional[HealthCheckPolicy] = None,
+            max_clients: Optional[int] = None,
     ):
         self.http_client = http_client
         self.queue = queue
+        self.max_concurrency = max_concurrency
+        # клиенты создаются при первой выдаче прокси
+        self.clients = ClientCache(http_client, max_clients, registry=ProxyController.client_registry)
+        self.sessions: Dict[ProxyData, ProxySession] = {}  # все прокси контроллера, одна на ip:port
+        self._draining: Set[ProxySession] = set()  # удаленные прокси, которые еще выданы
+        # прокси с открытым выключателем -> таймер возврата в пул на пробный запрос
+        self._breaker_timers: Dict[ProxySession, asyncio.TimerHandle] = {}
+        # task_key -> задержки последних запросов request, для задержки хеджа
+        self.request_latency: Dict[str, LatencyWindow] = {}
+        self.health_check = health_check or HealthCheckPolicy()
         self.proxy_check_stats = {}  # количество проверок, которые уже прошла прокси
+        # прокси, не прошедшие max_attempts проверок: вернуть их можно manually_check_proxy или add_proxy
+        self._retired: Set[ProxySession] = set()
+        # (time.monotonic() следующей проверки, seq, прокси, номер попытки)
+        self._check_heap: List[Tuple[float, int, ProxySession, int]] = []
+        self._check_seq = itertools.count()
+        self._checking: Set[ProxySession] = set()
+        self._check_tasks: Set[asyncio.Task] = set()
+        self._check_event = asyncio.Event()
         if with_check:
             self.check_proxy_task: asyncio.Task = asyncio.create_task(self.proxy_checker_task())
         self.lock = asyncio.Lock()
+        self.snapshot_store: Optional[SnapshotStore] = None
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._snapshot_lock = asyncio.Lock()  # записи снимка не перекрываются
 
     async def stop_proxy_checker_task(self):
         try:
             self.check_proxy_task.cancel()
         except asyncio.CancelledError:
             pass
+        for task in list(self._check_tasks):
+            task.cancel()
+        for timer in self._breaker_timers.values():
+            timer.cancel()
+        self._breaker_timers.clear()
+
+    def _schedule_check(self, proxy: ProxySession):
+        attempt = self.proxy_check_stats[proxy]
+        due = time.monotonic() + self.health_check.delay(attempt)
+        heapq.heappush(self._check_heap, (due, next(self._check_seq), proxy, attempt))
+        self._check_event.set()
+
+    def _pop_due_checks(self, limit: int) -> List[ProxySession]:
+        """
+        Прокси, которым пора на проверку, не больше limit. Записи о прокси, которые уже вернулись в пул,
+        проверяются прямо сейчас или перепланированы, отбрасываются
+        """
+        now = time.monotonic()
+        due = []
+        while self._check_heap and len(due) < limit and self._check_heap[0][0] <= now:
+            _, _, proxy, attempt = heapq.heappop(self._check_heap)
+            if self.proxy_check_stats.get(proxy) != attempt or proxy in self._checking:
+                continue
+            due.append(proxy)
+        return due
 
     async def proxy_checker_task(self):
+        """
+        Проверяет выведенные прокси по расписанию из кучи, не больше health_check.concurrency одновременно.
+        Просыпается по сроку ближайшей проверки, новой прокси на проверку или окончанию проверки
+        """
         while True:
-            await asyncio.sleep(1000)
-
-            # Первая блокировка: составление списка для проверки
-            proxies_to_check = []
+            self._check_event.clear()
             async with self.lock:
-                for proxy, check_count in list(self.proxy_check_stats.items()):
-                    if check_count <= 3:
-                        proxies_to_check.append(proxy)
-            # Проверка прокси БЕЗ блокировки (сетевые операции)
-            checked_proxies = []
-            for proxy in proxies_to_check:
-                try:
-                    new_proxy_session = await ProxyChecker.check_session(proxy)
-                    checked_proxies.append((proxy, new_proxy_session))
-                except Exception as e:
-                    logger.debug(f"Proxy check failed for {proxy.proxy_data.ip}: {e}")
-                    checked_proxies.append((proxy, None))
+                due = self._pop_due_checks(self.health_check.concurrency - len(self._checking))
+                for proxy in due:
+                    self._checking.add(proxy)
+                    task = asyncio.create_task(self._check_proxy(proxy))
+                    self._check_tasks.add(task)
+                    task.add_done_callback(self._check_tasks.discard)
+
+            timeout = None
+            if self._check_heap and len(self._checking) < self.health_check.concurrency:
+                timeout = max(self._check_heap[0][0] - time.monotonic(), 0.0)
+            try:
+                await asyncio.wait_for(self._check_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check_proxy(self, proxy: ProxySession):
+        try:
+            # Проверка без блокировки (сетевые операции)
+            # Полной проверке нужен клиент, после проверки он закрывается по общим правилам
+            with_client = self.health_check.handshake_target is None
+            if with_client:
+                self.clients.checkout(proxy)
+            try:
+                new_proxy_session = await ProxyChecker.check_session(
+                    proxy, handshake_target=self.health_check.handshake_target
+                )
+            except Exception as e:
+                logger.debug(f"Proxy check failed for {proxy.proxy_data.ip}: {e}")
+                new_proxy_session = None
+            finally:
+                # ProxyChecker мог заменить клиент - старый закрывается
+                await ProxyController.client_registry.sync(proxy)
+                if with_client:
+                    await self._checkin(proxy)
 
-            # Вторая блокировка: обновление состояния
             async with self.lock:
-                for proxy, new_proxy_session in checked_proxies:
-                    if proxy not in self.proxy_check_stats:
-                        continue  # Прокси мог быть удален параллельно
-
-                    if new_proxy_session is not None:
-                        # Успешная проверка - возвращаем в очередь
-                        await self.queue.add(new_proxy_session)
-                        self.proxy_check_stats.pop(proxy)
-                        ProxyController.proxy_storage.update_proxy_status(proxy.proxy_data)
-                    else:
-                        # Неудачная проверка - увеличиваем счетчик
-                        self.proxy_check_stats[proxy] += 1
+                if proxy not in self.proxy_check_stats:
+                    return  # Прокси мог быть удален или проверен вручную параллельно
+
+                if new_proxy_session is not None:
+                    # Успешная проверка - возвращаем в очередь
+                    await self.queue.add(new_proxy_session)
+                    self.proxy_check_stats.pop(proxy)
+                    ProxyController.proxy_storage.update_proxy_status(proxy.proxy_data)
+                    return
+
+                self.proxy_check_stats[proxy] += 1
+                if self.proxy_check_stats[proxy] >= self.health_check.max_attempts:
+                    logger.warning(
+                        "Proxy %s failed %d checks, giving up", proxy.proxy_data.ip, self.proxy_check_stats[proxy]
+                    )
+                    self.proxy_check_stats.pop(proxy)
+                    self._retired.add(proxy)
+                else:
+                    self._schedule_check(proxy)
+        finally:
+            self._checking.discard(proxy)
+            self._check_event.set()
 
     async def manually_check_proxy(self, proxy: str):
+        """
+        Проверяет прокси на проверке или уже выведенную после max_attempts проверок
+        :return: True - прокси вернулась в пул, False - проверка не прошла, None - такой прокси нет в проверке
+        """
         try:
             proxy_to_check = ProxyController.proxy_storage.get_proxy_by_str(proxy)
             async with self.lock:
-                for proxy in list(self.proxy_check_stats):
-                    if proxy_to_check == proxy.proxy_data:
-                        new_proxy_session = await ProxyChecker.check_session(proxy)
-                        if new_proxy_session is not None:
-                            await self.queue.add(new_proxy_session)
-                            self.proxy_check_stats.pop(proxy)
-                            ProxyController.proxy_storage.update_proxy_status(new_proxy_session.proxy_data)
-                            return True
-                        else:
-                            self.proxy_check_stats[proxy] += 1
-                            return False
+                proxy = self.sessions.get(proxy_to_check)
+                if proxy is None or (proxy not in self.proxy_check_stats and proxy not in self._retired):
+                    return None
+                with_client = self.health_check.handshake_target is None
+                if with_client:
+                    self.clients.checkout(proxy)
+                try:
+                    new_proxy_session = await ProxyChecker.check_session(
+                        proxy, handshake_target=self.health_check.handshake_target
+                    )
+                finally:
+                    await ProxyController.client_registry.sync(proxy)
+                    if with_client:
+                        await self._checkin(proxy)
+                if new_proxy_session is not None:
+                    await self.queue.add(new_proxy_session)
+                    self.proxy_check_stats.pop(proxy, None)
+                    self._retired.discard(proxy)
+                    ProxyController.proxy_storage.update_proxy_status(new_proxy_session.proxy_data)
+                    return True
+                if proxy in self.proxy_check_stats:
+                    self.proxy_check_stats[proxy] += 1
+                    self._schedule_check(proxy)
+                return False  # выведенная прокси остается выведенной
         except ValueError:
             pass
 
-    async def add_proxy(self, proxy: str, conditions: Dict = None):
-        proxy_object = ProxyController.proxy_storage.add_proxy_str(proxy=proxy, other_conditions=conditions)
-        if self.http_client == HttpClientType.httpx:
-            connector = SessionFactory.create_httpx_session(proxy_object)
-            ProxyController.proxy_clients.append(connector)
-            session = ProxySession(proxy_data=proxy_object, session=connector)
+    async def add_proxy(self, proxy: str, conditions: Dict = None, max_concurrency: Optional[int] = None):
+        """
+        Прокси с уже известной ip:port второй раз не добавляется: ее условия и логин обновляются на месте
+        :param max_concurrency: сколько запросов прокси обслуживает одновременно,
+         None - значение контроллера. Для очереди без условий всегда 1
+        """
+        proxy_object = ProxyController.proxy_storage.parse_proxy_str(proxy, conditions)
+        existing = self.sessions.get(proxy_object)
+        if existing is not None:
+            await self._update_proxy(existing, proxy_object)
+            return
+        ProxyController.proxy_storage.register_proxy(proxy_object)
+        await self.queue.add(self._new_session(proxy_object, max_concurrency))
+
+    def _new_session(self, proxy_object: ProxyData, max_concurrency: Optional[int]) -> ProxySession:
+        # Клиент создается при первой выдаче, см. ClientCache. Кулдаунов у новой прокси нет - чистить нечего
+        session = ProxySession(proxy_data=proxy_object, session=None, pruned_at=time.monotonic())
+        if isinstance(self.queue, ProxyPool):
+            session.max_concurrency = max_concurrency or self.max_concurrency
+        self.sessions[proxy_object] = session
+        return session
+
+    async def _update_proxy(self, proxy: ProxySession, proxy_object: ProxyData) -> bool:
+        """
+        Переносит в прокси условия и логин из proxy_object той же ip:port
+        Выведенная после max_attempts проверок прокси снова отправляется на проверку
+        :return: True если что-то изменилось
+        """
+        changed = False
+        if proxy in self._retired:
+            self._retired.discard(proxy)
+            self.send_proxy_to_check(proxy)
+            changed = True
+        data = proxy.proxy_data
+        if (data.username, data.password) != (proxy_object.username, proxy_object.password):
+            self.proxy_storage.update_credentials(data, proxy_object.username, proxy_object.password)
+            # Клиент собран со старым логином
+            await self.clients.invalidate(proxy)
+            changed = True
+        if data.other_conditions != proxy_object.other_conditions:
+            await self.queue.update_conditions(proxy, proxy_object.other_conditions)
+            changed = True
+        return changed
+
+    async def remove_proxy(self, proxy: str) -> bool:
+        """
+        Выводит прокси из ротации насовсем. Выданная прокси дорабатывает текущие запросы,
+        после последнего возврата ее клиент закрывается, а статистика удаляется
+        :param proxy: строка ip:port:user:password, для поиска важны только ip и port
+        :return: False если такой прокси нет
+        """
+        proxy_object = ProxyController.proxy_storage.parse_proxy_str(proxy)
+        session = self.sessions.get(proxy_object)
+        if session is None:
+            return False
+        await self._remove_session(session)
+        return True
+
+    async def _remove_session(self, proxy: ProxySession):
+        del self.sessions[proxy.proxy_data]
+        self.proxy_check_stats.pop(proxy, None)  # фоновая проверка ее больше не вернет
+        self._retired.discard(proxy)
+        timer = self._breaker_timers.pop(proxy, None)
+        if timer is not None:
+            timer.cancel()
+        await self.queue.remove(proxy)
+        if self._is_leased(proxy):
+            self._draining.add(proxy)
+        else:
+            await self._finish_removal(proxy)
+
+    def _is_leased(self, proxy: ProxySession) -> bool:
+        return self.clients.leased(proxy) or proxy.in_flight > 0
+
+    async def _finish_removal(self, proxy: ProxySession):
+        self._draining.discard(proxy)
+        await self.clients.close(proxy)
+        if proxy.proxy_data not in self.sessions:  # ее могли добавить заново, пока она была выдана
+            ProxyController.proxy_storage.remove_proxy(proxy.proxy_data)
+
+    async def _checkin(self, proxy: ProxySession):
+        await self.clients.checkin(proxy)
+        if proxy in self._draining and not self._is_leased(proxy):
+            await self._finish_removal(proxy)
+
+    @staticmethod
+    @contextmanager
+    def _source_lines(source: Union[Iterable[str], str, os.PathLike]) -> Iterator[Iterable[str]]:
+        if isinstance(source, (str, os.PathLike)):
+            with open(source) as lines:
+                yield lines
         else:
-            connector = SessionFactory.create_aiohttp_session(proxy_object)
-            ProxyController.proxy_clients.append(connector)
-            session = ProxySession(proxy_data=proxy_object, session=connector)
+            yield source
 
-        await self.queue.add(session)
+    @staticmethod
+    def _parse_lines(
+            lines: Iterable[str],
+            conditions_fn: Optional[Callable[[str], Optional[Dict[str, str]]]],
+            report: LoadReport,
+    ) -> Iterator[ProxyData]:
+        """Прокси из строк источника. Пустые строки и строки с # пропускаются, ошибки пишутся в report"""
+        for line_no, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                conditions = conditions_fn(line) if conditions_fn is not None else None
+                yield ProxyController.proxy_storage.parse_proxy_str(line, conditions)
+            except ValueError as e:
+                report.rejected.append((line_no, line, str(e)))
+
+    async def add_proxies(
+            self,
+            source: Union[Iterable[str], str, os.PathLike],
+            conditions_fn: Optional[Callable[[str], Optional[Dict[str, str]]]] = None,
+            max_concurrency: Optional[int] = None,
+            batch_size: int = 1000,
+    ) -> LoadReport:
+        """
+        Потоковая загрузка прокси: строки читаются по одной, в пул попадают пачками по batch_size
+        за одно взятие блокировки. Пустые строки и строки с # пропускаются.
+        Уже добавленные ip:port не дублируются, а обновляются как в add_proxy
+        :param source: строки ip:port:user:password или путь к файлу с ними
+        :param conditions_fn: условия для прокси по ее строке
+        :return: сколько добавлено и какие строки отклонены
+        """
+        report = LoadReport()
+        with self._source_lines(source) as lines:
+            await self._load(self._parse_lines(lines, conditions_fn, report), max_concurrency, batch_size, report)
+        return report
+
+    async def sync_proxies(
+            self,
+            source: Union[Iterable[str], str, os.PathLike],
+            conditions_fn: Optional[Callable[[str], Optional[Dict[str, str]]]] = None,
+            max_concurrency: Optional[int] = None,
+            batch_size: int = 1000,
+    ) -> SyncReport:
+        """
+        Приводит прокси контроллера к новому списку: добавляются только новые ip:port, пропавшие удаляются
+        как в remove_proxy, у оставшихся на месте обновляются условия и логин, их статистика и клиенты
+        сохраняются. Параметры как у add_proxies
+        :return: сколько добавлено, удалено и обновлено, какие строки отклонены
+        """
+        report = SyncReport()
+        with self._source_lines(source) as lines:
+            wanted = {proxy_object: proxy_object for proxy_object in self._parse_lines(lines, conditions_fn, report)}
+        for proxy_data, proxy in list(self.sessions.items()):
+            if proxy_data not in wanted:
+                await self._remove_session(proxy)
+                report.removed += 1
+        await self._load(wanted.values(), max_concurrency, batch_size, report)
+        return report
+
+    async def _load(
+            self,
+            proxy_objects: Iterable[ProxyData],
+            max_concurrency: Optional[int],
+            batch_size: int,
+            report: LoadReport,
+    ):
+        batch = []
+        for proxy_object in proxy_objects:
+            existing = self.sessions.get(proxy_object)
+            if existing is not None:
+                if await self._update_proxy(existing, proxy_object) and isinstance(report, SyncReport):
+                    report.updated += 1
+                continue
+            ProxyController.proxy_storage.register_proxy(proxy_object)
+            batch.append(self._new_session(proxy_object, max_concurrency))
+            if len(batch) >= batch_size:
+                await self.queue.add_many(batch)
+                report.added += len(batch)
+                batch = []
+                await asyncio.sleep(0)  # не держим цикл событий на всю загрузку
+        if batch:
+            await self.queue.add_many(batch)
+            report.added += len(batch)
 
     async def close_proxy_client(self, proxy: ProxySession):
-        if self.http_client == HttpClientType.httpx:
-            await SessionFactory.close_httpx_session(proxy=proxy.session)
-        if self.http_client == HttpClientType.aiohttp:
-            await SessionFactory.close_aiohttp_session(proxy=proxy.session)
+        await self.clients.close(proxy)
 
     def send_proxy_to_check(self, proxy: ProxySession):
+        if proxy in self._draining:
+            return  # удаленная прокси на проверку не идет
         self.proxy_check_stats[proxy] = 0
+        self._schedule_check(proxy)
+
+    async def start_snapshots(self, path: str, interval: float = 30.0) -> int:
+        """
+        Восстанавливает прокси из снимка path (если он есть) и запускает его периодическое сохранение
+        :return: сколько прокси восстановлено
+        """
+        self.snapshot_store = SnapshotStore(path)
+        # SQLite читается в отдельном потоке, строки разбираются по ходу восстановления
+        rows = await asyncio.to_thread(self.snapshot_store.read_rows)
+        restored = await self.restore_state(SnapshotStore.states(rows))
+        if self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self._snapshot_loop(interval))
+        return restored
+
+    async def stop_snapshots(self, save: bool = True):
+        """Останавливает периодическое сохранение, save - записать последний снимок"""
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            await asyncio.gather(self._snapshot_task, return_exceptions=True)
+            self._snapshot_task = None
+        if save and self.snapshot_store is not None:
+            await self.save_snapshot()
+
+    async def _snapshot_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save_snapshot()
+            except Exception as e:
+                logger.error("Snapshot save failed: %s", e)
+
+    async def save_snapshot(self):
+        """Собирает состояние в цикле событий по частям, пишет в файл в отдельном потоке"""
+        async with self._snapshot_lock:
+            states = await self.snapshot_state()
+            await asyncio.to_thread(self.snapshot_store.write, states)
+
+    async def snapshot_state(self, batch_size: int = 5000) -> List[ProxyState]:
+        """
+        Состояние прокси контроллера для снимка. Между пачками по batch_size управление отдается циклу событий,
+        так что каждая прокси согласована сама с собой, но не обязательно с остальными
+        """
+        storage = ProxyController.proxy_storage
+        cooling = self.queue.cooldowns() if isinstance(self.queue, ProxyQueueWithoutConditions) else {}
+        wall_offset = time.time() - time.monotonic()
+        states = []
+        for i, proxy in enumerate(list(self.sessions.values()), 1):
+            if proxy in self._draining:
+                continue
+            proxy_data = proxy.proxy_data
+            state = ProxyState(
+                proxy=proxy_data.as_str(),
+                conditions=dict(proxy_data.other_conditions),
+                max_concurrency=proxy.max_concurrency,
+                used_time=dict(proxy.used_time),
+            )
+            exported = storage.export_stats(proxy_data)
+            if exported is not None:
+                state.counters, state.task_totals = exported
+            if proxy in self.proxy_check_stats:
+                state.status, state.check_attempt = IN_CHECK, self.proxy_check_stats[proxy]
+            elif proxy in self._breaker_timers:
+                state.status = IN_BREAKER
+                state.breaker_retry_at = time.time() + storage.breaker_retry_in(proxy_data)
+                state.breaker_trips = storage.breaker_trips(proxy_data)
+            elif not proxy.in_rotation:
+                state.status = RETIRED
+            if proxy in cooling:
+                state.cooling_until = cooling[proxy] + wall_offset
+            states.append(state)
+            if i % batch_size == 0:
+                await asyncio.sleep(0)
+        return states
+
+    async def restore_state(self, states: Iterable[ProxyState], batch_size: int = 1000) -> int:
+        """
+        Добавляет прокси из снимка с их статистикой, кулдаунами и местом: в пул, на фоновую проверку,
+        под открытый выключатель или списанными. Уже добавленные ip:port пропускаются
+        :return: сколько прокси восстановлено
+        """
+        storage = ProxyController.proxy_storage
+        monotonic_offset = time.monotonic() - time.time()
+        keeps_cooling = isinstance(self.queue, ProxyQueueWithoutConditions)
+        restored = 0
+        batch = []
+        for i, state in enumerate(states, 1):
+            if i % batch_size == 0:
+                if batch:
+                    await self.queue.add_many(batch)
+                    batch = []
+                await asyncio.sleep(0)  # не держим цикл событий на все восстановление
+            try:
+                proxy_object = storage.parse_proxy_str(state.proxy, state.conditions)
+            except ValueError:
+                continue
+            if proxy_object in self.sessions:
+                continue
+            if state.counters is None:
+                storage.register_proxy(proxy_object)
+            else:
+                storage.restore_stats(proxy_object, state.counters, state.task_totals)
+            proxy = self._new_session(proxy_object, state.max_concurrency)
+            if state.used_time:
+                proxy.used_time = state.used_time
+                proxy.used_monotonic = {task_key: used + monotonic_offset for task_key, used in state.used_time.items()}
+            restored += 1
+            if state.status == IN_CHECK:
+                proxy.in_rotation = False
+                self.proxy_check_stats[proxy] = state.check_attempt or 0
+                self._schedule_check(proxy)
+            elif state.status == IN_BREAKER and storage.breaker is not None:
+                proxy.in_rotation = False
+                retry_in = max(state.breaker_retry_at + monotonic_offset - time.monotonic(), 0.0)
+                storage.restore_breaker(proxy_object, retry_in, state.breaker_trips)
+                self._schedule_half_open(proxy)
+            elif state.status == RETIRED:
+                proxy.in_rotation = False
+                self._retired.add(proxy)
+            elif state.cooling_until is not None and keeps_cooling:
+                await self.queue.add_cooling(proxy, state.cooling_until + monotonic_offset)
+            else:
+                batch.append(proxy)
+        if batch:
+            await self.queue.add_many(batch)
+        return restored
 
     @asynccontextmanager
     async def acquire(
@@ -152,52 +627,336 @@ class ProxyController:
             time_condition: float = 5.0,
             timeout: float | None = 100.0,
             other_conditions=None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            host: Optional[str] = None,
+            exclude: Optional[Set[ProxySession]] = None,
     ):
         """
         :param task_key: название задачи для которой нужна прокси
         :param time_condition:  требование по времени до скольких то секунд
         :param timeout: таймаут на поиск None будет искать бесконечно
         :param other_conditions: словарь с остальными требованиями
+        :param priority: приоритет ожидания, меньше - важнее (ждущие долго постепенно поднимаются)
+        :param rate_limit: RateLimit(rate, burst) на каждую прокси для task_key, заменяет time_condition
+        :param host: сайт назначения - кулдаун считается отдельно для task_key и host,
+         статистика пишется по task_key
+        :param exclude: прокси, которые не выдавать
         :return:
         """
         if other_conditions is None:
             other_conditions = {}
+        key = cooldown_key(task_key, host)
+        wait_started = time.monotonic()
         try:
             proxy = await self.queue.get(
-                task_key=task_key,
+                task_key=key,
                 last_used=time_condition,
                 timeout=timeout,
                 other_conditions=other_conditions,
+                priority=priority,
+                rate_limit=rate_limit,
+                exclude=exclude,
             )
         except asyncio.TimeoutError:
             raise
+        self.clients.checkout(proxy)
+        started = time.monotonic()
+        ProxyController.proxy_storage.observe_timing(
+            proxy.proxy_data, task_key, TimingMetric.wait, started - wait_started
+        )
         try:
             async with asyncio.timeout(20):
                 yield proxy
-            await self.queue.release(proxy=proxy, task_key=task_key)
-            ProxyController.proxy_storage.report_status(proxy=proxy.proxy_data, task_key=task_key, request_status=True)
-        except (
-                httpx.ProxyError,
-                httpx.ConnectError,
-                httpx.ReadTimeout,
-                httpx.RemoteProtocolError,
-                httpx.ProtocolError,
-                asyncio.TimeoutError,
-                aiohttp.ClientProxyConnectionError,
-                aiohttp.ServerTimeoutError,
-                aiohttp.ClientResponseError,
-                aiohttp.ClientConnectionError,
-                aiohttp.ClientOSError,
-                asyncio.TimeoutError,
-                PySocksProxyConnectionError,
-        ) as e:
+        except PROXY_ERRORS as e:
+            await self.return_proxy(proxy, task_key=task_key, request_status=False, host=host)
+            logger.debug("request if failed: %s", e)
+            raise ProxyError("Proxy is bad")
+        except BaseException:
+            # Ошибка не прокси (или отмена снаружи) - слот освобождается, статистику не трогаем
+            await self.return_proxy(proxy, task_key=task_key, request_status=None, host=host)
+            raise
+        # Вне try: отмена во время возврата не должна вернуть прокси в очередь второй раз
+        await self.return_proxy(
+            proxy, task_key=task_key, request_status=True, latency=time.monotonic() - started, host=host
+        )
+
+    async def request(
+            self,
+            method: str,
+            url: str,
+            retries: int = 2,
+            deadline: Optional[float] = 60.0,
+            task_key: str = "default",
+            time_condition: float = 5.0,
+            other_conditions=None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            host: Optional[str] = None,
+            hedge: Optional[HedgePolicy] = None,
+            **kwargs,
+    ) -> Union[httpx.Response, aiohttp.ClientResponse]:
+        """
+        Запрос через прокси из пула. При отказе прокси повторяется через другую, уже отказавшие
+        в этом вызове прокси не выдаются. Время и результат каждой попытки пишутся в статистику, как в acquire
+        :param retries: сколько раз повторить после отказа прокси
+        :param deadline: общий предел в секундах на ожидание прокси и все попытки, None - без предела
+        :param hedge: хеджирование медленных ответов второй прокси, только для идемпотентных методов
+        :param kwargs: параметры запроса http клиента (params, json, headers, ...)
+        :return: ответ http клиента с уже прочитанным телом
+        :raise ProxyError: отказали все попытки
+        :raise TimeoutError: истек deadline
+        """
+        if hedge is not None and method.upper() not in IDEMPOTENT_METHODS:
+            raise ValueError(f"Hedging is only allowed for idempotent methods, got {method}")
+        options = dict(
+            task_key=task_key,
+            time_condition=time_condition,
+            other_conditions=other_conditions,
+            priority=priority,
+            rate_limit=rate_limit,
+            host=host,
+        )
+        failed: Set[ProxySession] = set()
+        deadline_at = None if deadline is None else time.monotonic() + deadline
+        last_error = None
+        for _ in range(retries + 1):
+            remaining = None if deadline_at is None else deadline_at - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"Request deadline ({deadline}s) exceeded")
+            options["timeout"] = remaining
+            try:
+                async with asyncio.timeout(remaining):
+                    if hedge is None:
+                        _, response = await self._attempt(method, url, kwargs, options, set(failed), failed, {})
+                    else:
+                        response = await self._hedged_attempt(method, url, kwargs, options, failed, hedge)
+                    return response
+            except ProxyError as e:
+                last_error = e
+        raise ProxyError(f"Request failed on {len(failed)} proxies") from last_error
+
+    async def _attempt(
+            self,
+            method: str,
+            url: str,
+            kwargs: dict,
+            options: dict,
+            exclude: Set[ProxySession],
+            failed: Set[ProxySession],
+            started: Dict[ProxySession, float],
+    ) -> Tuple[ProxySession, Union[httpx.Response, aiohttp.ClientResponse]]:
+        """
+        Одна попытка request через acquire
+        :param failed: сюда добавляется прокси, если она отказала
+        :param started: прокси, запрос через которую идет прямо сейчас -> момент ее выдачи
+        """
+        proxy = None
+        try:
+            async with self.acquire(exclude=exclude, **options) as proxy:
+                started[proxy] = time.monotonic()
+                response = await self._send(proxy, method, url, kwargs)
+                ProxyController.proxy_storage.observe_timing(
+                    proxy.proxy_data, options["task_key"], TimingMetric.request, time.monotonic() - started[proxy]
+                )
+        except ProxyError:
+            started.pop(proxy, None)
+            failed.add(proxy)
+            raise
+        window = self.request_latency.get(options["task_key"])
+        if window is None:
+            window = self.request_latency[options["task_key"]] = LatencyWindow()
+        window.observe(time.monotonic() - started.pop(proxy))
+        return proxy, response
+
+    async def _hedged_attempt(
+            self,
+            method: str,
+            url: str,
+            kwargs: dict,
+            options: dict,
+            failed: Set[ProxySession],
+            hedge: HedgePolicy,
+    ) -> Union[httpx.Response, aiohttp.ClientResponse]:
+        """
+        Попытка с хеджем: если первая прокси не ответила за задержку хеджа, запрос параллельно уходит через
+        вторую. Первый ответ побеждает, запрос проигравшей отменяется, ее слот освобождается в acquire
+        """
+        started: Dict[ProxySession, float] = {}
+        pending = {asyncio.create_task(self._attempt(method, url, kwargs, options, set(failed), failed, started))}
+        try:
+            done, pending = await asyncio.wait(
+                pending, timeout=hedge.hedge_delay(self.request_latency.get(options["task_key"]))
+            )
+            if not done:
+                # Первая прокси еще работает - вторая выбирается из остальных
+                pending.add(asyncio.create_task(
+                    self._attempt(method, url, kwargs, options, failed | set(started), failed, started)
+                ))
+            error = None
+            while True:
+                for task in done:
+                    try:
+                        _, response = task.result()
+                        return response
+                    except ProxyError as e:
+                        error = e
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            # В started остались прокси, чьи запросы отменены не дождавшись ответа
+            now = time.monotonic()
+            for proxy, at in started.items():
+                ProxyController.proxy_storage.report_hedge_loss(proxy.proxy_data, now - at)
+
+    @staticmethod
+    async def _send(
+            proxy: ProxySession, method: str, url: str, kwargs: dict
+    ) -> Union[httpx.Response, aiohttp.ClientResponse]:
+        if isinstance(proxy.session, httpx.AsyncClient):
+            return await proxy.session.request(method, url, **kwargs)
+        async with proxy.session.request(method, url, **kwargs) as response:
+            await response.read()  # тело нужно прочитать, пока соединение не вернулось в пул клиента
+            return response
+
+    async def return_proxy(
+            self,
+            proxy: ProxySession,
+            task_key: str,
+            request_status: Optional[bool],
+            latency: Optional[float] = None,
+            host: Optional[str] = None,
+    ):
+        """
+        Возвращает выданную прокси в очередь и пишет результат в статистику
+        :param request_status: true - work false - not work, None - результат неизвестен, статистику не трогаем
+        :param latency: сколько прокси была в работе, для статистики задержек
+        :param host: тот же host, что и при выдаче
+        """
+        key = cooldown_key(task_key, host)
+        if request_status is None:
+            await self.queue.release(proxy=proxy, task_key=key)
+        elif request_status:
+            proxy.trial = False  # пробный запрос прошел - снова все слоты
+            await self.queue.release(proxy=proxy, task_key=key)
+            ProxyController.proxy_storage.report_status(
+                proxy=proxy.proxy_data, task_key=task_key, request_status=True, latency=latency
+            )
+        else:
             ProxyController.proxy_storage.report_status(proxy=proxy.proxy_data, request_status=False, task_key=task_key)
-            if not ProxyController.proxy_storage.proxy_is_valid(proxy.proxy_data):
-                await self.close_proxy_client(proxy)
-                self.send_proxy_to_check(proxy)
-            else:
-                await self.queue.release(proxy=proxy, task_key=task_key)
-            logger.debug("request if failed: ", e)
+            await self._retire_if_invalid(proxy)
+            # Выведенная из ротации прокси в пул не вернется, release только освобождает слот
+            await self.queue.release(proxy=proxy, task_key=key)
+        await self._checkin(proxy)
+
+    async def _retire_if_invalid(self, proxy: ProxySession) -> bool:
+        """
+        Выводит прокси из ротации, если она набрала слишком много ошибок подряд (тогда она уходит на фоновую
+        проверку) или у нее открылся выключатель (тогда она вернется в пул на пробный запрос по таймеру).
+        Клиент не закрывается: после проверки он переиспользуется, если транспорт жив
+        :return: True если прокси выведена из ротации
+        """
+        storage = ProxyController.proxy_storage
+        if not storage.proxy_is_valid(proxy.proxy_data):
+            await self.queue.remove(proxy)
+            proxy.trial = False
+            self.send_proxy_to_check(proxy)
+            return True
+        if storage.get_breaker_state(proxy.proxy_data) is BreakerState.open:
+            await self.queue.remove(proxy)
+            self._schedule_half_open(proxy)
+            return True
+        return False
+
+    def _schedule_half_open(self, proxy: ProxySession):
+        timer = self._breaker_timers.pop(proxy, None)
+        if timer is not None:
+            timer.cancel()
+        delay = ProxyController.proxy_storage.breaker_retry_in(proxy.proxy_data)
+        self._breaker_timers[proxy] = asyncio.get_running_loop().call_later(delay, self._on_half_open, proxy)
+
+    def _on_half_open(self, proxy: ProxySession):
+        self._breaker_timers.pop(proxy, None)
+        task = asyncio.create_task(self._readmit_trial(proxy))
+        self._check_tasks.add(task)
+        task.add_done_callback(self._check_tasks.discard)
+
+    async def _readmit_trial(self, proxy: ProxySession):
+        if self.sessions.get(proxy.proxy_data) is not proxy or proxy in self.proxy_check_stats:
+            return  # прокси удалена или ее ведет фоновая проверка
+        proxy.trial = True
+        await self.queue.add(proxy)
+
+    @asynccontextmanager
+    async def acquire_many(
+            self,
+            n: int,
+            task_key: str = "default",
+            time_condition: float = 5.0,
+            other_conditions=None,
+            min_count: int = 1,
+            timeout: float | None = 100.0,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            host: Optional[str] = None,
+    ):
+        """
+        Берет до n разных прокси одним вызовом и возвращает их все вместе
+        :param n: сколько прокси нужно
+        :param min_count: минимум, без которого ждем до timeout
+        :param host: сайт назначения, как в acquire
+        :return: ProxyBatch, неработающие прокси внутри блока помечаются batch.mark_failed(proxy)
+        """
+        if other_conditions is None:
+            other_conditions = {}
+        wait_started = time.monotonic()
+        proxies = await self.queue.get_many(
+            n,
+            task_key=cooldown_key(task_key, host),
+            last_used=time_condition,
+            other_conditions=other_conditions,
+            timeout=timeout,
+            min_count=min_count,
+            priority=priority,
+            rate_limit=rate_limit,
+        )
+        waited = time.monotonic() - wait_started
+        for proxy in proxies:
+            self.clients.checkout(proxy)
+            ProxyController.proxy_storage.observe_timing(proxy.proxy_data, task_key, TimingMetric.wait, waited)
+        batch = ProxyBatch(proxies=proxies)
+        try:
+            async with asyncio.timeout(20):
+                yield batch
+        except PROXY_ERRORS as e:
+            # Ошибку нельзя привязать к конкретной прокси - статистику непомеченных не трогаем
+            await self._finish_batch(batch, task_key, host, report_ok=False)
+            logger.debug("batch request failed: %s", e)
             raise ProxyError("Proxy is bad")
-        except Exception:
+        except BaseException:
+            await self._finish_batch(batch, task_key, host, report_ok=False)
             raise
+        await self._finish_batch(batch, task_key, host, report_ok=True)
+
+    async def _finish_batch(self, batch: ProxyBatch, task_key: str, host: Optional[str], report_ok: bool):
+        results = [(proxy.proxy_data, False) for proxy in batch.failed]
+        to_release: List[ProxySession] = []
+        for proxy in batch.proxies:
+            if proxy in batch.failed:
+                continue
+            to_release.append(proxy)
+            if report_ok:
+                proxy.trial = False
+                results.append((proxy.proxy_data, True))
+        ProxyController.proxy_storage.report_statuses(results, task_key=task_key)
+
+        for proxy in batch.failed:
+            await self._retire_if_invalid(proxy)
+            to_release.append(proxy)
+        await self.queue.release_many(to_release, task_key=cooldown_key(task_key, host))
+        for proxy in to_release:
+            await self._checkin(proxy)
@@ -1,13 +1,251 @@
-from typing import Dict
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
-from proxy_manager.types import ProxyData
+from proxy_manager.types import (
+    BreakerState,
+    CircuitBreaker,
+    CircuitBreakerPolicy,
+    ProxyData,
+    StatsWindowPolicy,
+    TimingMetric,
+    WindowStats,
+    histogram_bucket,
+)
 
 MAX_ERROR_COUNT = 50
+LATENCY_EWMA_ALPHA = 0.2  # вес нового замера в скользящей средней задержке
+PROBE_SCORE_ALPHA = 0.3  # вес нового замера в оценке здоровья по фоновым пробам
 
+_SUCCESS_SUFFIX = "_success_request"
+_ERROR_SUFFIX = "_error_request"
+_ZERO_COUNT = array("L", [0])  # заготовка для task_counts нужной длины: _ZERO_COUNT * n
+
+
+class TaskIds:
+    """Общая для всех прокси нумерация task_key: счетчики задач лежат в массивах по этим номерам"""
 
-class ProxyStorage:
     def __init__(self):
-        self.proxy_dict: Dict[ProxyData, dict] = {}
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+
+    def intern(self, task_key: str) -> int:
+        task_id = self.ids.get(task_key)
+        if task_id is None:
+            task_id = self.ids[task_key] = len(self.names)
+            self.names.append(task_key)
+        return task_id
+
+
+def _span_add(span: Optional[array], bucket: int) -> array:
+    """
+    Гистограмма в виде отрезка: [0] - номер первой корзины, дальше счетчики корзин подряд. Отрезок растет
+    только до наблюдавшихся корзин, а задержки одной прокси обычно укладываются в несколько соседних
+    """
+    if span is None:
+        return array("I", (bucket, 1))
+    first = span[0]
+    if bucket < first:
+        grown = array("I", (bucket, 1))
+        grown.extend([0] * (first - bucket - 1))
+        grown.extend(span[1:])
+        return grown
+    index = bucket - first + 1
+    if index >= len(span):
+        span.extend([0] * (index - len(span) + 1))
+    span[index] += 1
+    return span
+
+
+class RollingStats:
+    """
+    Скользящее окно одной прокси по одной задаче, см. StatsWindowPolicy. Успехи и ошибки всех частей окна -
+    один array, гистограммы заводятся только для метрик, которые наблюдались в этой части окна, и хранятся
+    отрезками от первой до последней занятой корзины. Устаревшая часть окна освобождает свои гистограммы.
+    Память на пару (прокси, задача) при 5 частях: ~0.35 KB без замеров задержек, плюс ~0.1-0.2 KB на каждую
+    метрику в каждой части (задержки в пределах 0.1-0.6 с - ~11 корзин). Все три метрики во всех частях -
+    ~2.5 KB против ~4.6 KB у плотных строк, одна часть с wait и hold - ~0.8 KB
+    """
+    __slots__ = ("slot_seconds", "epochs", "outcomes", "histograms")
+
+    def __init__(self, policy: StatsWindowPolicy):
+        self.slot_seconds = policy.window / policy.slots
+        self.epochs = array("q", [-1] * policy.slots)  # номер части окна, которую сейчас хранит позиция
+        self.outcomes = array("I", [0] * (2 * policy.slots))  # [2 * позиция] успехи, [2 * позиция + 1] ошибки
+        # [позиция * len(TimingMetric) + метрика] -> отрезок гистограммы, None пока замеров нет
+        self.histograms: Optional[List[Optional[array]]] = None
+
+    def _position(self, now: float) -> int:
+        epoch = int(now // self.slot_seconds)
+        position = epoch % len(self.epochs)
+        if self.epochs[position] != epoch:
+            self.epochs[position] = epoch
+            self.outcomes[2 * position] = self.outcomes[2 * position + 1] = 0
+            if self.histograms is not None:
+                metrics = len(TimingMetric)
+                self.histograms[position * metrics:(position + 1) * metrics] = [None] * metrics
+        return position
+
+    def record(self, ok: bool, now: float):
+        self.outcomes[2 * self._position(now) + (0 if ok else 1)] += 1
+
+    def observe(self, metric: TimingMetric, seconds: float, now: float):
+        position = self._position(now)
+        if self.histograms is None:
+            self.histograms = [None] * (len(self.epochs) * len(TimingMetric))
+        index = position * len(TimingMetric) + metric.value
+        self.histograms[index] = _span_add(self.histograms[index], histogram_bucket(seconds))
+
+    def add_to(self, stats: WindowStats, now: float):
+        """Прибавляет к stats части окна, которые еще не устарели"""
+        oldest = int(now // self.slot_seconds) - len(self.epochs) + 1
+        for position, epoch in enumerate(self.epochs):
+            if epoch < oldest:
+                continue
+            stats.success += self.outcomes[2 * position]
+            stats.errors += self.outcomes[2 * position + 1]
+            if self.histograms is None:
+                continue
+            for metric in TimingMetric:
+                span = self.histograms[position * len(TimingMetric) + metric.value]
+                if span is None:
+                    continue
+                counts, first = stats.histogram(metric).counts, span[0] - 1
+                for index in range(1, len(span)):
+                    counts[first + index] += span[index]
+
+
+class ProxyStats:
+    """
+    Статистика одной прокси. Счетчики задач - один array: [2 * id] успехи, [2 * id + 1] ошибки задачи
+    с номером id из TaskIds, так что отчет о запросе не создает ни строк, ни словарей.
+    Для совместимости читается и пишется как словарь со старыми ключами:
+    "error_sequence", "latency", "<task_key>_success_request" и т.д.
+    """
+    __slots__ = (
+        "key", "error_sequence", "success_total", "error_total", "latency", "probe_latency", "health_score",
+        "hedge_lost", "breaker", "task_counts", "windows", "_tasks",
+    )
+    FIELDS = (
+        "error_sequence", "success_total", "error_total", "latency", "probe_latency", "health_score", "hedge_lost",
+    )
+
+    def __init__(self, key: str, tasks: TaskIds):
+        self.key = key  # строка ip:port:user:password, под которой прокси в индексе хранилища
+        self.error_sequence = 0
+        self.success_total = 0
+        self.error_total = 0
+        self.latency: Optional[float] = None
+        self.probe_latency: Optional[float] = None
+        self.health_score: Optional[float] = None
+        self.hedge_lost = 0
+        self.breaker: Optional[CircuitBreaker] = None
+        self.task_counts = array("L")
+        self.windows: Optional[Dict[int, RollingStats]] = None  # номер задачи -> скользящее окно
+        self._tasks = tasks
+
+    def _reserve(self, task_id: int):
+        missing = 2 * task_id + 2 - len(self.task_counts)
+        if missing > 0:
+            self.task_counts.extend([0] * missing)
+
+    def counters(self) -> tuple:
+        """:return: значения FIELDS по порядку"""
+        return (
+            self.error_sequence, self.success_total, self.error_total, self.latency, self.probe_latency,
+            self.health_score, self.hedge_lost,
+        )
+
+    def task_totals(self) -> Dict[str, Tuple[int, int]]:
+        """:return: task_key -> (успехи, ошибки)"""
+        names, counts = self._tasks.names, self.task_counts
+        return {names[task_id]: (counts[2 * task_id], counts[2 * task_id + 1]) for task_id in range(len(counts) // 2)}
+
+    def count(self, task_id: int, ok: bool):
+        if 2 * task_id >= len(self.task_counts):
+            self._reserve(task_id)
+        self.task_counts[2 * task_id + (0 if ok else 1)] += 1
+
+    def task_counters(self, task_key: str) -> Tuple[int, int]:
+        """:return: (успехи, ошибки) по task_key"""
+        task_id = self._tasks.ids.get(task_key)
+        if task_id is None or 2 * task_id >= len(self.task_counts):
+            return 0, 0
+        return self.task_counts[2 * task_id], self.task_counts[2 * task_id + 1]
+
+    def _task_slot(self, key: str) -> Optional[Tuple[str, int]]:
+        if key.endswith(_SUCCESS_SUFFIX):
+            return key[:-len(_SUCCESS_SUFFIX)], 0
+        if key.endswith(_ERROR_SUFFIX):
+            return key[:-len(_ERROR_SUFFIX)], 1
+        return None
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        slot = self._task_slot(key)
+        if slot is not None:
+            task_id = self._tasks.ids.get(slot[0])
+            if task_id is not None and 2 * task_id < len(self.task_counts):
+                return self.task_counts[2 * task_id + slot[1]]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+            return
+        slot = self._task_slot(key)
+        if slot is None:
+            raise KeyError(key)
+        task_id = self._tasks.intern(slot[0])
+        self._reserve(task_id)
+        self.task_counts[2 * task_id + slot[1]] = value
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self) -> Iterator[str]:
+        for name in self.FIELDS:
+            if getattr(self, name) is not None:
+                yield name
+        for task_id in range(len(self.task_counts) // 2):
+            task_key = self._tasks.names[task_id]
+            yield task_key + _SUCCESS_SUFFIX
+            yield task_key + _ERROR_SUFFIX
+
+    def as_dict(self) -> dict:
+        return {key: self[key] for key in self}
+
+
+class ProxyStorage:
+    def __init__(
+            self,
+            breaker: Optional[CircuitBreakerPolicy] = CircuitBreakerPolicy(),
+            windows: Optional[StatsWindowPolicy] = None,
+    ):
+        """
+        :param breaker: пороги выключателя прокси, None - выключатель не используется
+        :param windows: скользящие окна статистики по прокси и задаче, None - окна не ведутся.
+         Память см. RollingStats
+        """
+        self.proxy_dict: Dict[ProxyData, ProxyStats] = {}
+        self.breaker = breaker
+        self.windows = windows
+        self.tasks = TaskIds()
+        self._by_str: Dict[str, ProxyData] = {}  # "ip:port:user:password" -> прокси
 
     def add_proxy_str(self, proxy: str, other_conditions: Dict[str, str] = None):
         """
@@ -15,6 +253,16 @@ class ProxyStorage:
         :param proxy: строка в стандартном формате
         :return: обьект прокси дата
         """
+        proxy_object = self.parse_proxy_str(proxy, other_conditions)
+        self.register_proxy(proxy_object)
+        return proxy_object
+
+    @staticmethod
+    def parse_proxy_str(proxy: str, other_conditions: Dict[str, str] = None) -> ProxyData:
+        """
+        Разбор строки ip:port:user:password без записи в хранилище
+        :raise ValueError: строка не в стандартном формате
+        """
         parts = proxy.split(":")
         if len(parts) != 4:
             raise ValueError("Proxy str format ip:port:user:password")
@@ -22,45 +270,257 @@ class ProxyStorage:
             raise ValueError("Proxy str format ip:port:user:password")
         if other_conditions is None:
             other_conditions = {}
-        proxy_object = ProxyData(parts[0], int(parts[1]), parts[2], parts[3], other_conditions)
+        return ProxyData(parts[0], int(parts[1]), parts[2], parts[3], other_conditions)
 
-        self.proxy_dict[proxy_object] = {}
-        self.proxy_dict[proxy_object]["error_sequence"] = 0
-        return proxy_object
+    def register_proxy(self, proxy: ProxyData):
+        """Заводит статистику прокси. Статистика уже известной ip:port сохраняется"""
+        if proxy in self.proxy_dict:
+            return
+        key = proxy.as_str()
+        self.proxy_dict[proxy] = ProxyStats(key, self.tasks)
+        self._by_str[key] = proxy
+
+    def remove_proxy(self, proxy: ProxyData):
+        stats = self.proxy_dict.pop(proxy, None)
+        if stats is not None:
+            self._by_str.pop(stats.key, None)
+
+    def update_credentials(self, proxy: ProxyData, username: str, password: str):
+        """Меняет логин и пароль прокси на месте, статистика сохраняется"""
+        proxy.username, proxy.password = username, password
+        stats = self.proxy_dict.get(proxy)
+        if stats is not None and self._by_str.get(stats.key) is proxy:
+            del self._by_str[stats.key]
+            stats.key = proxy.as_str()
+            self._by_str[stats.key] = proxy
 
     def get_proxy_by_str(self, proxy_str: str):
-        for proxy in self.proxy_dict.keys():
-            if f"{proxy.ip}:{str(proxy.port)}:{proxy.username}:{proxy.password}" == proxy_str:
-                return proxy
-        raise ValueError("Proxy doesnt match in record")
+        try:
+            return self._by_str[proxy_str]
+        except KeyError:
+            raise ValueError("Proxy doesnt match in record") from None
 
     def update_proxy_status(self, proxy: ProxyData):
-        self.proxy_dict[proxy]["error_sequence"] = 0
+        stats = self.proxy_dict[proxy]
+        stats.error_sequence = 0
+        stats.breaker = None
 
-    def report_status(self, proxy: ProxyData, request_status: bool, task_key: str):
+    def report_status(
+            self, proxy: ProxyData, request_status: bool, task_key: str, latency: Optional[float] = None
+    ):
         """
         :param task_key: таска где юзался прокси для статы
         :param proxy:
         :param request_status: true - work false - not work
+        :param latency: сколько длился запрос через прокси, секунды
         :return:
         """
-        try:
-            if request_status:
-                self.proxy_dict[proxy]["error_sequence"] = 0
-                self.proxy_dict[proxy][f"{task_key}_success_request"] += 1
-            else:
-                self.proxy_dict[proxy]["error_sequence"] += 1
-                self.proxy_dict[proxy][f"{task_key}_error_request"] += 1
-        except KeyError:
-            self.proxy_dict[proxy][f"{task_key}_success_request"] = 0
-            self.proxy_dict[proxy][f"{task_key}_error_request"] = 0
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return  # прокси удалена, пока была в работе
+        task_id = self.tasks.intern(task_key)
+        stats.count(task_id, request_status)
+        window = self._window(stats, task_id)
+        if window is not None:
+            now = time.monotonic()
+            window.record(request_status, now)
+            if latency is not None:
+                window.observe(TimingMetric.hold, latency, now)
+        if request_status:
+            stats.success_total += 1
+            stats.error_sequence = 0
+            if latency is not None:
+                previous = stats.latency
+                stats.latency = latency if previous is None else previous + LATENCY_EWMA_ALPHA * (latency - previous)
+        else:
+            stats.error_total += 1
+            stats.error_sequence += 1
+        if self.breaker is not None:
+            if stats.breaker is None:
+                stats.breaker = CircuitBreaker()
+            stats.breaker.record(request_status, self.breaker, time.monotonic())
+
+    def _window(self, stats: ProxyStats, task_id: int) -> Optional[RollingStats]:
+        if self.windows is None:
+            return None
+        if stats.windows is None:
+            stats.windows = {}
+        window = stats.windows.get(task_id)
+        if window is None:
+            window = stats.windows[task_id] = RollingStats(self.windows)
+        return window
+
+    def observe_timing(self, proxy: ProxyData, task_key: str, metric: TimingMetric, seconds: float):
+        """
+        Замер задержки в скользящее окно прокси по задаче (hold пишет report_status)
+        :param metric: TimingMetric.wait - ожидание выдачи, TimingMetric.request - http запрос
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return
+        window = self._window(stats, self.tasks.intern(task_key))
+        if window is not None:
+            window.observe(metric, seconds, time.monotonic())
+
+    def window_stats(self, proxy: ProxyData, task_key: Optional[str] = None) -> WindowStats:
+        """
+        :param task_key: задача, None - все задачи прокси вместе
+        :return: срез скользящего окна, независимая от хранилища копия
+        """
+        result = WindowStats()
+        stats = self.proxy_dict.get(proxy)
+        if stats is None or not stats.windows:
+            return result
+        now = time.monotonic()
+        if task_key is None:
+            for window in stats.windows.values():
+                window.add_to(result, now)
+        else:
+            window = stats.windows.get(self.tasks.ids.get(task_key))
+            if window is not None:
+                window.add_to(result, now)
+        return result
+
+    def iter_window_stats(self, task_key: Optional[str] = None) -> Iterator[Tuple[ProxyData, WindowStats]]:
+        """
+        Срезы окон по всем прокси, считаются по одной при обходе. Прокси без данных в окне пропускаются.
+        Список прокси фиксируется при первом шаге, так что обход можно прерывать await'ами
+        """
+        for proxy in list(self.proxy_dict):
+            result = self.window_stats(proxy, task_key)
+            if result.success or result.errors or any(result.histogram(metric).count for metric in TimingMetric):
+                yield proxy, result
+
+    def report_hedge_loss(self, proxy: ProxyData, elapsed: float):
+        """
+        Прокси проиграла хедж: ее запрос отменен через elapsed секунд, не дождавшись ответа. Ошибкой это
+        не считается, но elapsed - оценка задержки снизу и идет в скользящую среднюю задержку
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return
+        stats.hedge_lost += 1
+        previous = stats.latency
+        stats.latency = elapsed if previous is None else previous + LATENCY_EWMA_ALPHA * (elapsed - previous)
+
+    def report_statuses(self, results: Iterable[Tuple[ProxyData, bool]], task_key: str):
+        """
+        Пакетный report_status для acquire_many
+        :param results: пары (прокси, true - work false - not work)
+        """
+        for proxy, request_status in results:
+            self.report_status(proxy=proxy, request_status=request_status, task_key=task_key)
+
+    def report_probe(self, proxy: ProxyData, latency: Optional[float], slow_latency: float = 2.0):
+        """
+        Результат фоновой пробы. Оценка здоровья - скользящая средняя замеров: ответ за latency дает
+        slow_latency / (slow_latency + latency), то есть 0.5 на медленной прокси, отказ дает 0.
+        Старые замеры затухают экспоненциально, на счетчики ошибок пробы не влияют
+        :param latency: время до первого байта ответа, None - проба не прошла
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return
+        if latency is None:
+            sample = 0.0
+        else:
+            sample = slow_latency / (slow_latency + latency)
+            previous = stats.probe_latency
+            stats.probe_latency = latency if previous is None else previous + PROBE_SCORE_ALPHA * (latency - previous)
+        previous = 1.0 if stats.health_score is None else stats.health_score
+        stats.health_score = previous + PROBE_SCORE_ALPHA * (sample - previous)
+
+    def get_health_score(self, proxy: ProxyData) -> float:
+        """
+        :return: оценка здоровья по фоновым пробам от 0 до 1, у непроверенной прокси 1
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None or stats.health_score is None:
+            return 1.0
+        return stats.health_score
+
+    def get_error_rate(self, proxy: ProxyData) -> float:
+        """
+        :return: доля ошибок за все время со сглаживанием, у новой прокси 0.5
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return 0.5
+        return (stats.error_total + 1) / (stats.error_total + stats.success_total + 2)
+
+    def get_latency(self, proxy: ProxyData) -> Optional[float]:
+        """
+        :return: скользящая средняя задержка успешных запросов, None если замеров нет
+        """
+        stats = self.proxy_dict.get(proxy)
+        return None if stats is None else stats.latency
+
+    def get_task_counters(self, proxy: ProxyData, task_key: str) -> Tuple[int, int]:
+        """
+        :return: (успехи, ошибки) прокси по task_key
+        """
+        stats = self.proxy_dict.get(proxy)
+        return (0, 0) if stats is None else stats.task_counters(task_key)
+
+    def get_breaker_state(self, proxy: ProxyData) -> BreakerState:
+        stats = self.proxy_dict.get(proxy)
+        if stats is None or stats.breaker is None or self.breaker is None:
+            return BreakerState.closed
+        return stats.breaker.state(self.breaker, time.monotonic())
+
+    def breaker_retry_in(self, proxy: ProxyData) -> float:
+        """
+        :return: через сколько секунд открытый выключатель перейдет в half-open, 0 если уже не открыт
+        """
+        stats = self.proxy_dict.get(proxy)
+        if stats is None or stats.breaker is None or stats.breaker.opened_at is None or self.breaker is None:
+            return 0.0
+        return max(stats.breaker.retry_at(self.breaker) - time.monotonic(), 0.0)
+
+    def export_stats(self, proxy: ProxyData) -> Optional[Tuple[tuple, Dict[str, Tuple[int, int]]]]:
+        """:return: (ProxyStats.counters(), ProxyStats.task_totals()) для снимка, None если прокси неизвестна"""
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
+            return None
+        return stats.counters(), stats.task_totals()
+
+    def restore_stats(self, proxy: ProxyData, counters: Sequence, task_totals: Dict[str, Sequence[int]]):
+        """
+        Заводит статистику прокси из export_stats. Уже известная ip:port не трогается
+        """
+        if proxy in self.proxy_dict:
+            return
+        key = proxy.as_str()
+        stats = self.proxy_dict[proxy] = ProxyStats(key, self.tasks)
+        self._by_str[key] = proxy
+        (
+            stats.error_sequence, stats.success_total, stats.error_total, stats.latency, stats.probe_latency,
+            stats.health_score, stats.hedge_lost,
+        ) = counters
+        if task_totals:
+            intern = self.tasks.intern
+            task_ids = [intern(task_key) for task_key in task_totals]
+            counts = stats.task_counts = _ZERO_COUNT * (2 * max(task_ids) + 2)
+            for task_id, (success, errors) in zip(task_ids, task_totals.values()):
+                counts[2 * task_id] = success
+                counts[2 * task_id + 1] = errors
+
+    def restore_breaker(self, proxy: ProxyData, retry_in: float, trips: int):
+        """Открывает выключатель прокси так, чтобы half-open наступил через retry_in секунд"""
+        stats = self.proxy_dict.get(proxy)
+        if stats is None or self.breaker is None:
+            return
+        opened_at = time.monotonic() + retry_in - self.breaker.timeout(trips)
+        stats.breaker = CircuitBreaker(opened_at=opened_at, trips=trips)
+
+    def breaker_trips(self, proxy: ProxyData) -> int:
+        """:return: неудачных пробных запросов подряд у выключателя прокси"""
+        stats = self.proxy_dict.get(proxy)
+        return 0 if stats is None or stats.breaker is None else stats.breaker.trips
 
     def get_proxy_error_count(self, proxy: ProxyData) -> int:
-        try:
-            return self.proxy_dict[proxy]["error_sequence"]
-        except KeyError:
-            self.proxy_dict[proxy]["error_sequence"] = 0
-            return 0
+        stats = self.proxy_dict.get(proxy)
+        return 0 if stats is None else stats.error_sequence
 
     def get_all_proxy_with_statuses(self) -> dict:
         return self.proxy_dict
@@ -70,10 +530,7 @@ class ProxyStorage:
         :param proxy:
         :return: True if proxy valid false if not
         """
-        if proxy not in self.proxy_dict:
-            return False
-
-        if self.proxy_dict[proxy]["error_sequence"] < MAX_ERROR_COUNT:
-            return True
-        else:
+        stats = self.proxy_dict.get(proxy)
+        if stats is None:
             return False
+        return stats.error_sequence < MAX_ERROR_COUNT
@@ -1,5 +1,7 @@
 from abc import abstractmethod, ABC
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List, Set
+
+from proxy_manager.types import RateLimit
 
 
 class AbstractQueue(ABC):
@@ -8,15 +10,52 @@ class AbstractQueue(ABC):
     async def add(self, item) -> None:
         pass
 
+    @abstractmethod
+    async def add_many(self, items: List[Any]) -> None:
+        pass
+
     @abstractmethod
     async def get(
             self,
             task_key: str = "default",
             last_used: float = 1.0,
             other_conditions: Optional[Dict[str, str]] | None = None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            exclude: Optional[Set[Any]] = None,
     ) -> Any:
         pass
 
     @abstractmethod
     def release(self, item, task_key: str | None):
         pass
+
+    @abstractmethod
+    async def remove(self, item) -> None:
+        pass
+
+    @abstractmethod
+    async def update_conditions(self, item, other_conditions: Dict[str, str]) -> None:
+        pass
+
+    @abstractmethod
+    async def get_many(
+            self,
+            n: int,
+            task_key: str = "default",
+            last_used: float = 1.0,
+            other_conditions: Optional[Dict[str, str]] | None = None,
+            timeout: float | None = None,
+            min_count: int = 1,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+    ) -> List[Any]:
+        pass
+
+    @abstractmethod
+    async def release_many(self, items: List[Any], task_key: str | None):
+        pass
+
+    @abstractmethod
+    def upcoming(self, task_key: str, last_used: float, within: float, limit: int) -> List[Any]:
+        pass
@@ -1,54 +1,459 @@
 import asyncio
-from typing import Dict, List, Optional
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import logging
 
 from proxy_manager.queues.abstract_queue import AbstractQueue
-from proxy_manager.types import RequestProxy, ProxySession
+from proxy_manager.queues.selection import LeastRecentlyUsedPolicy, SelectionPolicy
+from proxy_manager.types import RateLimit, RequestProxy, ProxySession, WaitStats
 
 logger = logging.getLogger(__name__)
 
 
 class ProxyPool(AbstractQueue):
-    def __init__(self):
-        self.requests: List[RequestProxy] = []
-        self.proxies: List[ProxySession] = []
+    def __init__(
+            self,
+            aging_interval: Optional[float] = 5.0,
+            policy: Optional[SelectionPolicy] = None,
+            cooldown_ttl: Optional[float] = 3600.0,
+            max_cooldown_keys: Optional[int] = 1000,
+    ):
+        """
+        :param aging_interval: за сколько секунд ожидания запрос поднимается на один уровень приоритета,
+         None - без старения
+        :param policy: как выбирать прокси среди готовых, по умолчанию самая давно использованная
+        :param cooldown_ttl: через сколько секунд без использования кулдаун по ключу забывается,
+         должен быть больше самого большого time_condition
+        :param max_cooldown_keys: максимум ключей кулдауна (task_key/хостов) на одну прокси
+        """
+        self.policy = policy or LeastRecentlyUsedPolicy()
+        self.cooldown_ttl = cooldown_ttl
+        self.max_cooldown_keys = max_cooldown_keys
+        # приоритет -> очередь ожидающих запросов (FIFO внутри уровня)
+        self.requests: Dict[int, Deque[RequestProxy]] = {}
+        self.aging_interval = aging_interval
+        self.wait_stats: Dict[int, WaitStats] = {}
+        # Упорядоченное множество свободных прокси (dict сохраняет порядок добавления)
+        self.proxies: Dict[ProxySession, None] = {}
+        # Инвертированный индекс (ключ условия, значение) -> свободные прокси с этим условием
+        self._index: Dict[Tuple[str, str], Dict[ProxySession, None]] = {}
+        # task_key -> свободные прокси, которые уже использовались в этой задаче (значение - time.monotonic())
+        self._cooling: Dict[str, Dict[ProxySession, float]] = {}
+        # task_key -> min-куча (время использования, seq, прокси); устаревшие записи удаляются лениво
+        self._cooldown_heaps: Dict[str, List[Tuple[float, int, ProxySession]]] = {}
+        self._seq = itertools.count()
         self.lock = asyncio.Lock()
-        self._background_task: Optional[asyncio.Task] = None
+        # Таймер на момент, когда у ближайшей прокси закончится time_condition
+        self._wakeup_handle: Optional[asyncio.TimerHandle] = None
+        self._wakeup_at: Optional[float] = None
+        self._wakeup_task: Optional[asyncio.Task] = None
 
     async def start(self):
-        self._background_task = asyncio.create_task(self._background())
+        # Фоновый опрос больше не нужен: ожидающие запросы сопоставляются
+        # сразу в add/release, а окончание кулдауна отслеживает таймер
+        pass
 
     async def stop(self):
-        if self._background_task:
-            self._background_task.cancel()
+        self._cancel_wakeup()
+        if self._wakeup_task and not self._wakeup_task.done():
+            self._wakeup_task.cancel()
             try:
-                await self._background_task
+                await self._wakeup_task
             except asyncio.CancelledError:
                 pass
 
-    async def _background(self):
-        while True:
-            try:
-                await asyncio.sleep(0.5)  # Еще более частая проверка
-                await self.compare_available_proxy_and_request()
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                print(f"Background task error: {e}")
-                await asyncio.sleep(1)  # Пауза при ошибке
+    def _cancel_wakeup(self):
+        if self._wakeup_handle is not None:
+            self._wakeup_handle.cancel()
+        self._wakeup_handle = None
+        self._wakeup_at = None
+
+    def _schedule_wakeup(self, when: Optional[float]):
+        """
+        Ставит таймер на момент when (time.monotonic()), если он раньше уже запланированного
+        """
+        if when is None:
+            return
+        if self._wakeup_at is not None and self._wakeup_at <= when:
+            return
+        self._cancel_wakeup()
+        delay = max(when - time.monotonic(), 0.0)
+        self._wakeup_at = when
+        self._wakeup_handle = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup_handle = None
+        self._wakeup_at = None
+        self._wakeup_task = asyncio.ensure_future(self._run_wakeup())
+
+    async def _run_wakeup(self):
+        try:
+            await self.compare_available_proxy_and_request()
+        except Exception as e:
+            logger.error("Proxy pool wakeup error: %s", e)
+
+    def _insert(self, proxy: ProxySession):
+        # get вместо setdefault: не создаем пустой словарь или список на каждый ключ при каждой вставке
+        self.proxies[proxy] = None
+        for item in proxy.proxy_data.other_conditions.items():
+            bucket = self._index.get(item)
+            if bucket is None:
+                bucket = self._index[item] = {}
+            bucket[proxy] = None
+        for task_key in proxy.used_time:
+            used = proxy.last_used_monotonic(task_key)
+            cooling = self._cooling.get(task_key)
+            if cooling is None:
+                cooling = self._cooling[task_key] = {}
+            cooling[proxy] = used
+            heap = self._cooldown_heaps.get(task_key)
+            if heap is None:
+                heap = self._cooldown_heaps[task_key] = []
+            heapq.heappush(heap, (used, next(self._seq), proxy))
+            if len(heap) > 2 * len(cooling) + 16:
+                # Слишком много устаревших записей - пересобираем кучу из актуальных
+                heap[:] = [entry for entry in heap if cooling.get(entry[2]) == entry[0]]
+                heapq.heapify(heap)
+
+    def _remove(self, proxy: ProxySession):
+        self.proxies.pop(proxy, None)
+        for task_key in proxy.used_time:
+            cooling = self._cooling.get(task_key)
+            if cooling is not None:
+                cooling.pop(proxy, None)
+                if not cooling:
+                    # Ключ больше не нужен ни одной свободной прокси (например, разовый хост)
+                    del self._cooling[task_key]
+                    self._cooldown_heaps.pop(task_key, None)
+        for item in proxy.proxy_data.other_conditions.items():
+            bucket = self._index.get(item)
+            if bucket is None:
+                continue
+            bucket.pop(proxy, None)
+            if not bucket:
+                del self._index[item]
+
+    def _candidates(self, other_conditions: Optional[Dict[str, str]]) -> Iterable[ProxySession]:
+        """
+        Свободные прокси, которые могут подойти под other_conditions.
+        Без условий отдается весь пул, иначе самая короткая корзина индекса
+        """
+        if not other_conditions:
+            return self.proxies
+        smallest = None
+        for item in other_conditions.items():
+            bucket = self._index.get(item)
+            if bucket is None:
+                return ()
+            if smallest is None or len(bucket) < len(smallest):
+                smallest = bucket
+        if len(other_conditions) == 1:
+            return smallest
+        return (proxy for proxy in smallest if proxy.check_other(other_conditions))
+
+    def _heap_top(self, task_key: str) -> Optional[Tuple[float, ProxySession]]:
+        """
+        Свободная прокси, дольше всех не использовавшаяся в task_key. O(log N) амортизированно
+        """
+        heap = self._cooldown_heaps.get(task_key)
+        if not heap:
+            return None
+        cooling = self._cooling.get(task_key, {})
+        while heap:
+            used, _, proxy = heap[0]
+            if cooling.get(proxy) == used:
+                return used, proxy
+            heapq.heappop(heap)  # прокси занята или время использования обновилось
+        del self._cooldown_heaps[task_key]
+        return None
+
+    def _eligible(
+            self,
+            task_key: str,
+            last_used: float,
+            other_conditions: Optional[Dict[str, str]],
+            exclude: Optional[Set[ProxySession]] = None,
+            rate_limit: Optional[RateLimit] = None,
+    ) -> Iterator[ProxySession]:
+        """
+        Свободные прокси, готовые для запроса, в порядке от давно использованных к недавним
+        :param exclude: прокси, которые не предлагать
+        :param rate_limit: вместо кулдауна last_used проверяется корзина токенов
+        """
+        now = time.monotonic()
+        if rate_limit is not None:
+            for proxy in self._candidates(other_conditions):
+                if exclude and proxy in exclude:
+                    continue
+                if proxy.rate_ready_at(task_key, rate_limit) <= now:
+                    yield proxy
+            return
+        cooling = self._cooling.get(task_key, {})
+        top = None
+        if not other_conditions:
+            top = self._heap_top(task_key)
+            if top is not None and top[0] + last_used <= now:
+                if not exclude or top[1] not in exclude:
+                    yield top[1]
+            elif len(self.proxies) == len(cooling):
+                # Самая давно использованная прокси не готова, а неиспользованных нет - готовых нет вообще
+                return
+        for proxy in self._candidates(other_conditions):
+            if top is not None and proxy is top[1]:
+                continue
+            if exclude and proxy in exclude:
+                continue
+            used = cooling.get(proxy)
+            if used is None or used + last_used <= now:
+                yield proxy
+
+    def _enqueue(self, request: RequestProxy):
+        request.seq = next(self._seq)
+        self.requests.setdefault(request.priority, deque()).append(request)
+
+    def _dequeue(self, request: RequestProxy):
+        level = self.requests.get(request.priority)
+        if level is None:
+            return
+        try:
+            level.remove(request)
+        except ValueError:
+            return
+        if not level:
+            del self.requests[request.priority]
+
+    def _ordered_requests(self) -> List[RequestProxy]:
+        """
+        Ожидающие запросы в порядке обслуживания: по приоритету с учетом старения, внутри уровня FIFO.
+        Внутри уровня более старые запросы всегда выше, поэтому уровни просто сливаются
+        """
+        now = time.monotonic()
+        return list(heapq.merge(
+            *self.requests.values(),
+            key=lambda request: (request.effective_priority(now, self.aging_interval), request.seq),
+        ))
+
+    def _stats_for(self, priority: int) -> WaitStats:
+        stats = self.wait_stats.get(priority)
+        if stats is None:
+            stats = self.wait_stats[priority] = WaitStats()
+        return stats
+
+    def _lend(self, proxy: ProxySession, task_key: str, rate_limit: Optional[RateLimit] = None):
+        """
+        Выдача прокси: занимает слот и токен. Если у прокси несколько слотов, сразу ставит кулдаун
+        по task_key, чтобы он действовал и для параллельных запросов через эту же прокси
+        """
+        proxy.in_flight += 1
+        if rate_limit is not None:
+            proxy.take_token(task_key, rate_limit)
+        if proxy.max_concurrency > 1:
+            proxy.update_used_time(task_key)
+
+    def _fulfill(self, request: RequestProxy, proxy: ProxySession):
+        """Отдает запросу уже выданную через _lend прокси"""
+        self._dequeue(request)
+        if request.distinct:
+            request.exclude.add(proxy)
+        request.future.set_result(proxy)
+        self._stats_for(request.priority).observe(time.monotonic() - request.created_at)
+
+    def get_wait_stats(self) -> Dict[int, dict]:
+        """
+        :return: приоритет -> количество выдач, среднее и максимальное ожидание, число таймаутов
+        """
+        return {
+            priority: {
+                "count": stats.count,
+                "avg_wait": stats.avg_wait,
+                "max_wait": stats.max_wait,
+                "timeouts": stats.timeouts,
+                "waiting": len(self.requests.get(priority, ())),
+            }
+            for priority, stats in self.wait_stats.items()
+        }
+
+    def _match_waiting_request(self, proxy: ProxySession) -> bool:
+        """
+        Отдает прокси первому подходящему ожидающему запросу. Вызывается под блокировкой
+        :return: True если прокси ушла в запрос
+        """
+        if not self.requests:
+            return False
+        next_wakeup = None
+        for request in self._ordered_requests():
+            if request.future.done():
+                self._dequeue(request)
+                continue
+            if request.match_proxy(proxy):
+                self._lend(proxy, request.task_key, request.rate_limit)
+                self._fulfill(request, proxy)
+                return True
+            if proxy.check_other(request.other_conditions) and not request.excludes(proxy):
+                ready_at = request.ready_at(proxy)
+                if next_wakeup is None or ready_at < next_wakeup:
+                    next_wakeup = ready_at
+        self._schedule_wakeup(next_wakeup)
+        return False
+
+    def _put_back(self, proxy: ProxySession):
+        """
+        Раздает свободные слоты прокси ожидающим запросам, остаток оставляет в пуле
+        """
+        if proxy in self.proxies:
+            self._remove(proxy)  # переиндексация: время использования могло измениться
+        if not proxy.in_rotation:
+            return
+        self._maybe_prune(proxy)
+        while proxy.in_flight < proxy.slots:
+            if not self._match_waiting_request(proxy):
+                self._insert(proxy)
+                return
+
+    def _maybe_prune(self, proxy: ProxySession):
+        # Вызывается, когда прокси вне индекса кулдаунов, иначе индекс разойдется с used_time
+        proxy.maybe_prune_cooldowns(self.cooldown_ttl, self.max_cooldown_keys)
+
+    async def prune_cooldowns(self):
+        """
+        Чистка кулдаунов у всех свободных прокси. Выданные прокси чистятся при release,
+        так что звать стоит только если часть прокси долго простаивает
+        """
+        async with self.lock:
+            for proxy in list(self.proxies):
+                self._remove(proxy)
+                proxy.prune_cooldowns(self.cooldown_ttl, self.max_cooldown_keys)
+                self._insert(proxy)
 
     async def add(self, proxy_item: ProxySession):
-        async with self.lock:  # Только добавление под блокировкой
-            self.proxies.append(proxy_item)
+        async with self.lock:
+            proxy_item.in_rotation = True
+            self._put_back(proxy_item)
+
+    async def add_many(self, proxies: List[ProxySession]):
+        """Добавляет пачку прокси за одно взятие блокировки"""
+        async with self.lock:
+            for proxy in proxies:
+                proxy.in_rotation = True
+                self._put_back(proxy)
+
+    async def remove(self, proxy: ProxySession):
+        """
+        Выводит прокси из ротации. Выданные слоты после release в пул не возвращаются
+        """
+        async with self.lock:
+            proxy.in_rotation = False
+            self._remove(proxy)
+
+    async def update_conditions(self, proxy: ProxySession, other_conditions: Dict[str, str]):
+        """
+        Меняет условия прокси на месте. Свободная прокси переиндексируется сразу, выданная - при release
+        """
+        async with self.lock:
+            free = proxy in self.proxies
+            self._remove(proxy)  # индекс собран по старым условиям
+            proxy.proxy_data.other_conditions = other_conditions
+            if free:
+                self._put_back(proxy)
 
     def _check_already_existed_proxy(
-            self, task_key: str, last_used: float, other_conditions: Dict[str, str]
+            self,
+            task_key: str,
+            last_used: float,
+            other_conditions: Dict[str, str],
+            exclude: Optional[Set[ProxySession]] = None,
+            rate_limit: Optional[RateLimit] = None,
     ) -> Optional[ProxySession]:
-        for i, proxy in enumerate(self.proxies):
-            if proxy.check_other(conditions=other_conditions):
-                if proxy.check_time(task_key=task_key, condition=last_used):
-                    return self.proxies.pop(i)
-        return None
+        eligible = self._eligible(task_key, last_used, other_conditions, exclude, rate_limit)
+        if self.policy.window <= 1:
+            proxy = next(eligible, None)
+        else:
+            proxy = self.policy.pick(eligible, task_key)
+        if proxy is not None:
+            self._remove(proxy)
+            self._lend(proxy, task_key, rate_limit)
+            if proxy.in_flight < proxy.slots:
+                self._insert(proxy)
+        return proxy
+
+    def _next_ready_time(
+            self,
+            task_key: str,
+            last_used: float,
+            other_conditions: Optional[Dict[str, str]],
+            rate_limit: Optional[RateLimit] = None,
+            exclude: Optional[Set[ProxySession]] = None,
+    ) -> Optional[float]:
+        """
+        :return: момент (time.monotonic()), когда освободится первая подходящая свободная прокси
+        """
+        if not self.proxies:
+            return None
+        if rate_limit is not None:
+            return min(
+                (
+                    proxy.rate_ready_at(task_key, rate_limit)
+                    for proxy in self._candidates(other_conditions)
+                    if not exclude or proxy not in exclude
+                ),
+                default=None,
+            )
+        if not other_conditions and not exclude:
+            if len(self.proxies) > len(self._cooling.get(task_key, ())):
+                return 0.0
+            return self._heap_top(task_key)[0] + last_used
+
+        next_ready = None
+        cooling = self._cooling.get(task_key, {})
+        for proxy in self._candidates(other_conditions):
+            if exclude and proxy in exclude:
+                continue
+            used = cooling.get(proxy)
+            ready_at = 0.0 if used is None else used + last_used
+            if next_ready is None or ready_at < next_ready:
+                next_ready = ready_at
+        return next_ready
+
+    def next_available_in(
+            self,
+            task_key: str = "default",
+            last_used: float = 1.0,
+            other_conditions: Optional[Dict[str, str]] = None,
+            rate_limit: Optional[RateLimit] = None,
+    ) -> Optional[float]:
+        """
+        Через сколько секунд освободится подходящая прокси среди свободных
+        :return: 0 если есть прямо сейчас, None если подходящих свободных прокси нет совсем
+        """
+        ready_at = self._next_ready_time(task_key, last_used, other_conditions, rate_limit)
+        if ready_at is None:
+            return None
+        return max(ready_at - time.monotonic(), 0.0)
+
+    def upcoming(self, task_key: str, last_used: float, within: float, limit: int) -> List[ProxySession]:
+        """
+        Свободные прокси, которые первыми пойдут в выдачу по task_key: не использованные в нем и те,
+        у кого кулдаун last_used кончится в ближайшие within секунд, не больше limit. Для прогрева соединений
+        """
+        cooling = self._cooling.get(task_key, {})
+        result = []
+        if len(self.proxies) > len(cooling):
+            for proxy in self.proxies:
+                if proxy not in cooling:
+                    result.append(proxy)
+                    if len(result) >= limit:
+                        return result
+        horizon = time.monotonic() + within
+        # В куче бывают устаревшие записи, берем с запасом
+        for used, _, proxy in heapq.nsmallest(2 * limit, self._cooldown_heaps.get(task_key, ())):
+            if len(result) >= limit or used + last_used > horizon:
+                break
+            if cooling.get(proxy) == used:
+                result.append(proxy)
+        return result
 
     async def get(
             self,
@@ -56,32 +461,45 @@ class ProxyPool(AbstractQueue):
             last_used: float = 1.0,
             other_conditions: Optional[Dict[str, str]] | None = None,
             timeout: float | None = None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            exclude: Optional[Set[ProxySession]] = None,
     ):
-        # Проверка под блокировкой
+        """
+        :param priority: приоритет запроса, меньше - важнее. Внутри одного приоритета FIFO
+        :param rate_limit: ограничение частоты по task_key на каждую прокси вместо last_used
+        :param exclude: прокси, которые не выдавать (например, уже отказавшие в этом запросе)
+        """
+        # Поиск и регистрация запроса под одной блокировкой, чтобы не пропустить release между ними
         async with self.lock:
-            for i, proxy in enumerate(self.proxies):
-                if proxy.check_other(other_conditions):
-                    if proxy.check_time(task_key, last_used):
-                        return self.proxies.pop(i)
-
-        # Создание запроса под блокировкой
-        future = asyncio.Future()
-        request = RequestProxy(
-            future=future,
-            task_key=task_key,
-            time=last_used,
-            other_conditions=other_conditions or {},
-        )
+            # Свободная прокси, подходящая кому-то из ожидающих, уже была бы отдана ему в add/release
+            proxy = self._check_already_existed_proxy(
+                task_key, last_used, other_conditions, exclude=exclude, rate_limit=rate_limit
+            )
+            if proxy is not None:
+                self._stats_for(priority).observe(0.0)
+                return proxy
 
-        async with self.lock:
-            self.requests.append(request)
+            future = asyncio.Future()
+            request = RequestProxy(
+                future=future,
+                task_key=task_key,
+                time=last_used,
+                other_conditions=other_conditions or {},
+                priority=priority,
+                rate_limit=rate_limit,
+                exclude=exclude,
+            )
+            self._enqueue(request)
+            self._schedule_wakeup(self._next_ready_time(task_key, last_used, other_conditions, rate_limit, exclude))
 
         try:
             return await asyncio.wait_for(future, timeout=timeout)
         except (asyncio.TimeoutError, asyncio.CancelledError) as e:
             async with self.lock:
-                if request in self.requests:
-                    self.requests.remove(request)
+                self._dequeue(request)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._stats_for(priority).timeouts += 1
 
             if isinstance(e, asyncio.CancelledError):
                 # Можно добавить логирование для отладки
@@ -90,40 +508,121 @@ class ProxyPool(AbstractQueue):
             raise  # Пробрасываем оригинальную ошибку
 
     async def compare_available_proxy_and_request(self):
+        """
+        Полный проход по ожидающим запросам. Запускается таймером, когда у какой-то
+        прокси заканчивается time_condition, и заодно планирует следующий таймер
+        """
         async with self.lock:
-            i = 0
-            while i < len(self.requests):
-                request = self.requests[i]
-
+            next_wakeup = None
+            for request in self._ordered_requests():
                 # Удаляем завершенные запросы
                 if request.future.done():
-                    self.requests.pop(i)
+                    self._dequeue(request)
                     continue
 
-                # Ищем подходящий прокси
-                j = 0
-                found_match = False
-                while j < len(self.proxies):
-                    proxy = self.proxies[j]
-
-                    if request.match_proxy(proxy):
-                        try:
-                            request.future.set_result(proxy)
-                            self.proxies.pop(j)  # Удаляем использованный прокси
-                            self.requests.pop(i)  # Удаляем обработанный запрос
-                            found_match = True
-                            break
-                        except (asyncio.InvalidStateError, asyncio.CancelledError):
-                            self.requests.pop(i)  # Удаляем невалидный запрос
-                            found_match = True
-                            break
-                    else:
-                        j += 1
-
-                if not found_match:
-                    i += 1  # Переходим к следующему запросу
+                # Ищем подходящий прокси только среди кандидатов из индекса
+                proxy = self._check_already_existed_proxy(
+                    request.task_key,
+                    request.time,
+                    request.other_conditions,
+                    exclude=request.exclude,
+                    rate_limit=request.rate_limit,
+                )
+                if proxy is not None:
+                    self._fulfill(request, proxy)
+                else:
+                    ready_at = self._next_ready_time(
+                        request.task_key, request.time, request.other_conditions, request.rate_limit, request.exclude
+                    )
+                    if ready_at is not None and (next_wakeup is None or ready_at < next_wakeup):
+                        next_wakeup = ready_at
+
+            self._schedule_wakeup(next_wakeup)
+
+    async def get_many(
+            self,
+            n: int,
+            task_key: str = "default",
+            last_used: float = 1.0,
+            other_conditions: Optional[Dict[str, str]] | None = None,
+            timeout: float | None = None,
+            min_count: int = 1,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+    ) -> List[ProxySession]:
+        """
+        Забирает до n разных прокси за один проход под одной блокировкой
+        :param min_count: сколько прокси нужно минимум, недостающие до min_count ждем как обычные запросы
+        :return: список от min_count до n прокси
+        """
+        min_count = min(min_count, n)
+        async with self.lock:
+            proxies = []
+            taken = set()
+            while len(proxies) < n:
+                proxy = self._check_already_existed_proxy(
+                    task_key, last_used, other_conditions, exclude=taken, rate_limit=rate_limit
+                )
+                if proxy is None:
+                    break
+                proxies.append(proxy)
+                taken.add(proxy)
+            stats = self._stats_for(priority)
+            for _ in proxies:
+                stats.observe(0.0)
+            if len(proxies) >= min_count:
+                return proxies
+
+            requests = []
+            for _ in range(min_count - len(proxies)):
+                request = RequestProxy(
+                    future=asyncio.Future(),
+                    task_key=task_key,
+                    time=last_used,
+                    other_conditions=other_conditions or {},
+                    priority=priority,
+                    rate_limit=rate_limit,
+                    exclude=taken,
+                    distinct=True,
+                )
+                self._enqueue(request)
+                requests.append(request)
+            self._schedule_wakeup(self._next_ready_time(task_key, last_used, other_conditions, rate_limit, taken))
+
+        futures = [request.future for request in requests]
+        try:
+            _, pending = await asyncio.wait(futures, timeout=timeout)
+        except asyncio.CancelledError:
+            await self._abort_many(requests, proxies)
+            raise
+        if pending:
+            await self._abort_many(requests, proxies)
+            self._stats_for(priority).timeouts += 1
+            raise asyncio.TimeoutError(f"Only {len(proxies)} of {min_count} proxies acquired")
+        return proxies + [future.result() for future in futures]
+
+    async def _abort_many(self, requests: List[RequestProxy], proxies: List[ProxySession]):
+        # Возвращаем все, что успели получить
+        async with self.lock:
+            for request in requests:
+                self._dequeue(request)
+                if request.future.done() and not request.future.cancelled():
+                    proxies.append(request.future.result())
+                else:
+                    request.future.cancel()
+            for proxy in proxies:
+                proxy.in_flight -= 1
+                self._put_back(proxy)
 
     async def release(self, proxy: ProxySession, task_key: str | None):
-        proxy.update_used_time(task_key)
-        async with self.lock:  # Только добавление под блокировкой
-            self.proxies.append(proxy)
+        async with self.lock:
+            proxy.update_used_time(task_key)
+            proxy.in_flight = max(proxy.in_flight - 1, 0)
+            self._put_back(proxy)
+
+    async def release_many(self, proxies: List[ProxySession], task_key: str | None):
+        async with self.lock:
+            for proxy in proxies:
+                proxy.update_used_time(task_key)
+                proxy.in_flight = max(proxy.in_flight - 1, 0)
+                self._put_back(proxy)
@@ -1,16 +1,113 @@
 import asyncio
-from typing import Dict, Optional
+import heapq
+import itertools
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 from proxy_manager.queues.abstract_queue import AbstractQueue
-from proxy_manager.types import ProxySession
+from proxy_manager.types import ProxySession, RateLimit
 
 
 class ProxyQueueWithoutConditions(AbstractQueue):
-    def __init__(self):
-        self.queue = asyncio.Queue()
+    """
+    Простая очередь без условий: готовые прокси лежат в deque, вернувшиеся на кулдаун - в min-куче
+    по моменту готовности. Кулдаун ставится на всю прокси по time_condition того запроса, который ее брал,
+    то есть до его окончания прокси не выдается и другим задачам. Без task_key кулдаун не учитывается
+    """
+
+    def __init__(self, cooldown_ttl: Optional[float] = 3600.0, max_cooldown_keys: Optional[int] = 1000):
+        """
+        :param cooldown_ttl: через сколько секунд без использования забывается время использования по ключу
+        :param max_cooldown_keys: максимум ключей (task_key/хостов) в used_time одной прокси
+        """
+        self.cooldown_ttl = cooldown_ttl
+        self.max_cooldown_keys = max_cooldown_keys
+        self.ready: Deque[ProxySession] = deque()
+        # (time.monotonic() готовности, seq, прокси)
+        self.cooling: List[Tuple[float, int, ProxySession]] = []
+        # выданная прокси -> time_condition запроса, который ее взял
+        self._leases: Dict[ProxySession, float] = {}
+        # (future ожидающего, прокси, которые ему не выдавать)
+        self._waiters: Deque[Tuple[asyncio.Future, Optional[Set[ProxySession]]]] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._seq = itertools.count()
+
+    def _promote(self):
+        # Переносим в ready все прокси, у которых закончился кулдаун
+        now = time.monotonic()
+        while self.cooling and self.cooling[0][0] <= now:
+            self._put_ready(heapq.heappop(self.cooling)[2])
+
+    def _put_ready(self, proxy: ProxySession):
+        while self._waiters and self._waiters[0][0].done():
+            self._waiters.popleft()
+        for i, (waiter, exclude) in enumerate(self._waiters):
+            if waiter.done() or (exclude and proxy in exclude):
+                continue
+            del self._waiters[i]
+            waiter.set_result(proxy)
+            return
+        self.ready.append(proxy)
+
+    def _schedule_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._waiters and self.cooling:
+            delay = max(self.cooling[0][0] - time.monotonic(), 0.0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._promote()
+        self._schedule_timer()
+
+    def _pop_ready(self, exclude: Optional[Set[ProxySession]] = None) -> Optional[ProxySession]:
+        if self.cooling:
+            self._promote()
+        if not exclude:
+            return self.ready.popleft() if self.ready else None
+        for i, proxy in enumerate(self.ready):
+            if proxy not in exclude:
+                del self.ready[i]
+                return proxy
+        return None
+
+    def _lease(self, proxy: ProxySession, task_key: Optional[str], last_used: float) -> ProxySession:
+        proxy.in_flight += 1  # по нему контроллер понимает, что удаленная прокси еще в работе
+        if task_key is not None:
+            self._leases[proxy] = last_used
+        return proxy
 
     async def add(self, proxy: ProxySession) -> None:
-        self.queue.put_nowait(proxy)
+        proxy.in_rotation = True
+        self._put_ready(proxy)
+
+    async def add_many(self, proxies: List[ProxySession]) -> None:
+        for proxy in proxies:
+            proxy.in_rotation = True
+            self._put_ready(proxy)
+
+    async def _wait(
+            self, timeout: Optional[float], exclude: Optional[Set[ProxySession]] = None
+    ) -> ProxySession:
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, exclude)
+        self._waiters.append(entry)
+        self._schedule_timer()
+        try:
+            return await asyncio.wait_for(waiter, timeout=timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Прокси уже передали, но ожидающий ушел - отдаем ее следующему
+                self._put_ready(waiter.result())
+            else:
+                try:
+                    self._waiters.remove(entry)
+                except ValueError:
+                    pass
+            raise
 
     async def get(
             self,
@@ -18,14 +115,100 @@ class ProxyQueueWithoutConditions(AbstractQueue):
             task_key: str = None,
             last_used: float = 1.0,
             other_conditions: Optional[Dict[str, str]] = None,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+            exclude: Optional[Set[ProxySession]] = None,
     ):
-        if timeout is not None:
+        proxy = self._pop_ready(exclude)
+        if proxy is None:
             try:
-                return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                # Исключенные прокси _put_ready этому ожидающему не передает
+                proxy = await self._wait(timeout, exclude)
             except asyncio.TimeoutError:
                 raise TimeoutError(f"Timeout ({timeout}s) while waiting for proxy.")
-        else:
-            return await self.queue.get()
+        return self._lease(proxy, task_key, last_used)
 
     async def release(self, proxy: ProxySession, task_key: str = None) -> None:
-        await self.add(proxy)
+        cooldown = self._leases.pop(proxy, 0.0)
+        proxy.in_flight = max(proxy.in_flight - 1, 0)
+        if not proxy.in_rotation:
+            return
+        if task_key is not None:
+            proxy.update_used_time(task_key)
+            proxy.maybe_prune_cooldowns(self.cooldown_ttl, self.max_cooldown_keys)
+        if cooldown > 0:
+            heapq.heappush(self.cooling, (time.monotonic() + cooldown, next(self._seq), proxy))
+            self._schedule_timer()
+        else:
+            self._put_ready(proxy)
+
+    async def remove(self, proxy: ProxySession) -> None:
+        # Выданная прокси в очереди не лежит - достаточно не вернуть ее при release
+        proxy.in_rotation = False
+        try:
+            self.ready.remove(proxy)
+        except ValueError:
+            pass
+        if any(entry[2] is proxy for entry in self.cooling):
+            self.cooling = [entry for entry in self.cooling if entry[2] is not proxy]
+            heapq.heapify(self.cooling)
+
+    def cooldowns(self) -> Dict[ProxySession, float]:
+        """:return: прокси на кулдауне -> time.monotonic() его окончания"""
+        return {proxy: ready_at for ready_at, _, proxy in self.cooling}
+
+    async def add_cooling(self, proxy: ProxySession, ready_at: float) -> None:
+        """Добавляет прокси сразу на кулдаун до ready_at (time.monotonic()), например при восстановлении"""
+        proxy.in_rotation = True
+        heapq.heappush(self.cooling, (ready_at, next(self._seq), proxy))
+        self._schedule_timer()
+
+    async def update_conditions(self, proxy: ProxySession, other_conditions: Dict[str, str]) -> None:
+        # Условия очередь не учитывает
+        proxy.proxy_data.other_conditions = other_conditions
+
+    def upcoming(self, task_key: str, last_used: float, within: float, limit: int) -> List[ProxySession]:
+        """
+        Прокси, которые первыми пойдут в выдачу: готовые и те, у кого кулдаун кончится в ближайшие within секунд.
+        Кулдаун здесь общий на прокси, так что task_key и last_used не нужны
+        """
+        result = list(itertools.islice(self.ready, limit))
+        horizon = time.monotonic() + within
+        for ready_at, _, proxy in heapq.nsmallest(limit - len(result), self.cooling):
+            if ready_at > horizon:
+                break
+            result.append(proxy)
+        return result
+
+    async def get_many(
+            self,
+            n: int,
+            task_key: str = None,
+            last_used: float = 1.0,
+            other_conditions: Optional[Dict[str, str]] = None,
+            timeout: float | None = 5.0,
+            min_count: int = 1,
+            priority: int = 0,
+            rate_limit: Optional[RateLimit] = None,
+    ) -> List[ProxySession]:
+        proxies = []
+        while len(proxies) < n:
+            proxy = self._pop_ready()
+            if proxy is None:
+                break
+            proxies.append(proxy)
+        try:
+            async with asyncio.timeout(timeout):
+                while len(proxies) < min(min_count, n):
+                    proxies.append(await self._wait(None))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            for proxy in proxies:
+                self._put_ready(proxy)
+            if isinstance(e, asyncio.TimeoutError):
+                raise TimeoutError(f"Timeout ({timeout}s) while waiting for {min_count} proxies.")
+            raise
+        return [self._lease(proxy, task_key, last_used) for proxy in proxies]
+
+    async def release_many(self, proxies: List[ProxySession], task_key: str = None) -> None:
+        for proxy in proxies:
+            await self.release(proxy, task_key)
@@ -0,0 +1,100 @@
+import itertools
+import random
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional
+
+from proxy_manager.proxy_storage import ProxyStorage
+from proxy_manager.types import ProxySession
+
+
+class SelectionPolicy(ABC):
+    """
+    Выбор прокси среди готовых. Пул отдает политике не больше window первых готовых прокси
+    (от давно использованных к недавним), поэтому выбор не зависит от размера пула
+    """
+    window: int = 1
+
+    @abstractmethod
+    def choose(self, candidates: List[ProxySession], task_key: str) -> ProxySession:
+        pass
+
+    def pick(self, eligible: Iterator[ProxySession], task_key: str) -> Optional[ProxySession]:
+        """Выбор из потока готовых прокси: по умолчанию собирает окно и отдает его choose"""
+        candidates = list(itertools.islice(eligible, self.window))
+        return self.choose(candidates, task_key) if candidates else None
+
+
+class LeastRecentlyUsedPolicy(SelectionPolicy):
+    """
+    Самая давно использованная прокси. С хранилищем пропускает прокси с оценкой здоровья ниже min_health,
+    если в окне есть здоровая, так что медленные по фоновым пробам прокси выдаются реже
+    """
+
+    def __init__(self, storage: Optional[ProxyStorage] = None, min_health: float = 0.5, window: int = 4):
+        """
+        :param storage: откуда брать оценку здоровья, None - чистый LRU с окном 1
+        :param min_health: оценка здоровья, ниже которой прокси уступает следующей в окне
+        """
+        self.storage = storage
+        self.min_health = min_health
+        self.window = window if storage is not None else 1
+
+    def _healthy(self, proxy: ProxySession) -> bool:
+        return self.storage is None or self.storage.get_health_score(proxy.proxy_data) >= self.min_health
+
+    def choose(self, candidates: List[ProxySession], task_key: str) -> ProxySession:
+        return next((proxy for proxy in candidates if self._healthy(proxy)), candidates[0])
+
+    def pick(self, eligible: Iterator[ProxySession], task_key: str) -> Optional[ProxySession]:
+        # Окно собирается только если первая прокси нездорова - обычно хватает одной
+        first = next(eligible, None)
+        if first is None or self._healthy(first):
+            return first
+        return next((proxy for proxy in itertools.islice(eligible, self.window - 1) if self._healthy(proxy)), first)
+
+
+class PowerOfTwoChoicesPolicy(SelectionPolicy):
+    """
+    Две случайные прокси из окна, берется та, у которой выше доля успехов с учетом оценки здоровья.
+    Пока фоновых проб нет, сравнивается только доля ошибок
+    """
+
+    def __init__(self, storage: ProxyStorage, window: int = 8):
+        self.storage = storage
+        self.window = window
+
+    def score(self, proxy: ProxySession) -> float:
+        return (1.0 - self.storage.get_error_rate(proxy.proxy_data)) * self.storage.get_health_score(proxy.proxy_data)
+
+    def choose(self, candidates: List[ProxySession], task_key: str) -> ProxySession:
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        if self.score(second) > self.score(first):
+            return second
+        return first
+
+
+class LatencyWeightedPolicy(SelectionPolicy):
+    """Случайный выбор из окна с весом доля успехов * оценка здоровья / задержка"""
+
+    def __init__(self, storage: ProxyStorage, window: int = 8, default_latency: float = 1.0):
+        """
+        :param default_latency: задержка для прокси, по которым еще нет замеров
+        """
+        self.storage = storage
+        self.window = window
+        self.default_latency = default_latency
+
+    def weight(self, proxy: ProxySession) -> float:
+        latency = self.storage.get_latency(proxy.proxy_data)
+        if latency is None:
+            latency = self.default_latency
+        success_rate = 1.0 - self.storage.get_error_rate(proxy.proxy_data)
+        return success_rate * self.storage.get_health_score(proxy.proxy_data) / max(latency, 1e-3)
+
+    def choose(self, candidates: List[ProxySession], task_key: str) -> ProxySession:
+        if len(candidates) == 1:
+            return candidates[0]
+        weights = [self.weight(proxy) for proxy in candidates]
+        return random.choices(candidates, weights=weights)[0]
@@ -0,0 +1,120 @@
+"""
+Снимок состояния пула в SQLite, чтобы после перезапуска не выдавать заведомо мертвые прокси и не ломать
+кулдауны задач. В снимке по каждой прокси: статистика из ProxyStorage, где прокси была (в пуле, на фоновой
+проверке, с открытым выключателем или списана), время последнего использования по task_key и кулдаун
+очереди без условий. Моменты времени хранятся по time.time(), при восстановлении переводятся в монотонное.
+
+Снимок перезаписывается целиком в одной транзакции, чтение и запись блокирующие - контроллер вызывает их
+через asyncio.to_thread.
+"""
+import json
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from proxy_manager.proxy_storage import ProxyStats
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS proxies (
+    proxy TEXT NOT NULL,
+    conditions TEXT,
+    max_concurrency INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    {", ".join(ProxyStats.FIELDS)},
+    tasks TEXT,
+    check_attempt INTEGER,
+    breaker_retry_at REAL,
+    breaker_trips INTEGER NOT NULL,
+    cooling_until REAL
+)
+"""
+_COLUMNS = 9 + len(ProxyStats.FIELDS)
+
+# Где была прокси в момент снимка
+IN_POOL = "pool"
+IN_CHECK = "check"  # на фоновой проверке, см. check_attempt
+IN_BREAKER = "breaker"  # выведена открытым выключателем до breaker_retry_at
+RETIRED = "retired"  # не прошла max_attempts проверок
+
+
+@dataclass
+class ProxyState:
+    """Сохраняемое состояние одной прокси"""
+    proxy: str  # ip:port:user:password
+    conditions: Dict[str, str] = field(default_factory=dict)
+    max_concurrency: int = 1
+    status: str = IN_POOL
+    counters: Optional[tuple] = None  # ProxyStats.counters(), None - статистики не было
+    task_totals: Dict[str, Tuple[int, int]] = field(default_factory=dict)  # task_key -> (успехи, ошибки)
+    used_time: Dict[str, float] = field(default_factory=dict)  # task_key -> time.time() последнего использования
+    check_attempt: Optional[int] = None  # сколько проверок уже прошла, для status == IN_CHECK
+    breaker_retry_at: Optional[float] = None  # time.time() перехода в half-open, для status == IN_BREAKER
+    breaker_trips: int = 0
+    cooling_until: Optional[float] = None  # time.time() конца кулдауна в очереди без условий
+
+
+class SnapshotStore:
+    def __init__(self, path: str):
+        """
+        :param path: файл SQLite, создается при первой записи
+        """
+        self.path = path
+
+    def write(self, states: List[ProxyState]):
+        no_counters = (None,) * len(ProxyStats.FIELDS)
+        dumps = json.dumps
+        rows = [
+            (
+                state.proxy,
+                dumps(state.conditions) if state.conditions else None,
+                state.max_concurrency,
+                state.status,
+                *(state.counters or no_counters),
+                # Счетчики задач и кулдауны одной строкой JSON - при восстановлении один разбор на прокси
+                dumps((state.task_totals, state.used_time)) if state.task_totals or state.used_time else None,
+                state.check_attempt,
+                state.breaker_retry_at,
+                state.breaker_trips,
+                state.cooling_until,
+            )
+            for state in states
+        ]
+        with closing(sqlite3.connect(self.path)) as connection:
+            with connection:
+                connection.execute(SCHEMA)
+                connection.execute("DELETE FROM proxies")
+                connection.executemany(f"INSERT INTO proxies VALUES ({', '.join('?' * _COLUMNS)})", rows)
+
+    def read(self) -> List[ProxyState]:
+        """:return: состояния из последнего снимка, пустой список если снимка нет"""
+        return list(self.states(self.read_rows()))
+
+    def read_rows(self) -> List[tuple]:
+        """:return: строки последнего снимка без разбора, разбирает их states"""
+        with closing(sqlite3.connect(self.path)) as connection:
+            connection.execute(SCHEMA)
+            return connection.execute("SELECT * FROM proxies").fetchall()
+
+    @staticmethod
+    def states(rows: Iterable[tuple]) -> Iterator[ProxyState]:
+        """Разбирает строки по одной, чтобы восстановление шло сразу, без промежуточного списка состояний"""
+        loads = json.loads
+        fields = len(ProxyStats.FIELDS)
+        for row in rows:
+            counters = row[4:4 + fields]
+            task_totals, used_time = loads(row[4 + fields]) if row[4 + fields] else ({}, {})
+            check_attempt, breaker_retry_at, breaker_trips, cooling_until = row[5 + fields:]
+            yield ProxyState(
+                row[0],
+                loads(row[1]) if row[1] else {},
+                row[2],
+                row[3],
+                None if counters[0] is None else counters,
+                task_totals,
+                used_time,
+                check_attempt,
+                breaker_retry_at,
+                breaker_trips,
+                cooling_until,
+            )
@@ -1,12 +1,26 @@
 import asyncio
+import heapq
+import math
 import time
+from array import array
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, Union, Optional
+from enum import Enum
+from typing import Deque, Dict, List, Set, Tuple, Union, Optional
 
 import aiohttp
 import httpx
 
 
+def cooldown_key(task_key: str, host: Optional[str] = None) -> str:
+    """
+    Ключ кулдауна: task_key или task_key@host для отдельного кулдауна на каждый сайт
+    """
+    if host is None:
+        return task_key
+    return f"{task_key}@{host}"
+
+
 @dataclass(eq=False)
 class ProxyData:
     ip: str
@@ -23,6 +37,246 @@ class ProxyData:
             return other.ip == self.ip and other.port == self.port
         return False
 
+    def as_str(self) -> str:
+        """:return: строка в стандартном формате ip:port:user:password"""
+        return f"{self.ip}:{str(self.port)}:{self.username}:{self.password}"
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Ограничение частоты: rate запросов в секунду с запасом burst"""
+    rate: float
+    burst: int = 1
+
+
+@dataclass(frozen=True)
+class HealthCheckPolicy:
+    """
+    Фоновая проверка выведенных прокси: не больше concurrency проверок одновременно,
+    перед попыткой n пауза backoff * 2^n (не больше max_backoff), после max_attempts неудач прокси забывается.
+    handshake_target - куда делать CONNECT при проверке только SOCKS5 рукопожатием, None - полный HTTPS запрос
+    """
+    concurrency: int = 20
+    backoff: float = 5.0
+    max_backoff: float = 900.0
+    max_attempts: int = 10
+    handshake_target: Optional[Tuple[str, int]] = ("example.com", 443)
+
+    def delay(self, attempt: int) -> float:
+        return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+
+@dataclass(frozen=True)
+class CircuitBreakerPolicy:
+    """
+    Прокси выводится из ротации (open), если за последние window секунд было не меньше min_requests запросов
+    и доля ошибок среди них не меньше failure_rate. Через open_timeout * 2^(неудачных пробных подряд)
+    (не больше max_open_timeout) прокси возвращается в пул для одного пробного запроса (half-open):
+    успех закрывает выключатель, ошибка снова открывает
+    """
+    failure_rate: float = 0.5
+    min_requests: int = 5
+    window: float = 30.0
+    open_timeout: float = 10.0
+    max_open_timeout: float = 300.0
+
+    def timeout(self, trips: int) -> float:
+        return min(self.open_timeout * 2 ** trips, self.max_open_timeout)
+
+
+class BreakerState(Enum):
+    closed = 1
+    open = 2
+    half_open = 3
+
+
+@dataclass
+class CircuitBreaker:
+    """Выключатель одной прокси, см. CircuitBreakerPolicy"""
+    # (time.monotonic(), успех) запросов в окне; maxlen держит память постоянной при любом трафике
+    outcomes: Deque[Tuple[float, bool]] = field(default_factory=lambda: deque(maxlen=256))
+    failures: int = 0  # ошибок среди outcomes
+    opened_at: Optional[float] = None  # time.monotonic() открытия, None - закрыт
+    trips: int = 0  # неудачных пробных запросов подряд
+
+    def state(self, policy: CircuitBreakerPolicy, now: float) -> BreakerState:
+        if self.opened_at is None:
+            return BreakerState.closed
+        if now < self.retry_at(policy):
+            return BreakerState.open
+        return BreakerState.half_open
+
+    def retry_at(self, policy: CircuitBreakerPolicy) -> float:
+        """:return: момент (time.monotonic()) перехода в half-open"""
+        return self.opened_at + policy.timeout(self.trips)
+
+    def record(self, ok: bool, policy: CircuitBreakerPolicy, now: float):
+        state = self.state(policy, now)
+        if state is BreakerState.half_open:
+            if ok:
+                self.opened_at = None
+                self.trips = 0
+            else:
+                self.opened_at = now
+                self.trips += 1
+            return
+        if state is BreakerState.open:
+            return  # ответы запросов, выданных до открытия
+        if len(self.outcomes) == self.outcomes.maxlen and not self.outcomes[0][1]:
+            self.failures -= 1  # запись вытеснится при append
+        self.outcomes.append((now, ok))
+        if not ok:
+            self.failures += 1
+        while self.outcomes and self.outcomes[0][0] < now - policy.window:
+            if not self.outcomes.popleft()[1]:
+                self.failures -= 1
+        if len(self.outcomes) >= policy.min_requests and self.failures >= policy.failure_rate * len(self.outcomes):
+            self.opened_at = now
+            self.outcomes.clear()
+            self.failures = 0
+
+
+@dataclass(frozen=True)
+class HedgePolicy:
+    """
+    Если первая прокси не ответила за задержку хеджа, тот же запрос уходит через вторую, побеждает первый ответ.
+    delay=None - задержка равна квантилю quantile задержек последних запросов task_key,
+    пока замеров меньше min_samples - fallback_delay
+    """
+    delay: Optional[float] = None
+    quantile: float = 0.95
+    min_samples: int = 20
+    fallback_delay: float = 1.0
+    min_delay: float = 0.01
+
+    def hedge_delay(self, window: Optional["LatencyWindow"]) -> float:
+        if self.delay is not None:
+            return self.delay
+        if window is None or len(window.samples) < self.min_samples:
+            return self.fallback_delay
+        return max(window.quantile(self.quantile), self.min_delay)
+
+
+@dataclass
+class LatencyWindow:
+    """Задержки последних запросов для квантилей, память постоянная"""
+    samples: Deque[float] = field(default_factory=lambda: deque(maxlen=256))
+
+    def observe(self, latency: float):
+        self.samples.append(latency)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class TimingMetric(Enum):
+    wait = 0  # ожидание выдачи прокси в acquire
+    hold = 1  # от выдачи прокси до ее возврата
+    request = 2  # сам http запрос в request
+
+
+# Гистограмма задержек в духе HDR: 4 корзины на каждое удвоение от 1 мс, относительная ошибка до 19%.
+# Корзина 0 - до 1 мс, последняя собирает все дольше ~55 с
+HISTOGRAM_MIN = 0.001
+HISTOGRAM_SUB_BUCKETS = 4
+HISTOGRAM_BUCKETS = 64
+
+
+def histogram_bucket(seconds: float) -> int:
+    if seconds <= HISTOGRAM_MIN:
+        return 0
+    return min(int(math.log2(seconds / HISTOGRAM_MIN) * HISTOGRAM_SUB_BUCKETS) + 1, HISTOGRAM_BUCKETS - 1)
+
+
+def histogram_value(bucket: int) -> float:
+    """:return: верхняя граница корзины, секунды"""
+    return HISTOGRAM_MIN * 2 ** (bucket / HISTOGRAM_SUB_BUCKETS)
+
+
+@dataclass
+class LatencyHistogram:
+    counts: array = field(default_factory=lambda: array("I", [0] * HISTOGRAM_BUCKETS))
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, seconds: float):
+        self.counts[histogram_bucket(seconds)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """:return: верхняя граница корзины, в которую попал квантиль q, None если замеров нет"""
+        total = self.count
+        if total == 0:
+            return None
+        rank = max(math.ceil(q * total), 1)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return histogram_value(bucket)
+        return histogram_value(HISTOGRAM_BUCKETS - 1)
+
+
+@dataclass(frozen=True)
+class StatsWindowPolicy:
+    """
+    Скользящее окно статистики прокси по задаче: window секунд, поделенные на slots частей.
+    Старейшая часть выбрасывается целиком, так что окно покрывает от window - window / slots до window секунд
+    """
+    window: float = 300.0
+    slots: int = 5
+
+
+@dataclass
+class WindowStats:
+    """Срез скользящего окна: успехи, ошибки и гистограммы задержек"""
+    success: int = 0
+    errors: int = 0
+    wait: LatencyHistogram = field(default_factory=LatencyHistogram)
+    hold: LatencyHistogram = field(default_factory=LatencyHistogram)
+    request: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    @property
+    def success_rate(self) -> Optional[float]:
+        """:return: доля успешных запросов в окне, None если запросов не было"""
+        total = self.success + self.errors
+        return None if total == 0 else self.success / total
+
+    def histogram(self, metric: TimingMetric) -> LatencyHistogram:
+        return getattr(self, metric.name)
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    updated: float  # time.monotonic() последнего пересчета
+
+    @classmethod
+    def full(cls, rate_limit: RateLimit) -> "TokenBucket":
+        return cls(rate_limit.rate, rate_limit.burst, rate_limit.burst, time.monotonic())
+
+    def _tokens_at(self, now: float) -> float:
+        return min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+    def ready_at(self, now: float) -> float:
+        """
+        :return: момент (time.monotonic()), когда в корзине будет целый токен, 0 если он есть уже сейчас
+        """
+        tokens = self._tokens_at(now)
+        if tokens >= 1:
+            return 0.0
+        return now + (1 - tokens) / self.rate
+
+    def take(self, now: float):
+        self.tokens = self._tokens_at(now) - 1
+        self.updated = now
+
 
 @dataclass
 class ProxySession:
@@ -30,16 +284,60 @@ class ProxySession:
     proxy_data: ProxyData
     session: Union[aiohttp.ClientSession, httpx.AsyncClient]
     used_time: Dict[str, float] = field(default_factory=dict)
+    # то же время по time.monotonic(), по нему считаются кулдауны (не зависит от перевода часов)
+    used_monotonic: Dict[str, float] = field(default_factory=dict, repr=False)
+    max_concurrency: int = 1  # сколько запросов прокси может обслуживать одновременно
+    in_flight: int = 0
+    in_rotation: bool = True  # False - прокси выведена из пула и после release не возвращается
+    # task_key -> корзина токенов для запросов с rate_limit
+    buckets: Dict[str, TokenBucket] = field(default_factory=dict, repr=False)
+    pruned_at: float = field(default=0.0, repr=False)  # time.monotonic() последней чистки кулдаунов
+    trial: bool = False  # пробный запрос после открытия выключателя - выдается только в один слот
+
+    @property
+    def slots(self) -> int:
+        return 1 if self.trial else self.max_concurrency
 
     def __hash__(self):
         return hash(self.proxy_data)
 
-    def check_time(self, task_key: str, condition: float) -> bool:
+    def last_used_monotonic(self, task_key: str) -> Optional[float]:
         try:
-            elapsed_time = time.time() - self.used_time[task_key]
-            return elapsed_time >= condition
+            return self.used_monotonic[task_key]
         except KeyError:
-            return True
+            pass
+        try:
+            # used_time выставлен снаружи (например, восстановлен) - переводим в монотонное время
+            return self.used_time[task_key] - time.time() + time.monotonic()
+        except KeyError:
+            return None
+
+    def check_time(self, task_key: str, condition: float) -> bool:
+        return time.monotonic() >= self.available_at(task_key, condition)
+
+    def available_at(self, task_key: str, condition: float) -> float:
+        """
+        :return: момент (time.monotonic()), начиная с которого прокси снова подходит для task_key
+        """
+        last_used = self.last_used_monotonic(task_key)
+        if last_used is None:
+            return 0.0
+        return last_used + condition
+
+    def rate_ready_at(self, task_key: str, rate_limit: RateLimit) -> float:
+        """
+        :return: момент (time.monotonic()), когда по task_key будет доступен токен
+        """
+        bucket = self.buckets.get(task_key)
+        if bucket is None:
+            return 0.0
+        return bucket.ready_at(time.monotonic())
+
+    def take_token(self, task_key: str, rate_limit: RateLimit):
+        bucket = self.buckets.get(task_key)
+        if bucket is None or bucket.rate != rate_limit.rate or bucket.burst != rate_limit.burst:
+            bucket = self.buckets[task_key] = TokenBucket.full(rate_limit)
+        bucket.take(time.monotonic())
 
     def check_other(self, conditions: Dict[str, str]) -> bool:
         if conditions is None:
@@ -49,10 +347,74 @@ class ProxySession:
                 return False
         return True
 
+    def forget(self, task_key: str):
+        self.used_time.pop(task_key, None)
+        self.used_monotonic.pop(task_key, None)
+        self.buckets.pop(task_key, None)
+
+    def prune_cooldowns(self, ttl: Optional[float], max_keys: Optional[int]):
+        """
+        Удаляет кулдауны, которые уже ни на что не влияют, чтобы used_time не рос бесконечно
+        :param ttl: забыть ключи, не использовавшиеся дольше ttl секунд.
+         Должен быть больше самого большого time_condition (и burst / rate)
+        :param max_keys: максимум ключей на прокси, лишние забываются начиная с самых старых
+        """
+        now = time.monotonic()
+        self.pruned_at = now
+        if ttl is not None:
+            for task_key in [key for key in self.used_time if self.last_used_monotonic(key) + ttl < now]:
+                self.forget(task_key)
+        if max_keys is not None and len(self.used_time) > max_keys:
+            # Чистим с запасом в четверть лимита, чтобы не сортировать ключи на каждом release
+            extra = len(self.used_time) - max_keys * 3 // 4
+            for task_key in heapq.nsmallest(extra, self.used_time, key=self.last_used_monotonic):
+                self.forget(task_key)
+
+    def maybe_prune_cooldowns(self, ttl: Optional[float], max_keys: Optional[int]):
+        """prune_cooldowns, если ключей больше max_keys или с прошлой чистки прошло min(ttl / 4, 60) секунд"""
+        if max_keys is not None and len(self.used_time) > max_keys:
+            self.prune_cooldowns(ttl, max_keys)
+        elif ttl is not None and time.monotonic() - self.pruned_at > min(ttl / 4, 60.0):
+            self.prune_cooldowns(ttl, max_keys)
+
     def update_used_time(self, task_key: Optional[str] = None):
         if task_key is None:
             task_key = "default"
         self.used_time[task_key] = time.time()
+        self.used_monotonic[task_key] = time.monotonic()
+
+
+@dataclass
+class ProxyBatch:
+    """Набор прокси из acquire_many. Упавшие прокси помечаются через mark_failed"""
+    proxies: List[ProxySession]
+    failed: Set[ProxySession] = field(default_factory=set)
+
+    def __iter__(self):
+        return iter(self.proxies)
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def __getitem__(self, index: int) -> ProxySession:
+        return self.proxies[index]
+
+    def mark_failed(self, proxy: ProxySession):
+        self.failed.add(proxy)
+
+
+@dataclass
+class LoadReport:
+    """Итог add_proxies"""
+    added: int = 0
+    rejected: List[Tuple[int, str, str]] = field(default_factory=list)  # (номер строки, строка, ошибка)
+
+
+@dataclass
+class SyncReport(LoadReport):
+    """Итог sync_proxies"""
+    removed: int = 0
+    updated: int = 0  # у оставшихся прокси сменились условия или логин
 
 
 @dataclass
@@ -61,9 +423,64 @@ class RequestProxy:
     task_key: str = "default"
     time: float = 1.0
     other_conditions: Dict[str, str] = field(default_factory=dict)
+    priority: int = 0  # меньше - важнее, как в asyncio.PriorityQueue
+    # lambda: внутри класса имя time занято полем выше
+    created_at: float = field(default_factory=lambda: time.monotonic())
+    seq: int = 0
+    rate_limit: Optional[RateLimit] = None  # если задан, вместо time действует ограничение частоты
+    exclude: Optional[Set[ProxySession]] = None  # прокси, которые этому запросу не отдавать
+    # запрос из get_many: выданная ему прокси добавляется в общий exclude, чтобы в пачке не было повторов
+    distinct: bool = False
+
+    def excludes(self, proxy: ProxySession) -> bool:
+        return self.exclude is not None and proxy in self.exclude
+
+    def effective_priority(self, now: float, aging_interval: Optional[float]) -> float:
+        """
+        Приоритет с учетом старения: каждые aging_interval секунд ожидания поднимают запрос на уровень
+        """
+        if not aging_interval:
+            return self.priority
+        return self.priority - (now - self.created_at) / aging_interval
+
+    def ready_at(self, proxy: ProxySession) -> float:
+        """
+        :return: момент (time.monotonic()), когда прокси станет подходить по времени
+        """
+        if self.rate_limit is not None:
+            return proxy.rate_ready_at(self.task_key, self.rate_limit)
+        return proxy.available_at(self.task_key, self.time)
 
     def match_proxy(self, proxy: ProxySession) -> bool:
+        if self.excludes(proxy):
+            return False
+        if self.rate_limit is not None:
+            return (
+                    proxy.rate_ready_at(self.task_key, self.rate_limit) <= time.monotonic()
+                    and proxy.check_other(self.other_conditions)
+            )
         if proxy.check_time(self.task_key, self.time):
             if proxy.check_other(self.other_conditions):
                 return True
         return False
+
+
+@dataclass
+class WaitStats:
+    """Статистика ожидания прокси для одного класса приоритета"""
+    count: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+    timeouts: int = 0
+
+    def observe(self, wait: float):
+        self.count += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    @property
+    def avg_wait(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total_wait / self.count
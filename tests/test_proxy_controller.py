@@ -2,11 +2,33 @@
 import pytest
 import asyncio
 import time
+import httpx
 from unittest.mock import AsyncMock, patch
-from proxy_manager.proxy_storage import ProxyStorage, ProxyData
-from proxy_manager.types import ProxySession, RequestProxy
+from proxy_manager.proxy_storage import ProxyStorage, ProxyData, RollingStats
+from proxy_manager.types import (
+    BreakerState,
+    CircuitBreakerPolicy,
+    HealthCheckPolicy,
+    HedgePolicy,
+    LatencyHistogram,
+    LatencyWindow,
+    ProxySession,
+    RateLimit,
+    RequestProxy,
+    StatsWindowPolicy,
+    TimingMetric,
+    WindowStats,
+)
+from proxy_manager.proxy_check import ProxyChecker
 from proxy_manager.queues.queue_without_conditions import ProxyQueueWithoutConditions
+from proxy_manager.queues.custom_queue import ProxyPool
+from proxy_manager.queues.selection import LatencyWeightedPolicy, LeastRecentlyUsedPolicy, PowerOfTwoChoicesPolicy
 from proxy_manager.proxy_controller import ProxyController, HttpClientType, ProxyError
+from proxy_manager.broker import BrokerClient, ProxyBroker, decode_acquire, encode_acquire
+from proxy_manager.prober import ProxyProber
+from proxy_manager.prewarm import ConnectionPrewarmer
+from proxy_manager.clients import ClientRegistry, ClientState
+from proxy_manager.snapshot import ProxyState
 
 
 class TestProxyStorage:
@@ -52,13 +74,13 @@ class TestProxyStorage:
         storage = ProxyStorage()
         proxy_data = storage.add_proxy_str("192.168.1.1:8080:user:pass")
 
-        # Первый вызов должен инициализировать счетчики
+        # Первый вызов заводит счетчики задачи и уже засчитывается
         storage.report_status(proxy_data, True, "new_task")
 
         proxy_info = storage.proxy_dict[proxy_data]
         assert "new_task_success_request" in proxy_info
         assert "new_task_error_request" in proxy_info
-        assert proxy_info["new_task_success_request"] == 0
+        assert proxy_info["new_task_success_request"] == 1
         assert proxy_info["new_task_error_request"] == 0
 
     def test_report_status_counters(self):
@@ -74,7 +96,7 @@ class TestProxyStorage:
             storage.report_status(proxy_data, False, "test_task")
 
         proxy_info = storage.proxy_dict[proxy_data]
-        assert proxy_info["test_task_success_request"] == 2
+        assert proxy_info["test_task_success_request"] == 3
         assert proxy_info["test_task_error_request"] == 2
         assert proxy_info["error_sequence"] == 2
 
@@ -85,9 +107,64 @@ class TestProxyStorage:
         storage.report_status(proxy_data, False, "test_task")
         storage.report_status(proxy_data, False, "test_task")
 
-        assert storage.proxy_dict[proxy_data]["test_task_error_request"] == 1
+        assert storage.proxy_dict[proxy_data]["test_task_error_request"] == 2
         assert storage.proxy_dict[proxy_data]["error_sequence"] == 2
 
+    def test_get_proxy_by_str_after_credentials_change(self):
+        storage = ProxyStorage()
+        proxy_data = storage.add_proxy_str("192.168.1.1:8080:user:pass")
+        storage.report_status(proxy_data, True, "task_a")
+        storage.report_status(proxy_data, False, "task_b")
+
+        storage.update_credentials(proxy_data, "user2", "pass2")
+
+        assert storage.get_proxy_by_str("192.168.1.1:8080:user2:pass2") is proxy_data
+        with pytest.raises(ValueError):
+            storage.get_proxy_by_str("192.168.1.1:8080:user:pass")
+        assert storage.get_task_counters(proxy_data, "task_a") == (1, 0)
+        assert storage.get_task_counters(proxy_data, "task_b") == (0, 1)
+        assert storage.proxy_dict[proxy_data].as_dict() == {
+            "error_sequence": 1, "success_total": 1, "error_total": 1, "hedge_lost": 0,
+            "task_a_success_request": 1, "task_a_error_request": 0,
+            "task_b_success_request": 0, "task_b_error_request": 1,
+        }
+
+        storage.remove_proxy(proxy_data)
+        with pytest.raises(ValueError):
+            storage.get_proxy_by_str("192.168.1.1:8080:user2:pass2")
+
+    def test_rolling_window_expires_old_slots(self):
+        window = RollingStats(StatsWindowPolicy(window=60.0, slots=3))
+        window.record(True, now=5.0)
+        window.record(False, now=5.0)
+        window.observe(TimingMetric.request, 0.1, now=5.0)
+        window.record(True, now=25.0)
+        window.observe(TimingMetric.request, 2.0, now=25.0)
+        # Отрезок гистограммы растет в обе стороны
+        window.observe(TimingMetric.wait, 0.5, now=25.0)
+        window.observe(TimingMetric.wait, 0.01, now=25.0)
+        window.observe(TimingMetric.wait, 0.5, now=25.0)
+
+        stats = WindowStats()
+        window.add_to(stats, now=59.0)
+        assert (stats.success, stats.errors) == (2, 1)
+        assert stats.request.count == 2
+        assert 0.1 <= stats.request.quantile(0.5) < 0.12
+        assert 2.0 <= stats.request.quantile(0.99) < 2.4
+        assert stats.wait.count == 3
+        assert 0.01 <= stats.wait.quantile(0.3) < 0.012
+        assert 0.5 <= stats.wait.quantile(0.9) < 0.6
+        assert stats.hold.count == 0
+
+        # Часть окна с первыми событиями устарела, ее позиция переиспользуется
+        window.record(True, now=65.0)
+        stats = WindowStats()
+        window.add_to(stats, now=65.0)
+        assert (stats.success, stats.errors) == (2, 0)
+        assert (stats.request.count, stats.wait.count) == (1, 3)
+        assert stats.success_rate == 1.0
+        assert LatencyHistogram().quantile(0.5) is None
+
     def test_proxy_is_valid(self):
         storage = ProxyStorage()
         proxy_data = storage.add_proxy_str("192.168.1.1:8080:user:pass")
@@ -211,6 +288,63 @@ class TestProxyQueueWithoutConditions:
         result = await queue.get(timeout=0.1)
         assert result == proxy_session
 
+    @pytest.mark.asyncio
+    async def test_release_honors_cooldown(self):
+        queue = ProxyQueueWithoutConditions()
+        first = ProxySession(ProxyData("192.168.1.1", 8080, "user", "pass"), AsyncMock())
+        second = ProxySession(ProxyData("192.168.1.2", 8080, "user", "pass"), AsyncMock())
+        await queue.add(first)
+        await queue.add(second)
+
+        proxy = await queue.get(task_key="task", last_used=0.2)
+        await queue.release(proxy, "task")
+        # Свободна только вторая, первая на кулдауне
+        assert await queue.get(task_key="task", last_used=0.2) == second
+        waiter = asyncio.create_task(queue.get(timeout=1.0, task_key="task", last_used=0.2))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        # Ожидающий просыпается по окончании кулдауна, без release
+        start = time.monotonic()
+        assert await waiter == first
+        assert time.monotonic() - start < 0.3
+
+    @pytest.mark.asyncio
+    async def test_release_prunes_cooldown_keys(self):
+        queue = ProxyQueueWithoutConditions(max_cooldown_keys=10)
+        proxy = ProxySession(ProxyData("10.0.3.1", 1080, "u", "p"), None)
+        await queue.add(proxy)
+        for i in range(50):
+            leased = await queue.get(task_key=f"task@host{i}.example", last_used=0, timeout=0.1)
+            await queue.release(leased, task_key=f"task@host{i}.example")
+        assert len(proxy.used_time) <= 10
+        assert "task@host49.example" in proxy.used_time
+        assert proxy.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_waiters_skip_excluded_proxy(self):
+        queue = ProxyQueueWithoutConditions()
+        first = ProxySession(ProxyData("192.168.1.1", 8080, "user", "pass"), AsyncMock())
+        second = ProxySession(ProxyData("192.168.1.2", 8080, "user", "pass"), AsyncMock())
+        await queue.add(first)
+        leased = await queue.get()
+        waiters = [asyncio.create_task(queue.get(timeout=1.0, exclude={first})) for _ in range(2)]
+        await asyncio.sleep(0.01)
+
+        # Оба ожидающих исключают вернувшуюся прокси - она остается в ready, а не ходит между ними
+        await queue.release(leased)
+        await asyncio.sleep(0.05)
+        assert list(queue.ready) == [first]
+        assert not any(waiter.done() for waiter in waiters)
+
+        await queue.add(second)
+        done, pending = await asyncio.wait(waiters, timeout=0.1)
+        assert [task.result() for task in done] == [second]
+        assert await queue.get(timeout=0.1) is first
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
 
 class TestProxyPool:
     @pytest.mark.asyncio
@@ -301,6 +435,386 @@ class TestProxyPool:
         await pool.stop()
 
 
+    @pytest.mark.asyncio
+    async def test_release_wakes_waiter_immediately(self):
+        pool = ProxyPool()
+        await pool.start()
+
+        proxy_session = ProxySession(ProxyData("192.168.1.1", 8080, "user", "pass"), AsyncMock())
+        await pool.add(proxy_session)
+        proxy = await pool.get(timeout=1.0)
+
+        waiter = asyncio.create_task(pool.get(task_key="other_task", timeout=1.0))
+        await asyncio.sleep(0)
+
+        start = time.monotonic()
+        await pool.release(proxy, "test_task")
+        result = await waiter
+
+        assert result == proxy_session
+        assert time.monotonic() - start < 0.05
+        await pool.stop()
+
+    @pytest.mark.asyncio
+    async def test_waiter_woken_when_cooldown_ends(self):
+        pool = ProxyPool()
+        await pool.start()
+
+        proxy_session = ProxySession(ProxyData("192.168.1.1", 8080, "user", "pass"), AsyncMock())
+        await pool.add(proxy_session)
+        proxy = await pool.get(task_key="test_task", timeout=1.0)
+        await pool.release(proxy, "test_task")
+
+        start = time.monotonic()
+        result = await pool.get(task_key="test_task", last_used=0.2, timeout=1.0)
+        elapsed = time.monotonic() - start
+
+        assert result == proxy_session
+        assert 0.15 <= elapsed < 0.3
+        assert proxy_session.in_flight == 1
+
+        # Выданная по таймеру прокси после release снова в пуле
+        await pool.release(result, "test_task")
+        assert proxy_session in pool.proxies
+        await pool.stop()
+
+    @pytest.mark.asyncio
+    async def test_condition_index_lookup(self):
+        pool = ProxyPool()
+
+        us_aws = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p", {"country": "US", "provider": "aws"}), None)
+        us_gcp = ProxySession(ProxyData("10.0.0.2", 1080, "u", "p", {"country": "US", "provider": "gcp"}), None)
+        eu_aws = ProxySession(ProxyData("10.0.0.3", 1080, "u", "p", {"country": "EU", "provider": "aws"}), None)
+        for proxy in (us_aws, us_gcp, eu_aws):
+            await pool.add(proxy)
+
+        result = await pool.get(other_conditions={"country": "US", "provider": "gcp"}, timeout=0.1)
+        assert result is us_gcp
+        assert us_gcp not in pool._index[("country", "US")]
+
+        result = await pool.get(other_conditions={"provider": "aws"}, timeout=0.1)
+        assert result is us_aws
+        assert ("country", "US") not in pool._index
+
+        await pool.release(us_aws, "test_task")
+        assert us_aws in pool._index[("country", "US")]
+        await pool.stop()
+
+    @pytest.mark.asyncio
+    async def test_next_available_in(self):
+        pool = ProxyPool()
+
+        first = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        second = ProxySession(ProxyData("10.0.0.2", 1080, "u", "p"), None)
+        assert pool.next_available_in("task", 1.0) is None
+
+        await pool.add(first)
+        await pool.add(second)
+        assert pool.next_available_in("task", 1.0) == 0.0
+
+        for _ in range(2):
+            proxy = await pool.get(task_key="task", last_used=1.0, timeout=0.1)
+            await pool.release(proxy, "task")
+
+        assert 0.9 < pool.next_available_in("task", 1.0) <= 1.0
+        assert pool.next_available_in("other_task", 1.0) == 0.0
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get(task_key="task", last_used=1.0, timeout=0.05)
+
+        # Дольше всех не использовавшаяся прокси отдается первой
+        assert await pool.get(task_key="task", last_used=0.0, timeout=0.1) is first
+        await pool.stop()
+
+    def test_check_time_ignores_wall_clock_jump(self):
+        session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        session.update_used_time("task")
+
+        with patch("proxy_manager.types.time.time", return_value=time.time() + 3600):
+            assert session.check_time("task", 10.0) == False
+
+    @pytest.mark.asyncio
+    async def test_priority_order_and_fifo(self):
+        pool = ProxyPool(aging_interval=None)
+        proxy_session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        served = []
+
+        async def waiter(name, priority):
+            proxy = await pool.get(task_key=name, last_used=0.0, timeout=1.0, priority=priority)
+            served.append(name)
+            await pool.release(proxy, name)
+
+        tasks = []
+        for name, priority in (("bulk_1", 10), ("bulk_2", 10), ("urgent", 0)):
+            tasks.append(asyncio.create_task(waiter(name, priority)))
+            await asyncio.sleep(0)
+
+        await pool.add(proxy_session)
+        await asyncio.gather(*tasks)
+
+        assert served == ["urgent", "bulk_1", "bulk_2"]
+        stats = pool.get_wait_stats()
+        assert stats[10]["count"] == 2
+        assert stats[0]["count"] == 1
+        assert stats[10]["avg_wait"] >= stats[0]["avg_wait"]
+
+    def test_request_aging(self):
+        future = asyncio.Future(loop=asyncio.new_event_loop())
+        old_bulk = RequestProxy(future, priority=10, created_at=time.monotonic() - 60.0)
+        new_urgent = RequestProxy(future, priority=0)
+
+        now = time.monotonic()
+        assert old_bulk.effective_priority(now, 5.0) < new_urgent.effective_priority(now, 5.0)
+        assert old_bulk.effective_priority(now, None) == 10
+
+    @pytest.mark.asyncio
+    async def test_get_many(self):
+        pool = ProxyPool()
+        sessions = [ProxySession(ProxyData(f"10.0.0.{i}", 1080, "u", "p"), None) for i in range(3)]
+        for proxy in sessions:
+            await pool.add(proxy)
+
+        proxies = await pool.get_many(5, timeout=0.1)
+        assert len(set(proxies)) == 3
+
+        # Недостаточно прокси до min_count - все взятое возвращается в пул
+        await pool.release_many(proxies[:1], "task")
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get_many(2, min_count=2, timeout=0.05)
+        assert len(pool.proxies) == 1
+
+        # Недостающие прокси приходят из release
+        waiter = asyncio.create_task(pool.get_many(2, min_count=2, timeout=1.0))
+        await asyncio.sleep(0)
+        await pool.release_many(proxies[1:], "task")
+        assert len(await waiter) == 2
+
+        # Прокси с несколькими слотами: пачка все равно из разных прокси
+        pool = ProxyPool()
+        first = ProxySession(ProxyData("10.0.1.1", 1080, "u", "p"), None, max_concurrency=4)
+        await pool.add(first)
+
+        # Свободные слоты той же прокси недостающих до min_count не закрывают
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get_many(3, last_used=0, min_count=3, timeout=0.05)
+        assert first.in_flight == 0
+
+        waiter = asyncio.create_task(pool.get_many(2, last_used=0, min_count=2, timeout=1.0))
+        await asyncio.sleep(0.01)
+        second = ProxySession(ProxyData("10.0.1.2", 1080, "u", "p"), None, max_concurrency=4)
+        await pool.add(second)
+        assert set(await waiter) == {first, second}
+
+    @pytest.mark.asyncio
+    async def test_power_of_two_choices_prefers_healthy_proxy(self):
+        storage = ProxyStorage()
+        good = storage.add_proxy_str("10.0.0.1:1080:u:p")
+        bad = storage.add_proxy_str("10.0.0.2:1080:u:p")
+        for _ in range(10):
+            storage.report_status(good, True, "task")
+            storage.report_status(bad, False, "task")
+
+        pool = ProxyPool(policy=PowerOfTwoChoicesPolicy(storage))
+        await pool.add(ProxySession(bad, None))
+        await pool.add(ProxySession(good, None))
+
+        proxy = await pool.get(timeout=0.1)
+        assert proxy.proxy_data == good
+
+    @pytest.mark.asyncio
+    async def test_least_recently_used_skips_unhealthy_proxy(self):
+        storage = ProxyStorage()
+        slow = storage.add_proxy_str("10.0.0.1:1080:u:p")
+        fast = storage.add_proxy_str("10.0.0.2:1080:u:p")
+        for _ in range(5):
+            storage.report_probe(slow, 4.0)
+
+        pool = ProxyPool(policy=LeastRecentlyUsedPolicy(storage))
+        await pool.add(ProxySession(slow, None))
+        await pool.add(ProxySession(fast, None))
+
+        # Медленная прокси первая по LRU, но уступает здоровой
+        assert (await pool.get(timeout=0.1)).proxy_data == fast
+        # Здоровых в окне нет - выдается медленная, а не таймаут
+        assert (await pool.get(timeout=0.1)).proxy_data == slow
+
+    def test_latency_weighted_policy(self):
+        storage = ProxyStorage()
+        fast = storage.add_proxy_str("10.0.0.1:1080:u:p")
+        slow = storage.add_proxy_str("10.0.0.2:1080:u:p")
+        storage.report_status(fast, True, "task", latency=0.05)
+        storage.report_status(slow, True, "task", latency=5.0)
+
+        policy = LatencyWeightedPolicy(storage)
+        assert policy.weight(ProxySession(fast, None)) > 50 * policy.weight(ProxySession(slow, None))
+
+    @pytest.mark.asyncio
+    async def test_max_concurrency(self):
+        pool = ProxyPool()
+        proxy_session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None, max_concurrency=2)
+        await pool.add(proxy_session)
+
+        first = await pool.get(task_key="a", last_used=5.0, timeout=0.1)
+        second = await pool.get(task_key="b", last_used=5.0, timeout=0.1)
+        assert first is second is proxy_session
+        assert proxy_session.in_flight == 2
+
+        # Слоты кончились
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get(task_key="c", last_used=5.0, timeout=0.05)
+
+        # Кулдаун по задаче действует и для параллельных запросов
+        await pool.release(first, "a")
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.get(task_key="a", last_used=5.0, timeout=0.05)
+        assert await pool.get(task_key="c", last_used=5.0, timeout=0.1) is proxy_session
+
+    @pytest.mark.asyncio
+    async def test_removed_proxy_not_returned_on_release(self):
+        pool = ProxyPool()
+        proxy_session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        await pool.add(proxy_session)
+
+        proxy = await pool.get(timeout=0.1)
+        await pool.remove(proxy)
+        await pool.release(proxy, "task")
+        assert proxy not in pool.proxies
+        assert proxy.in_flight == 0
+
+        await pool.add(proxy)
+        assert await pool.get(task_key="other", timeout=0.1) is proxy
+
+    @pytest.mark.asyncio
+    async def test_rate_limit_burst_then_wake_on_token(self):
+        pool = ProxyPool()
+        proxy_session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        await pool.add(proxy_session)
+        rate_limit = RateLimit(rate=10.0, burst=3)
+
+        start = time.monotonic()
+        for _ in range(3):
+            proxy = await pool.get(task_key="api", rate_limit=rate_limit, timeout=0.1)
+            await pool.release(proxy, "api")
+        assert time.monotonic() - start < 0.05
+
+        # Запас кончился - следующий токен через 1 / rate
+        proxy = await pool.get(task_key="api", rate_limit=rate_limit, timeout=1.0)
+        assert 0.08 <= time.monotonic() - start < 0.2
+        await pool.release(proxy, "api")
+
+    @pytest.mark.asyncio
+    async def test_cooldown_keys_stay_bounded(self):
+        pool = ProxyPool(cooldown_ttl=3600.0, max_cooldown_keys=100)
+        proxy_session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        await pool.add(proxy_session)
+
+        for i in range(1000):
+            key = f"crawl@host{i}.example"
+            proxy = await pool.get(task_key=key, last_used=1.0, timeout=0.1)
+            await pool.release(proxy, key)
+
+        assert len(proxy_session.used_time) <= 100
+        assert len(pool._cooling) <= 100
+        assert len(pool._cooldown_heaps) <= 100
+
+    def test_prune_cooldowns_by_ttl(self):
+        session = ProxySession(ProxyData("10.0.0.1", 1080, "u", "p"), None)
+        session.update_used_time("fresh")
+        session.update_used_time("stale")
+        session.used_monotonic["stale"] -= 120.0
+
+        session.prune_cooldowns(ttl=60.0, max_keys=None)
+
+        assert list(session.used_time) == ["fresh"]
+
+class TestProxyChecker:
+    @staticmethod
+    async def _socks5_stand_in(password: str, connects: list):
+        """Локальная SOCKS5 прокси: проверяет пароль и отвечает на CONNECT успехом, никуда не подключаясь"""
+        async def handle(reader, writer):
+            try:
+                _, n_methods = await reader.readexactly(2)
+                await reader.readexactly(n_methods)
+                writer.write(b"\x05\x02")
+                _, user_len = await reader.readexactly(2)
+                await reader.readexactly(user_len)
+                (password_len,) = await reader.readexactly(1)
+                ok = (await reader.readexactly(password_len)).decode() == password
+                writer.write(b"\x01\x00" if ok else b"\x01\x01")
+                if ok:
+                    _, _, _, _, host_len = await reader.readexactly(5)
+                    host = (await reader.readexactly(host_len)).decode()
+                    port = int.from_bytes(await reader.readexactly(2), "big")
+                    connects.append((host, port))
+                    writer.write(b"\x05\x00\x00\x01" + bytes(6))
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+    @pytest.mark.asyncio
+    async def test_handshake_check_reuses_session(self):
+        connects = []
+        server = await self._socks5_stand_in("pass", connects)
+        port = server.sockets[0].getsockname()[1]
+        proxy_data = ProxyData("127.0.0.1", port, "user", "pass")
+        client = AsyncMock(spec=httpx.AsyncClient)
+        client.is_closed = False
+        proxy = ProxySession(proxy_data, client)
+
+        result = await ProxyChecker.check_session(proxy, handshake_target=("example.org", 443))
+
+        assert result is proxy
+        assert proxy.session is client
+        assert connects == [("example.org", 443)]
+        client.get.assert_not_called()
+
+        # Неверный пароль - проверка не прошла
+        proxy_bad = ProxySession(ProxyData("127.0.0.1", port, "user", "wrong"), client)
+        assert await ProxyChecker.check_session(proxy_bad, handshake_target=("example.org", 443)) is None
+        server.close()
+
+    @pytest.mark.asyncio
+    async def test_handshake_check_rebuilds_closed_client(self):
+        server = await self._socks5_stand_in("pass", [])
+        port = server.sockets[0].getsockname()[1]
+        client = httpx.AsyncClient()
+        await client.aclose()
+        proxy = ProxySession(ProxyData("127.0.0.1", port, "user", "pass"), client)
+
+        assert await ProxyChecker.check_session(proxy, handshake_target=("example.org", 443)) is proxy
+        assert proxy.session is not client
+        assert not proxy.session.is_closed
+        await proxy.session.aclose()
+        server.close()
+
+
+class TestClientRegistry:
+    @pytest.mark.asyncio
+    async def test_replaced_client_is_closed_and_dropped(self):
+        registry = ClientRegistry()
+        proxy = ProxySession(ProxyData("10.8.0.1", 8080, "user", "pass"), httpx.AsyncClient())
+        first = proxy.session
+        registry.register(proxy, first)
+        assert registry.live_count == 1
+        assert registry.state(first) == ClientState.live
+
+        # ProxyChecker заменил клиент - старый закрывается при sync
+        proxy.session = httpx.AsyncClient()
+        await registry.sync(proxy)
+        assert first.is_closed
+        assert registry.state(first) == ClientState.closed
+        assert registry.state(proxy.session) == ClientState.live
+        assert registry.live_count == 1
+
+        second = proxy.session
+        await registry.close(proxy)
+        assert second.is_closed
+        assert proxy.session is None
+        assert registry.live_count == 0
+        assert registry.closing_count == 0
+
+
 class TestProxyController:
     @pytest.mark.asyncio
     async def test_create_with_conditions(self):
@@ -421,6 +935,646 @@ class TestProxyController:
         assert len(exceptions) == 2  # 2 задачи должны получить таймаут
 
 
+    @pytest.mark.asyncio
+    async def test_add_proxies_from_file(self, tmp_path):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.aiohttp, with_check=False
+        )
+        path = tmp_path / "proxies.txt"
+        path.write_text(
+            "10.6.0.1:8080:user:pass\n"
+            "# comment\n"
+            "\n"
+            "broken line\n"
+            "10.6.0.2:8080:user:pass\n"
+            "10.6.0.3:port:user:pass\n"
+            "10.6.0.4:8080:user:pass\n"
+        )
+
+        report = await controller.add_proxies(
+            path, conditions_fn=lambda line: {"load": "yes"}, batch_size=2
+        )
+
+        assert report.added == 3
+        assert [line_no for line_no, _, _ in report.rejected] == [4, 6]
+        proxies = await controller.queue.get_many(3, other_conditions={"load": "yes"}, timeout=0.1)
+        assert {proxy.proxy_data.ip for proxy in proxies} == {"10.6.0.1", "10.6.0.2", "10.6.0.4"}
+        # Клиенты создаются только при выдаче через acquire
+        assert all(proxy.session is None for proxy in proxies)
+
+    @pytest.mark.asyncio
+    async def test_lazy_clients_evicted_by_lru(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.aiohttp, with_check=False, max_clients=2
+        )
+        for i in range(4):
+            await controller.add_proxy(f"10.7.0.{i + 1}:8080:user:pass", {"lazy": "yes"})
+        assert controller.clients.live == 0
+
+        used = []
+        for _ in range(4):
+            async with controller.acquire(task_key="lazy", other_conditions={"lazy": "yes"}, timeout=1.0) as proxy:
+                assert proxy.session is not None
+                used.append(proxy)
+
+        # Живых клиентов не больше max_clients, закрыты давно отпущенные
+        assert controller.clients.live == 2
+        assert [proxy.session is None for proxy in used] == [True, True, False, False]
+
+        # Закрытый клиент пересоздается при следующей выдаче
+        async with controller.acquire(task_key="lazy2", other_conditions={"lazy": "yes"}, timeout=1.0) as proxy:
+            assert proxy is used[0]
+            assert proxy.session is not None
+        assert controller.clients.live == 2
+        for proxy in used:
+            await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_sync_proxies_drains_removed(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.aiohttp, with_check=False)
+        storage = ProxyController.proxy_storage
+        await controller.add_proxy("10.8.0.1:8080:user:pass", {"role": "keep"})
+        await controller.add_proxies(["10.8.0.1:8080:user:pass", "10.8.0.2:8080:user:pass"], lambda line: {"role": "drop"})
+        await controller.add_proxy("10.8.0.1:8080:user:pass", {"role": "keep"})
+        assert len(controller.sessions) == 2
+        assert len(controller.queue.proxies) == 2
+
+        kept = controller.sessions[storage.parse_proxy_str("10.8.0.1:8080:user:pass")]
+        storage.report_status(kept.proxy_data, request_status=True, task_key="sync")
+        async with controller.acquire(task_key="sync", other_conditions={"role": "drop"}, timeout=1.0) as gone:
+            report = await controller.sync_proxies(
+                ["10.8.0.1:8080:user:pass", "10.8.0.3:8080:user:pass", "bad line"],
+                conditions_fn=lambda line: {"role": "keep", "synced": "yes"},
+            )
+            assert (report.added, report.removed, report.updated, len(report.rejected)) == (1, 1, 1, 1)
+            # Удаленная прокси еще выдана - клиент и статистика живы до возврата
+            assert gone.session is not None
+            assert gone.proxy_data in storage.proxy_dict
+
+        assert gone.session is None
+        assert gone.proxy_data not in storage.proxy_dict
+        assert gone not in controller.queue.proxies
+        assert controller.sessions[kept.proxy_data] is kept
+        assert "sync_success_request" in storage.proxy_dict[kept.proxy_data]  # статистика сохранилась
+        async with controller.acquire(task_key="sync", other_conditions={"synced": "yes"}, timeout=1.0) as proxy:
+            assert proxy.proxy_data.other_conditions == {"role": "keep", "synced": "yes"}
+
+        assert await controller.remove_proxy("10.8.0.3:8080:user:pass")
+        assert not await controller.remove_proxy("10.8.0.3:8080:user:pass")
+        assert set(controller.queue.proxies) == {kept}
+        await controller.close_proxy_client(kept)
+
+    @pytest.mark.asyncio
+    async def test_circuit_breaker_half_open_trial(self):
+        storage = ProxyController.proxy_storage
+        default_policy = storage.breaker
+        storage.breaker = CircuitBreakerPolicy(min_requests=3, failure_rate=0.5, open_timeout=0.05)
+        try:
+            controller = await ProxyController.create_with_conditions(
+                HttpClientType.httpx, with_check=False, max_concurrency=2
+            )
+            await controller.add_proxy("10.9.0.1:8080:user:pass", {"breaker": "yes"})
+            proxy_data = storage.parse_proxy_str("10.9.0.1:8080:user:pass")
+
+            for _ in range(3):
+                with pytest.raises(ProxyError):
+                    async with controller.acquire(
+                        task_key="breaker", time_condition=0, other_conditions={"breaker": "yes"}, timeout=1.0
+                    ):
+                        raise httpx.ConnectError("refused")
+            # Ошибок меньше MAX_ERROR_COUNT, но выключатель уже вывел прокси из ротации
+            assert storage.get_breaker_state(proxy_data) is BreakerState.open
+            with pytest.raises(TimeoutError):
+                async with controller.acquire(task_key="breaker", other_conditions={"breaker": "yes"}, timeout=0.01):
+                    pass
+
+            await asyncio.sleep(0.1)
+            assert storage.get_breaker_state(proxy_data) is BreakerState.half_open
+            async with controller.acquire(
+                task_key="breaker", time_condition=0, other_conditions={"breaker": "yes"}, timeout=1.0
+            ):
+                # Пробный запрос один, второй слот не выдается
+                with pytest.raises(TimeoutError):
+                    async with controller.acquire(
+                        task_key="breaker2", other_conditions={"breaker": "yes"}, timeout=0.01
+                    ):
+                        pass
+            assert storage.get_breaker_state(proxy_data) is BreakerState.closed
+            async with controller.acquire_many(
+                2, task_key="breaker3", other_conditions={"breaker": "yes"}, min_count=1, timeout=1.0
+            ) as batch:
+                assert len(batch) == 1
+            proxy = controller.sessions[proxy_data]
+            assert proxy.slots == 2
+            await controller.close_proxy_client(proxy)
+        finally:
+            storage.breaker = default_policy
+
+    @pytest.mark.asyncio
+    async def test_acquire_cancelled_during_return_releases_once(self):
+        controller = await ProxyController.create_without_conditions(HttpClientType.httpx, with_check=False)
+        await controller.add_proxy("10.15.0.1:8080:user:pass")
+        proxy = next(iter(controller.sessions.values()))
+        checkin_started = asyncio.Event()
+
+        async def slow_checkin(proxy):
+            checkin_started.set()
+            await asyncio.sleep(1)
+
+        async def use():
+            async with controller.acquire(task_key="once", time_condition=0, timeout=1.0):
+                pass
+
+        # Отмена пришла, когда прокси уже вернулась в очередь, а закрытие клиентов еще идет
+        with patch.object(controller, "_checkin", side_effect=slow_checkin):
+            task = asyncio.create_task(use())
+            await checkin_started.wait()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert list(controller.queue.ready) == [proxy]
+        await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_request_retries_on_other_proxy(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.httpx, with_check=False)
+        await controller.add_proxy("10.10.0.1:8080:user:pass", {"retry": "yes"})
+        await controller.add_proxy("10.10.0.2:8080:user:pass", {"retry": "yes"})
+        storage = ProxyController.proxy_storage
+        tried = []
+
+        async def fake_send(proxy, method, url, kwargs):
+            tried.append(proxy)
+            if len(tried) == 1:
+                raise httpx.ConnectError("refused")
+            return httpx.Response(200, text="ok")
+
+        storage.windows = StatsWindowPolicy()
+        try:
+            with patch.object(ProxyController, "_send", side_effect=fake_send):
+                response = await controller.request(
+                    "GET", "https://example.com/", task_key="retry", time_condition=0, other_conditions={"retry": "yes"}
+                )
+        finally:
+            storage.windows = None
+        assert response.text == "ok"
+        # Отказавшая прокси свободна и без кулдауна, но второй раз в этом вызове не выдается
+        assert tried[0] is not tried[1]
+        assert storage.get_proxy_error_count(tried[0].proxy_data) == 1
+        assert storage.get_latency(tried[1].proxy_data) is not None
+        recent = storage.window_stats(tried[1].proxy_data, "retry")
+        assert (recent.success, recent.errors) == (1, 0)
+        assert all(recent.histogram(metric).count == 1 for metric in TimingMetric)
+        assert storage.window_stats(tried[0].proxy_data, "retry").errors == 1
+        assert {proxy for proxy, _ in storage.iter_window_stats("retry")} >= {p.proxy_data for p in tried}
+
+        async def always_fail(proxy, method, url, kwargs):
+            raise httpx.ConnectError("refused")
+
+        with patch.object(ProxyController, "_send", side_effect=always_fail):
+            with pytest.raises(ProxyError):
+                await controller.request("GET", "https://example.com/", retries=1, other_conditions={"retry": "yes"})
+            # Обе прокси уже отказали - третья попытка ждет до deadline
+            with pytest.raises(TimeoutError):
+                await controller.request(
+                    "GET", "https://example.com/", retries=5, deadline=0.2, other_conditions={"retry": "yes"}
+                )
+        assert all(proxy.in_flight == 0 for proxy in controller.sessions.values())
+        for proxy in controller.sessions.values():
+            await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_hedged_request_cancels_slow_proxy(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.httpx, with_check=False)
+        await controller.add_proxy("10.11.0.1:8080:user:pass", {"hedge": "yes"})
+        await controller.add_proxy("10.11.0.2:8080:user:pass", {"hedge": "yes"})
+        storage = ProxyController.proxy_storage
+        tried = []
+
+        async def fake_send(proxy, method, url, kwargs):
+            tried.append(proxy)
+            if len(tried) == 1:
+                await asyncio.sleep(5)
+            return httpx.Response(200, text=proxy.proxy_data.ip)
+
+        started = time.monotonic()
+        with patch.object(ProxyController, "_send", side_effect=fake_send):
+            response = await controller.request(
+                "GET", "https://example.com/", task_key="hedge", other_conditions={"hedge": "yes"},
+                hedge=HedgePolicy(delay=0.05),
+            )
+        assert time.monotonic() - started < 1.0
+        slow, fast = tried
+        assert response.text == fast.proxy_data.ip
+        # Проигравшая отпущена без ошибки, ее задержка учтена как оценка снизу
+        assert slow.in_flight == 0 and fast.in_flight == 0
+        assert storage.proxy_dict[slow.proxy_data]["hedge_lost"] == 1
+        assert storage.get_latency(slow.proxy_data) >= 0.05
+        assert storage.get_proxy_error_count(slow.proxy_data) == 0
+        assert len(controller.request_latency["hedge"].samples) == 1
+
+        with pytest.raises(ValueError):
+            await controller.request("POST", "https://example.com/", hedge=HedgePolicy())
+        window = LatencyWindow()
+        for i in range(100):
+            window.observe(i / 100)
+        assert HedgePolicy(min_samples=10).hedge_delay(window) == 0.95
+        assert HedgePolicy(min_samples=1000, fallback_delay=2.0).hedge_delay(window) == 2.0
+        for proxy in tried:
+            await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_acquire_many(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx, with_check=False
+        )
+        for i in range(3):
+            await controller.add_proxy(f"10.1.0.{i + 1}:8080:user:pass", {"batch": "yes"})
+
+        async with controller.acquire_many(
+            5, task_key="batch_task", other_conditions={"batch": "yes"}, timeout=1.0
+        ) as batch:
+            assert len({proxy.proxy_data.ip for proxy in batch}) == 3
+            batch.mark_failed(batch[0])
+            failed = batch[0].proxy_data
+
+        storage = ProxyController.proxy_storage
+        assert storage.get_proxy_error_count(failed) == 1
+        assert len(controller.queue.proxies) >= 3
+
+    @pytest.mark.asyncio
+    async def test_acquire_with_host_cooldown(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx, with_check=False
+        )
+        await controller.add_proxy("10.3.0.1:8080:user:pass", {"hosts": "yes"})
+
+        async with controller.acquire(
+            task_key="crawl", time_condition=10.0, other_conditions={"hosts": "yes"}, host="a.example", timeout=1.0
+        ) as proxy:
+            pass
+        # Другой сайт - свой кулдаун
+        async with controller.acquire(
+            task_key="crawl", time_condition=10.0, other_conditions={"hosts": "yes"}, host="b.example", timeout=1.0
+        ):
+            pass
+        with pytest.raises(asyncio.TimeoutError):
+            async with controller.acquire(
+                task_key="crawl", time_condition=10.0, other_conditions={"hosts": "yes"}, host="a.example",
+                timeout=0.05,
+            ):
+                pass
+
+        stats = ProxyController.proxy_storage.proxy_dict[proxy.proxy_data]
+        assert not any("example" in key for key in stats)
+
+    @pytest.mark.asyncio
+    async def test_background_checker_backoff_and_concurrency(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx,
+            with_check=True,
+            health_check=HealthCheckPolicy(concurrency=2, backoff=0.02, max_backoff=0.05, max_attempts=3),
+        )
+        sessions = []
+        for i in range(5):
+            await controller.add_proxy(f"10.4.0.{i + 1}:8080:user:pass", {"health": "yes"})
+            sessions.append(await controller.queue.get(task_key="t", other_conditions={"health": "yes"}, timeout=1.0))
+
+        running = 0
+        max_running = 0
+        attempts = {}
+
+        async def fake_check(proxy, handshake_target=None):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            attempts[proxy] = attempts.get(proxy, 0) + 1
+            # Первая прокси мертва, остальные оживают со второй попытки
+            if proxy is sessions[0] or attempts[proxy] < 2:
+                return None
+            return proxy
+
+        with patch.object(ProxyChecker, "check_session", fake_check):
+            for proxy in sessions:
+                await controller.queue.remove(proxy)
+                await controller.queue.release(proxy, "t")
+                controller.send_proxy_to_check(proxy)
+            await asyncio.sleep(0.5)
+
+        assert max_running == 2
+        assert all(proxy in controller.queue.proxies for proxy in sessions[1:])
+        # Мертвая прокси проверена max_attempts раз и больше не проверяется
+        assert attempts[sessions[0]] == 3
+        assert sessions[0] not in controller.proxy_check_stats
+        assert sessions[0] not in controller.queue.proxies
+        await controller.stop_proxy_checker_task()
+
+    @pytest.mark.asyncio
+    async def test_retired_proxy_can_be_requeued(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx,
+            with_check=True,
+            health_check=HealthCheckPolicy(backoff=0.01, max_backoff=0.01, max_attempts=2),
+        )
+        await controller.add_proxy("10.4.1.1:8080:user:pass", {"retired": "yes"})
+        proxy = await controller.queue.get(task_key="t", other_conditions={"retired": "yes"}, timeout=1.0)
+        await controller.queue.remove(proxy)
+        await controller.queue.release(proxy, "t")
+
+        with patch.object(ProxyChecker, "check_session", AsyncMock(return_value=None)):
+            controller.send_proxy_to_check(proxy)
+            await asyncio.sleep(0.2)
+            assert proxy in controller._retired
+            # Неудачная ручная проверка оставляет прокси выведенной
+            assert await controller.manually_check_proxy("10.4.1.1:8080:user:pass") is False
+        assert proxy in controller._retired
+
+        with patch.object(ProxyChecker, "check_session", AsyncMock(return_value=proxy)):
+            assert await controller.manually_check_proxy("10.4.1.1:8080:user:pass") is True
+        assert proxy not in controller._retired
+        assert proxy in controller.queue.proxies
+
+        # Повторное добавление выведенной прокси отправляет ее на проверку
+        await controller.queue.remove(proxy)
+        controller._retired.add(proxy)
+        with patch.object(ProxyChecker, "check_session", AsyncMock(return_value=proxy)):
+            await controller.add_proxy("10.4.1.1:8080:user:pass", {"retired": "yes"})
+            await asyncio.sleep(0.1)
+        assert proxy not in controller._retired
+        assert proxy in controller.queue.proxies
+        await controller.stop_proxy_checker_task()
+
+    @pytest.mark.asyncio
+    async def test_prober_keeps_client_leased(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.httpx, with_check=False, max_clients=1)
+        await controller.add_proxy("10.5.1.1:8080:user:pass", {"probe_lease": "yes"})
+        async with controller.acquire(task_key="probe_lease", time_condition=0, timeout=1.0) as proxy:
+            pass
+        assert proxy.session is not None
+
+        async def fake_ttfb(probed):
+            # Вытеснение простаивающих клиентов посреди пробы не трогает клиент пробы
+            controller.clients.max_clients = 0
+            await controller.clients.evict()
+            assert controller.clients.leased(probed) and probed.session is not None
+            return 0.05
+
+        prober = ProxyProber(controller)
+        with patch.object(prober, "_time_to_first_byte", fake_ttfb):
+            assert await prober.probe(proxy) == 0.05
+        assert not controller.clients.leased(proxy)
+        assert ProxyController.proxy_storage.get_health_score(proxy.proxy_data) > 0.9
+        await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_prober_demotes_slow_proxy(self):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx, with_check=False, policy=PowerOfTwoChoicesPolicy(ProxyController.proxy_storage)
+        )
+        await controller.add_proxy("10.5.0.1:8080:user:pass", {"probe": "yes"})
+        await controller.add_proxy("10.5.0.2:8080:user:pass", {"probe": "yes"})
+        latencies = {"10.5.0.1": 0.05, "10.5.0.2": 4.0}
+
+        async def fake_ttfb(proxy):
+            return latencies[proxy.proxy_data.ip]
+
+        prober = ProxyProber(controller, rate=200.0)
+        with patch.object(prober, "_time_to_first_byte", fake_ttfb):
+            await prober.start()
+            await asyncio.sleep(0.2)
+            await prober.stop()
+
+        storage = ProxyController.proxy_storage
+        fast, slow = sorted(controller.queue.proxies, key=lambda proxy: proxy.proxy_data.ip)
+        assert storage.get_health_score(fast.proxy_data) > 0.9
+        assert storage.get_health_score(slow.proxy_data) < 0.5
+        # Медленная прокси проигрывает при выборе
+        proxy = await controller.queue.get(task_key="probe", other_conditions={"probe": "yes"}, timeout=0.1)
+        assert proxy is fast
+
+    @pytest.mark.asyncio
+    async def test_prewarmer_targets_upcoming_proxies(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.httpx, with_check=False)
+        for i in range(3):
+            await controller.add_proxy(f"10.12.0.{i + 1}:8080:user:pass")
+        async with controller.acquire(task_key="warm", time_condition=0.3, timeout=1.0) as used:
+            pass
+        # Кулдаун used кончится через 0.3с - в ближайшие 0.1с она не выдается, в ближайшую секунду выдается
+        assert used not in controller.queue.upcoming("warm", 0.3, within=0.1, limit=10)
+        assert len(controller.queue.upcoming("warm", 0.3, within=1.0, limit=10)) == 3
+        assert len(controller.queue.upcoming("warm", 0.3, within=1.0, limit=2)) == 2
+
+        touched = []
+
+        async def fake_touch(session, url):
+            touched.append((session, url))
+
+        prewarmer = ConnectionPrewarmer(
+            controller, ["https://example.com/"], task_key="warm", time_condition=0.3, lead_time=0.1, interval=0.01
+        )
+        with patch.object(ConnectionPrewarmer, "_touch", side_effect=fake_touch):
+            await prewarmer.start()
+            await asyncio.sleep(0.1)
+            await prewarmer.stop()
+
+        # Прогреты только две ближайшие прокси и по разу - повтор не раньше refresh
+        assert len(touched) == 2
+        assert set(prewarmer.warmed) == set(controller.sessions.values()) - {used}
+        for proxy in prewarmer.warmed:
+            assert proxy.session is not None
+            assert not controller.clients.leased(proxy)
+            assert proxy in controller.queue.proxies
+        for proxy in controller.sessions.values():
+            await controller.close_proxy_client(proxy)
+
+    @pytest.mark.asyncio
+    async def test_snapshot_restores_stats_cooldowns_and_checks(self, tmp_path):
+        path = str(tmp_path / "state.db")
+        storage = ProxyController.proxy_storage
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.httpx, with_check=False, snapshot_path=path, snapshot_interval=3600
+        )
+        await controller.add_proxy("10.13.0.1:8080:user:pass", {"snap": "yes"}, max_concurrency=2)
+        await controller.add_proxy("10.13.0.2:8080:user:pass", {"snap": "yes"})
+        async with controller.acquire(
+                task_key="snap", time_condition=60.0, other_conditions={"snap": "yes"}, timeout=1.0
+        ) as used:
+            pass
+        dead = next(proxy for proxy in controller.sessions.values() if proxy is not used)
+        storage.proxy_dict[dead.proxy_data]["error_sequence"] = 100
+        await controller._retire_if_invalid(dead)
+        controller.proxy_check_stats[dead] = 3
+        await controller.stop_snapshots()
+
+        # Перезапуск: статистика и прокси в памяти потеряны
+        for proxy_data in list(controller.sessions):
+            storage.remove_proxy(proxy_data)
+        restarted = await ProxyController.create_with_conditions(
+            HttpClientType.httpx, with_check=False, snapshot_path=path, snapshot_interval=3600
+        )
+        assert len(restarted.sessions) == 2
+        used_again = restarted.sessions[used.proxy_data]
+        dead_again = restarted.sessions[dead.proxy_data]
+        assert used_again.max_concurrency == 2
+        assert storage.get_task_counters(used_again.proxy_data, "snap") == (1, 0)
+        # Мертвая прокси сразу на фоновой проверке, живая выдается только после кулдауна задачи
+        assert restarted.proxy_check_stats == {dead_again: 3}
+        assert storage.get_proxy_error_count(dead_again.proxy_data) == 100
+        with pytest.raises(TimeoutError):
+            async with restarted.acquire(task_key="snap", time_condition=60.0, timeout=0.05):
+                pass
+        async with restarted.acquire(task_key="other", time_condition=60.0, timeout=0.05) as proxy:
+            assert proxy is used_again
+        await restarted.stop_snapshots(save=False)
+        for proxy_data in list(restarted.sessions):
+            storage.remove_proxy(proxy_data)
+
+    @pytest.mark.asyncio
+    async def test_restore_state_yields_between_batches(self):
+        controller = await ProxyController.create_with_conditions(HttpClientType.httpx, with_check=False)
+        states = [
+            ProxyState(
+                f"10.14.0.{i + 1}:8080:user:pass",
+                counters=(0, 1, 0, None, None, None, 0),
+                task_totals={"restore": (1, 0)},
+                used_time={"restore": time.time()},
+            )
+            for i in range(5)
+        ]
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = ticks
+        assert await controller.restore_state(states, batch_size=2) == 5
+        task.cancel()
+        # Цикл событий отпускался между пачками, а не один раз за все восстановление
+        assert ticks - started >= 2
+        assert len(controller.queue.proxies) == 5
+        storage = ProxyController.proxy_storage
+        for proxy_data in list(controller.sessions):
+            assert storage.get_task_counters(proxy_data, "restore") == (1, 0)
+            storage.remove_proxy(proxy_data)
+
+class TestProxyBroker:
+    def test_acquire_frame_roundtrip(self):
+        body = encode_acquire("task", 2.5, None, {"country": "US"}, 3, RateLimit(10.0, 5), "example.com")
+
+        assert decode_acquire(body) == (
+            "task", 2.5, None, {"country": "US"}, 3, RateLimit(10.0, 5), "example.com"
+        )
+
+    @pytest.mark.asyncio
+    async def test_workers_share_cooldowns(self, tmp_path):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.aiohttp, with_check=False
+        )
+        await controller.add_proxy("10.2.0.1:8080:user:pass", {"broker": "yes"})
+        broker = ProxyBroker(controller, str(tmp_path / "broker.sock"))
+        await broker.start()
+
+        first, second = (BrokerClient(broker.path, HttpClientType.aiohttp) for _ in range(2))
+        await first.connect()
+        await second.connect()
+        try:
+            async with first.acquire(
+                task_key="shared", time_condition=10.0, other_conditions={"broker": "yes"}, timeout=1.0
+            ) as proxy:
+                assert proxy.proxy_data.ip == "10.2.0.1"
+
+            # Кулдаун, выставленный первым воркером, действует и на второй
+            with pytest.raises(asyncio.TimeoutError):
+                await second.lease(
+                    task_key="shared", time_condition=10.0, other_conditions={"broker": "yes"}, timeout=0.1
+                )
+            lease_id, proxy = await second.lease(
+                task_key="other", time_condition=10.0, other_conditions={"broker": "yes"}, timeout=1.0
+            )
+            second.release(lease_id, False)
+            await asyncio.sleep(0.05)
+
+            assert ProxyController.proxy_storage.get_proxy_error_count(proxy.proxy_data) == 1
+        finally:
+            await first.close()
+            await second.close()
+            await broker.stop()
+
+    @pytest.mark.asyncio
+    async def test_abandoned_lease_returns_to_pool(self, tmp_path):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.aiohttp, with_check=False
+        )
+        await controller.add_proxy("10.2.0.2:8080:user:pass", {"abandon": "yes"})
+        broker = ProxyBroker(controller, str(tmp_path / "broker.sock"))
+        await broker.start()
+        client = BrokerClient(broker.path, HttpClientType.aiohttp)
+        await client.connect()
+        try:
+            held, _ = await client.lease(time_condition=0, other_conditions={"abandon": "yes"}, timeout=1.0)
+            # Воркер перестал ждать, но брокер выдаст прокси этому запросу, как только она освободится
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    client.lease(time_condition=0, other_conditions={"abandon": "yes"}, timeout=1.0), timeout=0.05
+                )
+            client.release(held, True)
+            lease_id, proxy = await client.lease(time_condition=0, other_conditions={"abandon": "yes"}, timeout=1.0)
+            assert proxy.proxy_data.ip == "10.2.0.2"
+            assert list(broker._leases) == [lease_id]
+            client.release(lease_id, True)
+        finally:
+            await client.close()
+            await broker.stop()
+
+    @pytest.mark.asyncio
+    async def test_remove_leased_proxy_without_conditions(self, tmp_path):
+        controller = await ProxyController.create_without_conditions(HttpClientType.aiohttp, with_check=False)
+        await controller.add_proxy("10.2.0.3:8080:user:pass")
+        storage = ProxyController.proxy_storage
+        broker = ProxyBroker(controller, str(tmp_path / "broker.sock"))
+        await broker.start()
+        client = BrokerClient(broker.path, HttpClientType.aiohttp)
+        await client.connect()
+        try:
+            lease_id, proxy = await client.lease(task_key="removed", time_condition=0, timeout=1.0)
+            # Прокси выдана брокером без клиента контроллера - удаление ждет ее возврата
+            assert await controller.remove_proxy("10.2.0.3:8080:user:pass")
+            assert storage.proxy_dict.get(proxy.proxy_data) is not None
+            client.release(lease_id, True)
+            await asyncio.sleep(0.05)
+            assert storage.proxy_dict.get(proxy.proxy_data) is None
+            # Соединение воркера живо после возврата удаленной прокси
+            with pytest.raises(asyncio.TimeoutError):
+                await client.lease(task_key="removed", time_condition=0, timeout=0.05)
+        finally:
+            await client.close()
+            await broker.stop()
+
+    @pytest.mark.asyncio
+    async def test_acquire_error_reaches_worker(self, tmp_path):
+        controller = await ProxyController.create_with_conditions(
+            HttpClientType.aiohttp, with_check=False
+        )
+        broker = ProxyBroker(controller, str(tmp_path / "broker.sock"))
+        await broker.start()
+        client = BrokerClient(broker.path, HttpClientType.aiohttp)
+        await client.connect()
+        try:
+            # Неожиданная ошибка очереди приходит воркеру как ProxyError, а не вешает lease
+            with patch.object(controller.queue, "get", side_effect=RuntimeError("queue is broken")):
+                with pytest.raises(ProxyError, match="queue is broken"):
+                    await asyncio.wait_for(client.lease(task_key="broken", timeout=1.0), timeout=1.0)
+        finally:
+            await client.close()
+            await broker.stop()
+
 class TestIntegration:
     @pytest.mark.asyncio
     async def test_full_workflow(self):